@@ -1,8 +1,16 @@
 from collections import Counter, defaultdict
 from typing import Tuple, List
-from copy import deepcopy
+from random import Random
 import numpy as np
 
+# Known cards are packed into a single integer, with a fixed-width
+# field holding the count for each suit. The field is wide enough that
+# the packed counts of all hands can be summed without overflowing into
+# the next suit (there are only 4 * number_of_players cards in total),
+# for up to fifteen players.
+SUIT_BITS = 6
+SUIT_MASK = (1 << SUIT_BITS) - 1
+
 class Hand:
     """
     Represents a single hand of cards. Cards are either of a
@@ -10,20 +18,100 @@ class Hand:
     define the possibilities in terms of what we know they are
     not. For example, if the holder has said they do not have
     a card in a given suit, we record that fact.
+
+    The hand is stored compactly as three integers: the packed
+    counts of the known cards (SUIT_BITS per suit), a bitmask of
+    the known voids, and the number of unknown cards. This makes
+    hands cheap to copy and to encode as positions.
     """
+    __slots__ = ('counts', 'voids', 'number_of_unknown_cards')
+
     def __init__(self):
         """
         Creates an empty hand
         """
-        self.known_cards = Counter()        # Counter of suit -> count
-        self.known_voids = set()            # set of suits we know we don't have
+        self.counts = 0                     # packed suit -> count
+        self.voids = 0                      # bitmask of suits we know we don't have
         self.number_of_unknown_cards = 4    # we always start with four cards
 
+    def copy(self) -> 'Hand':
+        """
+        Returns an independent copy of this hand. Much faster than deepcopy.
+        """
+        result = Hand.__new__(Hand)
+        result.counts = self.counts
+        result.voids = self.voids
+        result.number_of_unknown_cards = self.number_of_unknown_cards
+        return result
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def count(self, suit: int) -> int:
+        """
+        Returns the number of known cards of the given suit
+        """
+        return (self.counts >> (suit * SUIT_BITS)) & SUIT_MASK
+
+    def is_void(self, suit: int) -> bool:
+        """
+        Returns true if we know this hand has none of the given suit
+        """
+        return (self.voids >> suit) & 1 == 1
+
+    @property
+    def known_cards(self) -> Counter:
+        """
+        Counter of suit -> count for the known cards. This is a snapshot,
+        so modifying it does not modify the hand, but it can be assigned.
+        """
+        result = Counter()
+        counts = self.counts
+        suit = 0
+        while counts:
+            count = counts & SUIT_MASK
+            if count:
+                result[suit] = count
+            counts >>= SUIT_BITS
+            suit += 1
+        return result
+
+    @known_cards.setter
+    def known_cards(self, cards):
+        counts = 0
+        for suit, count in cards.items():
+            assert 0 <= count <= SUIT_MASK
+            counts += count << (suit * SUIT_BITS)
+        self.counts = counts
+
+    @property
+    def known_voids(self) -> set:
+        """
+        Set of suits we know we don't have. This is a snapshot, so
+        modifying it does not modify the hand, but it can be assigned.
+        """
+        result = set()
+        voids = self.voids
+        suit = 0
+        while voids:
+            if voids & 1:
+                result.add(suit)
+            voids >>= 1
+            suit += 1
+        return result
+
+    @known_voids.setter
+    def known_voids(self, suits):
+        voids = 0
+        for suit in suits:
+            voids |= 1 << suit
+        self.voids = voids
+
     def is_empty(self):
         """
         Returns true if this player has no cards at all.
         """
-        return not self.known_cards and self.number_of_unknown_cards == 0
+        return self.counts == 0 and self.number_of_unknown_cards == 0
 
     def show(self, is_next_player: bool):
         """
@@ -36,16 +124,12 @@ class Hand:
             print()
 
     def __str__(self):
-        result = ""
-        for suit in self.known_cards.elements():
-            result += str(suit)
-        for _ in range(self.number_of_unknown_cards):
-            result += "?"
-        if self.known_voids:
-            result += "x"
-            for kv in self.known_voids:
-                result += str(kv)
-        return result
+        parts = [str(suit) * count for suit, count in self.known_cards.items()]
+        parts.append("?" * self.number_of_unknown_cards)
+        if self.voids:
+            parts.append("x")
+            parts.extend(str(kv) for kv in sorted(self.known_voids))
+        return "".join(parts)
 
     def ensure_have(self, suit: int) -> bool:
         """
@@ -55,32 +139,32 @@ class Hand:
         """
 
         # easy if we already have one
-        if suit in self.known_cards:
-            assert(self.known_cards[suit] > 0)
+        shift = suit * SUIT_BITS
+        if (self.counts >> shift) & SUIT_MASK:
             return True
         
         # convert one of the unknowns into one of these
-        if suit in self.known_voids:
+        if (self.voids >> suit) & 1:
             return False
 
         self._remove_unknown()
-        self.known_cards[suit] = 1
+        self.counts += 1 << shift
         return True
 
     def _remove_unknown(self):
         assert(self.number_of_unknown_cards > 0)
         self.number_of_unknown_cards -= 1
         if self.number_of_unknown_cards == 0:
-            self.known_voids.clear()
+            self.voids = 0
 
     def ensure_have_not(self, suit: int) -> bool:
         """
         We know this hand does not contain this suit. For example the player has
         rejected a request for a card. Returns True if we were able to validate it.
         """
-        if suit in self.known_cards:
+        if (self.counts >> (suit * SUIT_BITS)) & SUIT_MASK:
             return False
-        self.known_voids.add(suit)
+        self.voids |= 1 << suit
         return True
 
     def remove(self, suit: int) -> bool:
@@ -88,14 +172,11 @@ class Hand:
         Take one card of this suit away from the user. If it is a known card, remove that.
         If not, take it from the unknowns. Returns True if we were able to remove it
         """
-        if suit in self.known_cards:
-            count = self.known_cards[suit]
-            if count > 1:
-                self.known_cards[suit] = count - 1
-            else:
-                del self.known_cards[suit]  # avoid empties
+        shift = suit * SUIT_BITS
+        if (self.counts >> shift) & SUIT_MASK:
+            self.counts -= 1 << shift
             return True
-        elif suit in self.known_voids:
+        elif (self.voids >> suit) & 1:
             return False
         else:
             self._remove_unknown()
@@ -105,15 +186,17 @@ class Hand:
         """
         Adds a card to this hand
         """
-        self.known_cards[suit] += 1
+        self.counts += 1 << (suit * SUIT_BITS)
 
     def has_four_of_a_kind(self):
         """
         Returns true if this hand contains four of a kind.
         """
-        for _, count in self.known_cards.items():
-            if count == 4:
+        counts = self.counts
+        while counts:
+            if counts & SUIT_MASK == 4:
                 return True
+            counts >>= SUIT_BITS
         return False
     
     def is_determined(self):
@@ -133,8 +216,9 @@ class Hand:
         There are four known cards of this suit, so we know it is
         no longer unknown. Returns True if anything changed.
         """
-        if self.number_of_unknown_cards > 0 and suit not in self.known_voids:
-            self.known_voids.add(suit)
+        bit = 1 << suit
+        if self.number_of_unknown_cards > 0 and not self.voids & bit:
+            self.voids |= bit
             return True
         else:
             return False
@@ -149,28 +233,29 @@ class Hand:
         
         # If we know that all the unknowns are of the same suit,
         # fix them and return True
-        if len(self.known_voids) == number_of_suits - 1:
-            # find the only possible non-void
-            diff = set(range(number_of_suits)) - self.known_voids
-            for i in diff:
-                self.known_cards[i] += self.number_of_unknown_cards
-                self.number_of_unknown_cards = 0
-                self.known_voids.clear()
-                return True
+        possible = ((1 << number_of_suits) - 1) & ~self.voids
+        if possible and possible & (possible - 1) == 0:
+            # there is only one possible non-void
+            suit = possible.bit_length() - 1
+            self.counts += self.number_of_unknown_cards << (suit * SUIT_BITS)
+            self.number_of_unknown_cards = 0
+            self.voids = 0
+            return True
 
         # TODO: There is more logic we could deploy here.
         # For example, if there are two unknowns and we know we need
         # two different suits, we could set them both to one.
+        return False
 
     def is_legal(self, suit: int) -> bool:
         """
         Can I legally ask for the given suit?
         """
-        if suit in self.known_cards:
+        if (self.counts >> (suit * SUIT_BITS)) & SUIT_MASK:
             return True     # I have one of these, so can ask
         if self.number_of_unknown_cards == 0:
             return False    # No unknown cards, so cannot ask
-        if suit in self.known_voids:
+        if (self.voids >> suit) & 1:
             return False    # We know I have none of these
         return True
     
@@ -179,22 +264,24 @@ class Hand:
         Does this hand definitely contain the given suit?
         Returns a tuple of [forced, yes/no]
         """
-        if suit in self.known_cards:
+        if (self.counts >> (suit * SUIT_BITS)) & SUIT_MASK:
             return True, True   # We definitely have this card
         elif self.number_of_unknown_cards == 0:
             return True, False  # We definitely do not have it
-        elif suit in self.known_voids:
+        elif (self.voids >> suit) & 1:
             return True, False  # We definitely do not have it
         else:
             return False, True  # We may or may not have it
 
-    def fill_unknowns(self, totals: Counter) -> bool:
+    def fill_unknowns(self, totals) -> bool:
         """
         If only one of the hands has any unknowns in it, we
         can fill them given the counts of other cards. Returns
-        True if it cannot be done.
+        True if it cannot be done. The totals may be a Counter
+        or a list indexed by suit.
         """
-        for suit, count in totals.items():
+        items = totals.items() if isinstance(totals, dict) else enumerate(totals)
+        for suit, count in items:
             if count < 4:
                 if not self.fill_some_unknowns(suit, 4 - count):
                     return False
@@ -211,9 +298,9 @@ class Hand:
         assert count <= 4
         if self.number_of_unknown_cards < count:
             return False
-        assert suit not in self.known_voids
+        assert not (self.voids >> suit) & 1
         self.number_of_unknown_cards -= count
-        self.known_cards[suit] += count
+        self.counts += count << (suit * SUIT_BITS)
         return True
 
     def position(self, pos: int, permutation: np.ndarray) -> int:
@@ -226,48 +313,39 @@ class Hand:
         the count of cards in any suit must be less than four.
         """
         # start by packing the counts of each suit, using two bits per suit
+        counts = self.counts
         for i in permutation:
-            count = self.known_cards[i]
-            assert(count >= 0 and count < 4)
-            pos *= 4
-            pos += count
+            count = (counts >> (i * SUIT_BITS)) & SUIT_MASK
+            assert(count < 4)
+            pos = (pos << 2) | count
         
         # now pack three bits for a count of unknown cards (0..4)
-        pos *= 8
-        pos += self.number_of_unknown_cards
+        pos = (pos << 3) | self.number_of_unknown_cards
 
         # finally, pack one bit for each known void
+        voids = self.voids
         for i in permutation:
-            count = 1 if i in self.known_voids else 0
-            pos *= 2
-            pos += count
+            pos = (pos << 1) | ((voids >> i) & 1)
         
         return pos
 
-    def adjust_ranking(self, rankings: np.ndarray):
+    def adjust_ranking(self, rankings: List[int]):
         """
-        Given an array of rankings for the different suits,
+        Given a list of rankings for the different suits,
         adjust the rankings to make more common suits higher
         than less common ones. This function is called
         for each hand in turn, with the earlier invocations
         more significant than the later.
-        """
-        # Shift the existing rankings up out of the way      
-        n = len(rankings)
-        rankings *= n
 
-        # add the suit counts to the rankings
-        for i in range(n):
-            rankings[i] += self.known_cards[i]
-        
-        # make space for the voids
-        rankings *= 2
-
-        # add any voids to the rankings (count one each)
-        for i in range(n):
-            if i in self.known_voids:
-                rankings[i] += 1
-        
+        Each hand gets a field in the rankings wide enough for any
+        count and void, so two suits only have the same ranking if
+        they look the same in every hand.
+        """
+        counts = self.counts
+        voids = self.voids
+        for i in range(len(rankings)):
+            rankings[i] = ((rankings[i] << (SUIT_BITS + 1))
+                | ((counts >> (i * SUIT_BITS)) & SUIT_MASK) << 1 | (voids >> i) & 1)
         return rankings
 
 class Cards:
@@ -275,10 +353,124 @@ class Cards:
     Represents a pack of playing cards, divided by the given number
     of players. There are four cards per player, and the same
     number of suits as players.
+
+    As well as the hands, we keep two running per-suit tallies, packed
+    in the same way as Hand.counts: the number of known cards of each
+    suit, and the number of unknown cards (open slots) that could still
+    be of each suit. We also keep bitmasks of the suits and hands that
+    have changed since the cards were last shaken down. These are all
+    updated incrementally as the hands change, so the hands must only be
+    modified via Cards methods (or by assigning a new list of hands).
     """
+    __slots__ = ('_hands', '_journal', '_known', '_slots', '_spread', '_keys', '_hash',
+        '_exact', '_dirty_suits', '_dirty_hands', 'shake_down_cache', 'position_cache',
+        'has_card_cache')
+
     def __init__(self, number_of_players):
+        # undo journal of (player, counts, voids, number_of_unknown_cards,
+        # known, slots, dirty_suits, dirty_hands), recording the state of
+        # each hand and of the per-suit tallies before it was changed. This
+        # is None unless somebody has called mark.
+        self._journal = None
         self.hands = [Hand() for _ in range(number_of_players)]
-    
+
+        # optional ShakeDownCache, PositionCache and HasCardCache, shared
+        # by any copies of these cards
+        self.shake_down_cache = None
+        self.position_cache = None
+        self.has_card_cache = None
+
+    @property
+    def hands(self) -> List[Hand]:
+        return self._hands
+
+    @hands.setter
+    def hands(self, hands: List[Hand]):
+        self._hands = hands
+        self._spread = _spread_table(len(hands))
+        self._keys = _key_table(len(hands))
+        self.recount()
+
+    def recount(self):
+        """
+        Recalculates the per-suit tallies and the keys from scratch, and marks
+        everything as needing to be shaken down. Only needed if the hands have
+        been modified directly.
+        """
+        self._known = 0
+        self._slots = 0
+        self._hash = 0
+        self._exact = 0
+        for hand, keys in zip(self._hands, self._keys):
+            self._known += hand.counts
+            self._slots += self._hand_slots(hand.voids, hand.number_of_unknown_cards)
+            self._add_to_keys(keys, hand.counts, hand.voids, hand.number_of_unknown_cards)
+        everything = (1 << len(self._hands)) - 1
+        self._dirty_suits = everything
+        self._dirty_hands = everything
+
+    def _add_to_keys(self, keys: Tuple[int, ...], counts: int, voids: int, unknowns: int):
+        """
+        Updates the hash and the exact key, given the changes to the packed
+        counts, voids and number of unknown cards of one hand (as in
+        _key_table, the keys for that hand).
+        """
+        counts_key, voids_key, unknowns_key, counts_place, voids_place, unknowns_place = keys
+        self._hash = (self._hash + counts * counts_key + voids * voids_key
+            + unknowns * unknowns_key) & ZOBRIST_MASK
+        self._exact += counts * counts_place + voids * voids_place + unknowns * unknowns_place
+
+    def _hand_slots(self, voids: int, unknowns: int) -> int:
+        """
+        Returns the packed open slots contributed by a single hand
+        """
+        spread = self._spread
+        return unknowns * spread[(len(spread) - 1) & ~voids]
+
+    def copy(self) -> 'Cards':
+        """
+        Returns an independent copy of these cards. Much faster than deepcopy.
+        The copy does not share or inherit the undo journal.
+        """
+        result = Cards.__new__(Cards)
+        result._hands = [hand.copy() for hand in self._hands]
+        result._journal = None
+        result._known = self._known
+        result._slots = self._slots
+        result._spread = self._spread
+        result._keys = self._keys
+        result._hash = self._hash
+        result._exact = self._exact
+        result._dirty_suits = self._dirty_suits
+        result._dirty_hands = self._dirty_hands
+        result.shake_down_cache = self.shake_down_cache
+        result.position_cache = self.position_cache
+        result.has_card_cache = self.has_card_cache
+        return result
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def totals(self) -> List[int]:
+        """
+        Returns the number of known cards of each suit, summed over all hands.
+        """
+        known = self._known
+        return [(known >> (suit * SUIT_BITS)) & SUIT_MASK for suit in range(len(self._hands))]
+
+    def total(self, suit: int) -> int:
+        """
+        Returns the number of known cards of the given suit, in all hands.
+        """
+        return (self._known >> (suit * SUIT_BITS)) & SUIT_MASK
+
+    def open_slots(self, suit: int) -> int:
+        """
+        Returns the number of unknown cards, in all hands, that could
+        still be of the given suit.
+        """
+        return (self._slots >> (suit * SUIT_BITS)) & SUIT_MASK
+
     def is_empty(self, player):
         return self.hands[player].is_empty()
 
@@ -304,6 +496,105 @@ class Cards:
             result += str(hand)
         return result
 
+    def mark(self) -> int:
+        """
+        Starts (or continues) recording changes in the undo journal, and
+        returns a marker for the current state. Any changes made by
+        transfer, no_transfer or shake_down can then be rolled back by
+        passing the marker to undo. Marks must be properly nested.
+        """
+        if self._journal is None:
+            self._journal = []
+            return Cards.OUTERMOST_MARK
+        return len(self._journal)
+
+    # Marker returned by the mark that started the undo journal
+    OUTERMOST_MARK = -1
+
+    def undo(self, mark: int):
+        """
+        Rolls the cards back to the state they were in when mark was
+        called. Undoing the outermost mark stops the journal recording.
+        Undoing the same mark twice is harmless.
+        """
+        journal = self._journal
+        if journal is None:
+            return      # already rolled back past the outermost mark
+        hands = self._hands
+        while len(journal) > max(mark, 0):
+            (player, counts, voids, unknowns,
+                known, slots, hash, exact, dirty_suits, dirty_hands) = journal.pop()
+            hand = hands[player]
+            hand.counts = counts
+            hand.voids = voids
+            hand.number_of_unknown_cards = unknowns
+            self._known = known
+            self._slots = slots
+            self._hash = hash
+            self._exact = exact
+            self._dirty_suits = dirty_suits
+            self._dirty_hands = dirty_hands
+        if mark == Cards.OUTERMOST_MARK:
+            self._journal = None
+
+    def _record(self, player: int) -> Tuple[int, int, int, int]:
+        """
+        Returns the current state of a hand, also recording it in the
+        undo journal, if any.
+        """
+        hand = self._hands[player]
+        state = (player, hand.counts, hand.voids, hand.number_of_unknown_cards)
+        if self._journal is not None:
+            self._journal.append(state + (self._known, self._slots, self._hash,
+                self._exact, self._dirty_suits, self._dirty_hands))
+        return state
+
+    def _track(self, state: Tuple[int, int, int, int], suit: int = -1) -> bool:
+        """
+        Updates the per-suit tallies and the hash after a hand has changed, and marks the
+        hand and any suits whose tallies changed as needing to be shaken
+        down. Pass in the state of the hand before the change, as returned
+        by _record, and the suit if we know that only the known cards of that
+        suit can have changed. Returns True if anything changed.
+        """
+        player, counts, voids, unknowns = state
+        hand = self._hands[player]
+        new_voids = hand.voids
+        new_unknowns = hand.number_of_unknown_cards
+        changed_counts = hand.counts - counts
+        if not changed_counts and new_voids == voids and new_unknowns == unknowns:
+            return False
+        self._dirty_hands |= 1 << player
+        (counts_key, voids_key, unknowns_key,
+            counts_place, voids_place, unknowns_place) = self._keys[player]
+        changed_voids = new_voids - voids
+        changed_unknowns = new_unknowns - unknowns
+        self._hash = (self._hash + changed_counts * counts_key + changed_voids * voids_key
+            + changed_unknowns * unknowns_key) & ZOBRIST_MASK
+        self._exact += (changed_counts * counts_place + changed_voids * voids_place
+            + changed_unknowns * unknowns_place)
+
+        # Suits whose totals have changed
+        if changed_counts:
+            self._known += changed_counts
+            if suit >= 0:
+                self._dirty_suits |= 1 << suit
+            else:
+                self._dirty_suits |= _changed_suits(hand.counts ^ counts)
+
+        # Suits whose open slots have changed
+        everything = len(self._spread) - 1
+        if new_unknowns == unknowns:
+            changed_suits = (voids ^ new_voids) & everything if unknowns else 0
+        else:
+            changed_suits = ((everything & ~voids if unknowns else 0)
+                | (everything & ~new_voids if new_unknowns else 0))
+        if changed_suits:
+            self._slots += (self._hand_slots(new_voids, new_unknowns)
+                - self._hand_slots(voids, unknowns))
+            self._dirty_suits |= changed_suits
+        return True
+
     def transfer(self, suit, other, this, no_throw) -> bool:
         """
         Moves a card from one hand to another after a successful request.
@@ -311,16 +602,28 @@ class Cards:
         player who said they did not have the card. Returns True if it 
         could be done.
         """
-        # must have the suit to be able to ask
-        if not self.hands[this].ensure_have(suit):
+        this_hand = self._hands[this]
+        other_hand = self._hands[other]
+        this_state = self._record(this)
+        other_state = self._record(other)
+
+        # must have the suit to be able to ask, and the other player
+        # must be able to give it to us
+        has_suit = this_hand.ensure_have(suit)
+        can_give = has_suit and other_hand.remove(suit)
+        if can_give:
+            this_hand.add(suit)         # and give it to this player
+        self._track(this_state, suit)
+        self._track(other_state, suit)
+
+        if not has_suit:
             if no_throw:
                 return False
             assert False, f"Cannot ask for {suit} as we know you don't have any"
-        if not self.hands[other].remove(suit):
+        if not can_give:
             if no_throw:
                 return False
             assert False, f"We know player {other} doesn't have any {suit}"
-        self.hands[this].add(suit)         # and give it to this player
         return True
 
     def no_transfer(self, suit, other, this, no_throw) -> bool:
@@ -330,13 +633,23 @@ class Cards:
         said they did not have the card. Returns True if it could be
         done.
         """
-        # must have the suit to be able to ask
-        if not self.hands[this].ensure_have(suit):
+        this_hand = self._hands[this]
+        other_hand = self._hands[other]
+        this_state = self._record(this)
+        other_state = self._record(other)
+
+        # must have the suit to be able to ask, and the other player
+        # must have a void
+        has_suit = this_hand.ensure_have(suit)
+        has_void = has_suit and other_hand.ensure_have_not(suit)
+        self._track(this_state, suit)
+        self._track(other_state, suit)
+
+        if not has_suit:
             if no_throw:
                 return False
             assert False, f"Cannot ask for {suit} as we know you don't have any"
-        # other player must have a void
-        if not self.hands[other].ensure_have_not(suit):
+        if not has_void:
             if no_throw:
                 return False
             assert False, f"Cannot reject {suit} as we know you have one"
@@ -381,82 +694,173 @@ class Cards:
         """
         Resolve any logical inferences that can be made on the cards.
         Returns True if the cards are logically consistent.
+
+        The inference is driven by a worklist of the suits and hands
+        that have changed since the cards were last shaken down. Each
+        rule only revisits the suits and hands it depends on that are in
+        the worklist, and any deduction adds the suits and hands it
+        touches. Cheap rules are applied before expensive ones, and an
+        item only leaves the worklist once no rule has anything more to
+        deduce from it.
+        """
+        if not self._dirty_suits and not self._dirty_hands:
+            return True     # nothing has changed since we were last shaken down
+
+        # Record any hands that are changed by the shake down
+        journal = self._journal
+        if journal is not None:
+            before = [(player, hand.counts, hand.voids, hand.number_of_unknown_cards,
+                    self._known, self._slots, self._hash, self._exact,
+                    self._dirty_suits, self._dirty_hands)
+                for player, hand in enumerate(self._hands)]
+
+        # Either look up the result, or work it out
+        cache = self.shake_down_cache
+        entry = None
+        if cache is not None:
+            key = self._shake_down_key()
+            entry = cache.get(key)
+        if entry is not None:
+            ok = self._restore_shaken(entry)
+        else:
+            ok = self._shake_down()
+            if not ok:
+                # The cards are inconsistent. Make sure anybody who tries
+                # again (e.g. after changing the hands) starts from scratch.
+                everything = (1 << len(self._hands)) - 1
+                self._dirty_suits = everything
+                self._dirty_hands = everything
+            if cache is not None:
+                cache.put(key, (ok, tuple((hand.counts, hand.voids, hand.number_of_unknown_cards)
+                    for hand in self._hands), self._known, self._slots,
+                    self._hash, self._exact))
+
+        if journal is not None:
+            for entry in before:
+                hand = self._hands[entry[0]]
+                if (hand.counts != entry[1] or hand.voids != entry[2]
+                        or hand.number_of_unknown_cards != entry[3]):
+                    journal.append(entry)
+        return ok
+
+    def _shake_down_key(self) -> int:
+        """
+        Returns an exact key for the state of the cards before shaking down:
+        all the hands, plus the worklist. (We do not use the canonical
+        position, as it costs more to calculate than it would save.)
+        """
+        n = len(self._hands)
+        return ((self.exact_key() << n | self._dirty_suits) << n) | self._dirty_hands
+
+    def _restore_shaken(self, entry) -> bool:
+        """
+        Sets the cards to the result of a shake down, as stored in
+        a ShakeDownCache. Returns whether the cards were consistent.
+        """
+        ok, states, known, slots, hash, exact = entry
+        for hand, (counts, voids, unknowns) in zip(self._hands, states):
+            hand.counts = counts
+            hand.voids = voids
+            hand.number_of_unknown_cards = unknowns
+        self._known = known
+        self._slots = slots
+        self._hash = hash
+        self._exact = exact
+        dirty = 0 if ok else (1 << len(self._hands)) - 1
+        self._dirty_suits = dirty
+        self._dirty_hands = dirty
+        return ok
+
+    def _shake_down(self) -> bool:
         """
-        len_hands = len(self.hands)
-        all_suits = {s for s in range(len_hands)}
+        Implementation of shake_down, returning False as soon as we find
+        an inconsistency. This ignores the undo journal.
+        """
+        hands = self._hands
+        len_hands = len(hands)
+        all_suits = (1 << len_hands) - 1
 
         # Keep shaking until nothing else settles out
-        any_changes = True
-        while any_changes:
+        while self._dirty_suits or self._dirty_hands:
+            suits = self._dirty_suits
+            players = self._dirty_hands
             any_changes = False
 
             # If we know the whereabouts of four cards of any suit,
             # we can eliminate them from our enquiries
-            totals = Counter()
-            for hand in self.hands:
-                hand.running_totals(totals)
-            for suit, total in totals.items():
-                # if we have made changes, break out of the loop so we redo the totals
-                if any_changes:
-                    break
+            for suit in range(len_hands):
+                if not (suits >> suit) & 1:
+                    continue
+                shift = suit * SUIT_BITS
+                total = (self._known >> shift) & SUIT_MASK
+                if total == 0:
+                    continue
                 if total > 4:
                     return False
                 if total == 4:
                     # If we know the whereabouts of all cards in a suit, we know that
                     # none of the unknown cards are of that suit.
-                    for hand in self.hands:
-                        if hand.kill_unknown(suit):
-                            any_changes = True
+                    if (self._slots >> shift) & SUIT_MASK:
+                        for player in range(len_hands):
+                            if self._kill_unknown(player, suit):
+                                any_changes = True
                 else:
+                    # If we know that the unknown cards in one suit only just fit in the
+                    # remaining unknown slots, even spanning multiple hands, we can fill in
+                    # those cards. This includes the case where all the unknown cards of
+                    # one suit are in one hand.
+                    remainder = 4 - total
+                    slots = (self._slots >> shift) & SUIT_MASK
+                    if slots < remainder:
+                        return False    # not enough unknown cards to fit this suit
+                    bit = 1 << suit
+                    players_with_unknowns = [player for player, hand in enumerate(hands)
+                        if hand.number_of_unknown_cards > 0 and not hand.voids & bit]
+                    if slots == remainder:
+                        for player in players_with_unknowns:
+                            unknowns = hands[player].number_of_unknown_cards
+                            if not self._fill_some_unknowns(player, suit, unknowns):
+                                return False
+                        any_changes = True
+
                     # If we know that all the unknown cards of one suit are in one hand,
                     # we can fill in all those cards in that hand.
-                    hands_with_unknowns = []
-                    number_of_unknown_cards = 0
-                    for hand in self.hands:
-                        if hand.number_of_unknown_cards > 0 and not suit in hand.known_voids:
-                            hands_with_unknowns.append(hand)
-                            number_of_unknown_cards += hand.number_of_unknown_cards
-                    if len(hands_with_unknowns) == 1:
-                        if not hands_with_unknowns[0].fill_some_unknowns(suit, 4 - total):
+                    elif len(players_with_unknowns) == 1:
+                        if not self._fill_some_unknowns(players_with_unknowns[0], suit, remainder):
                             return False
                         any_changes = True
-
-                    # If we know that the unknown cards in one suit only just fit in the
-                    # remaining unknown slots, even spanning multiple hands, we can fill in
-                    # those cards.
-                    else:
-                        remainder = 4 - total
-                        if number_of_unknown_cards < remainder:
-                            return False    # not enough unknown cards to fit this suit
-                        elif number_of_unknown_cards == remainder:
-                            for hand in hands_with_unknowns:
-                                if not hand.fill_some_unknowns(suit, hand.number_of_unknown_cards):
-                                    return False
-                            any_changes = True
         
             # If all the unknown cards in a hand are of just one suit,
-            # force them to be known.
-            for hand in self.hands:
-                if hand.force_unknowns(len_hands):
-                    any_changes = True
+            # force them to be known. If they cannot be of any suit, the
+            # cards are inconsistent.
+            for player, hand in enumerate(hands):
+                if (players >> player) & 1 and hand.number_of_unknown_cards:
+                    possible = all_suits & ~hand.voids
+                    if not possible:
+                        return False
+                    if possible & (possible - 1) == 0:
+                        state = (player, hand.counts, hand.voids, hand.number_of_unknown_cards)
+                        hand.force_unknowns(len_hands)
+                        self._track(state)
+                        any_changes = True
             
-            # redo the totals if there were any changes
+            # redo the cheap rules if there were any changes
             if any_changes:
                 continue
             
             # If all the unknowns are in one hand, we must know what they are
-            hands_with_unknowns = []
-            for hand in self.hands:
-                if hand.number_of_unknown_cards > 0:
-                    hands_with_unknowns.append(hand)
-            if len(hands_with_unknowns) == 1:
-                if not hands_with_unknowns[0].fill_unknowns(totals):
-                    return False
-                any_changes = True
-
-            # redo the totals if there were any changes
-            if any_changes:
-                continue
+            if players:
+                players_with_unknowns = [player for player, hand in enumerate(hands)
+                    if hand.number_of_unknown_cards > 0]
+                if len(players_with_unknowns) == 1:
+                    hand = hands[players_with_unknowns[0]]
+                    state = (players_with_unknowns[0], hand.counts, hand.voids,
+                        hand.number_of_unknown_cards)
+                    ok = hand.fill_unknowns(self.totals())
+                    self._track(state)
+                    if not ok:
+                        return False
+                    continue
             
             # Considering each hand separately, if there are limited options
             # for the unknown cards, we may be able to fill some or all in.
@@ -468,34 +872,35 @@ class Cards:
             # are M unknown cards, take the N possible combinations of N-1 suits
             # and for each see whether there are fewer than M cards (say P). If
             # so, there must be at least M - P cards in the remaining suit.
-            for suit in range(len(self.hands)):
-                if suit not in totals:
-                    totals[suit] = 0    # first fill in any complete blanks
 
             # Consider the cards: 2???/0???x2/????x0.
             # Player 2 must be holding a 1, because he can have at most 3
             # 2's and can't have any 0's
-
-            for hand in self.hands:
-                if hand.number_of_unknown_cards > 1:
+            #
+            # This depends on the hand itself, and the totals of any suits
+            # it may hold.
+            totals = self.totals()
+            for player, hand in enumerate(hands):
+                unknowns = hand.number_of_unknown_cards
+                if unknowns > 1 and ((players >> player) & 1 or suits & ~hand.voids):
+                    voids = hand.voids
                     possible = 0
-                    for suit, total in totals.items():
-                        if total < 4 and suit not in hand.known_voids:
+                    for suit, total in enumerate(totals):
+                        if total < 4 and not (voids >> suit) & 1:
                             possible += 4 - total
-                    if possible < hand.number_of_unknown_cards:
+                    if possible < unknowns:
                         return False    # not enough possible cards to fit
 
-                    unknowns = hand.number_of_unknown_cards
-                    for suit, total in totals.items():
-                        if total < 4 and suit not in hand.known_voids:
+                    for suit, total in enumerate(totals):
+                        if total < 4 and not (voids >> suit) & 1:
                             remaining = possible - (4 - total)
                             if remaining < unknowns:
                                 min_suit = unknowns - remaining
-                                if not hand.fill_some_unknowns(suit, min_suit):
+                                if not self._fill_some_unknowns(player, suit, min_suit):
                                     return False
                                 any_changes = True
 
-            # redo the totals if there were any changes
+            # redo the cheap rules if there were any changes
             if any_changes:
                 continue
 
@@ -503,21 +908,20 @@ class Cards:
             # there are four possible unknowns that could be ones, and two ones
             # whose position is unknown. Clearly two of these unknowns must be
             # ones, so player 2 must have one of them.
-            for suit, total in totals.items():
-                if total > 2:
+            for suit, total in enumerate(totals):
+                if total > 2 or not (suits >> suit) & 1:
                     continue
-                slots = 0
-                for hand in self.hands:
-                    if suit not in hand.known_voids:
-                        slots += hand.number_of_unknown_cards
-                for hand in self.hands:
-                    if suit not in hand.known_voids:
+                bit = 1 << suit
+                slots = self.open_slots(suit)
+                for player, hand in enumerate(hands):
+                    if not hand.voids & bit:
                         other_slots = slots - hand.number_of_unknown_cards
                         if other_slots < total:
-                            if not hand.fill_some_unknowns(suit, total - other_slots):
+                            if not self._fill_some_unknowns(player, suit, total - other_slots):
                                 return False
+                            any_changes = True
 
-            # redo the totals if there were any changes
+            # redo the cheap rules if there were any changes
             if any_changes:
                 continue
 
@@ -533,12 +937,14 @@ class Cards:
             #
             # This gives 00111?x123/?x01/02223?x23/33?x01, which from the rule above
             # can be further shaken down to 000111/?x01/022231/33?x01
+            #
+            # Groups are represented as bitmasks of the suits they contain.
             groups = {}
-            for player, hand in enumerate(self.hands):
-                group_len = len(hand.known_voids)
-                if hand.number_of_unknown_cards > 0 and group_len > 1:
-                    # Got a grouping of cards
-                    group = frozenset(all_suits.difference(hand.known_voids))
+            for player, hand in enumerate(hands):
+                voids = hand.voids
+                if hand.number_of_unknown_cards > 0 and voids & (voids - 1):
+                    # Got a grouping of cards (more than one void)
+                    group = all_suits & ~voids
                     if group in groups:
                         groups[group].append(player)
                     else:
@@ -546,20 +952,23 @@ class Cards:
             
             # If there are any groupings that are common to multiple hands,
             # check how many missing cards there are in the group and how many
-            # holes to put them in
-            for group, players in groups.items():
-                if len(players) > 1:
+            # holes to put them in. We only need to look at groups that
+            # include changed suits or hands.
+            for group, group_players in groups.items():
+                if len(group_players) > 1:
+                    if not group & suits and not any((players >> p) & 1 for p in group_players):
+                        continue
 
                     # How many missing cards are there in this group?
-                    missing = len(group) * 4
-                    for suit, total in totals.items():
-                        if suit in group:
-                            missing -= total
+                    missing = 0
+                    for suit, total in enumerate(totals):
+                        if (group >> suit) & 1:
+                            missing += 4 - total
                     
                     # How many holes to put them in, in the group players?
                     holes = 0
-                    for player in players:
-                        holes += self.hands[player].number_of_unknown_cards
+                    for player in group_players:
+                        holes += hands[player].number_of_unknown_cards
                     
                     # if there are too many holes for the missing cards, we
                     # know something has gone wrong
@@ -569,13 +978,50 @@ class Cards:
                     # if the missing cards fill all the holes, we know there are
                     # no cards in the group anywhere else
                     if missing == holes:
-                        for player, hand in enumerate(self.hands):
-                            if player not in players:
-                                for suit in group:
-                                    if hand.kill_unknown(suit):
+                        for player in range(len_hands):
+                            if player not in group_players:
+                                for suit in range(len_hands):
+                                    if (group >> suit) & 1 and self._kill_unknown(player, suit):
                                         any_changes = True
 
             # TODO there may be other logical moves to clarify what we know
+
+            # If nothing changed, there is nothing more to deduce from the
+            # suits and hands in the worklist
+            if not any_changes:
+                self._dirty_suits = 0
+                self._dirty_hands = 0
+        return True
+
+    def _kill_unknown(self, player: int, suit: int) -> bool:
+        """
+        Like Hand.kill_unknown, but keeping the per-suit tallies, the hash
+        and the worklist up to date. Ignores the undo journal.
+        """
+        hand = self._hands[player]
+        if not hand.kill_unknown(suit):
+            return False
+        self._slots -= hand.number_of_unknown_cards << (suit * SUIT_BITS)
+        self._add_to_keys(self._keys[player], 0, 1 << suit, 0)
+        self._dirty_suits |= 1 << suit
+        self._dirty_hands |= 1 << player
+        return True
+
+    def _fill_some_unknowns(self, player: int, suit: int, count: int) -> bool:
+        """
+        Like Hand.fill_some_unknowns, but keeping the per-suit tallies, the
+        hash and the worklist up to date. Ignores the undo journal.
+        """
+        hand = self._hands[player]
+        open_suits = (len(self._spread) - 1) & ~hand.voids
+        if not hand.fill_some_unknowns(suit, count):
+            return False
+        if count:
+            self._known += count << (suit * SUIT_BITS)
+            self._slots -= count * self._spread[open_suits]
+            self._add_to_keys(self._keys[player], count << (suit * SUIT_BITS), 0, -count)
+            self._dirty_suits |= open_suits | (1 << suit)
+            self._dirty_hands |= 1 << player
         return True
 
     def legal(self, other, suit, this, verbose: bool) -> bool:
@@ -616,14 +1062,12 @@ class Cards:
 
         # we can ask for any card that we own or possibly own
         this_hand = self.hands[this]
-        for i in permutation:
+        for i in _suit_list(permutation):
             if this_hand.is_legal(i):
                 suits.append(i)
 
         # find a count of each of the suits
-        totals = Counter()
-        for hand in self.hands:
-            hand.running_totals(totals)
+        totals = self.totals()
 
         # we can ask any other player for a card, but not ourselves
         n = len(self.hands)
@@ -642,7 +1086,7 @@ class Cards:
                 # if the other player may not have the card, should we ask?
                 elif not forced:
                     count = totals[suit]    # cards already known
-                    if suit not in this_hand.known_cards:
+                    if not this_hand.count(suit):
                         count += 1          # add one if we are creating one in our hand
                     if count >= 4:
                         continue            # no room to add another one in the hand we are asking 
@@ -661,7 +1105,8 @@ class Cards:
         permutation = range(self.number_of_players())
         return self.position_given_permutation(permutation, last_player)
     
-    def position_given_permutation(self, permutation: np.ndarray, last_player: int) -> int:
+    def position_given_permutation(self, permutation: np.ndarray, last_player: int,
+            player_symmetric: bool = False) -> int:
         """
         Returns a representation of the current set of hands, using the
         given permutation of suits to define the relative ordering.  The position function
@@ -671,6 +1116,10 @@ class Cards:
         * Rotation of players (e.g. player 0 -> 1, 1 -> 2 and 2 -> 0)
         * Permutation of suits (e.g. swapping any two suits)
 
+        Rotated positions are only the same if player_symmetric is set,
+        which says that all players make the same decisions. Otherwise we
+        encode the last player too.
+
         Note that position is always an integer greater or equal to zero.
         """
         # Handle rotation of players by always starting from the last
@@ -679,31 +1128,96 @@ class Cards:
         pos = 0
         n = len(self.hands)
         assert last_player < n
+        permutation = _suit_list(permutation)
         for i in range(n):
             hand = self.hands[(i + last_player) % n]
             pos = hand.position(pos, permutation)
 
         # now encode the player number, if we cannot make the assumption
         # that all players make the same decisions
-        pos *= n
-        pos += last_player
+        if not player_symmetric:
+            pos *= n
+            pos += last_player
         return pos
 
+    def zobrist(self) -> int:
+        """
+        Returns a fixed-width hash of the hands, which is updated
+        incrementally as the cards change. Unlike position, it does not
+        take account of any symmetries, and different cards may share
+        the same hash. Use exact_key to tell them apart.
+        """
+        return self._hash
+
+    def exact_key(self) -> int:
+        """
+        Returns an integer that uniquely identifies the hands, packing in
+        every field of every hand. Like zobrist, it is updated incrementally.
+        Unlike position, it does not take account of any symmetries, and it
+        is valid even if the cards are inconsistent.
+        """
+        return self._exact
+
+    def canonical(self, last_player: int, permutation: List[int] = None,
+            player_symmetric: bool = False) -> Tuple[List[int], int]:
+        """
+        Returns the permutation of suits for last_player, and the position
+        given that permutation and player_symmetric. Alternatively, pass in
+        the permutation to use.
+        If we have a position_cache, these are looked up by the hash of the
+        cards, so the cost does not depend on the number of suits or players.
+        """
+        cache = self.position_cache
+        if cache is None:
+            if permutation is None:
+                permutation = self.permutation(last_player)
+            return permutation, self.position_given_permutation(
+                permutation, last_player, player_symmetric)
+
+        # Pack any permutation we were given into the key, four bits per
+        # suit, then a bit to say whether there was one, then the player
+        # and whether we are player symmetric
+        n = len(self._hands)
+        key = self._hash
+        if permutation is not None:
+            for suit in _suit_list(permutation):
+                key = (key << 4) | suit
+            key = key << 1 | 1
+        else:
+            key <<= 1
+        key = (key * n + last_player) << 1 | player_symmetric
+        exact_key = self.exact_key()
+        entry = cache.get(key, exact_key)
+        if entry is not None:
+            return entry[1], entry[2]
+
+        # Not found, or a hash collision. Work it out and (re)cache it
+        if permutation is None:
+            permutation = self.permutation(last_player)
+        position = self.position_given_permutation(permutation, last_player, player_symmetric)
+        cache.put(key, (exact_key, permutation, position))
+        return permutation, position
+
     def permutation(self, last_player) -> List[int]:
         """
         Handle permutation of suits by ordering them according to how
         they appear in the hands: the most common suit in the first
-        hand, down to the last suit seen. Suits that are not seen at
-        all, or which have the same ordering in all hands, are ordered
-        arbitrarily.
+        hand, down to the last suit seen.
+
+        Ties are broken by the later hands in turn, and by voids, so two
+        suits only tie if their counts and voids are the same in every
+        hand. Swapping such suits leaves the hands unchanged, so the
+        position does not depend on how the tie is broken. This makes the
+        position an exact canonical form: all positions that are the same
+        up to a permutation of suits give the same position.
         """
         n = len(self.hands)
         assert last_player < n
-        ranking = np.zeros(n, dtype=int)   # will contain the rankings of each suit
+        ranking = [0] * n   # will contain the rankings of each suit
         for i in range(n):
             hand = self.hands[(i + last_player) % n]
             hand.adjust_ranking(ranking)
-        return np.flip(np.argsort(ranking))
+        return sorted(range(n), key=ranking.__getitem__, reverse=True)
 
     def has_card(self, suit, this, other) -> Tuple[bool, bool]:
         """
@@ -714,24 +1228,121 @@ class Cards:
         forced, has = self.hands[this].has_card(suit)
         if forced:
             return forced, has
-        
+
+        # then see whether we have already worked it out
+        cache = self.has_card_cache
+        if cache is not None:
+            n = len(self._hands)
+            key = ((self._shake_down_key() * n + suit) * n + this) * n + other
+            result = cache.get(key)
+            if result is not None:
+                return result
+        result = self._has_card(suit, this, other)
+        if cache is not None:
+            cache.put(key, result)
+        return result
+
+    def _has_card(self, suit, this, other) -> Tuple[bool, bool]:
+        """
+        Implementation of has_card, once we know the hand itself does not
+        force the answer.
+        """
         # It is possible that the choice may be forced even
         # it does not appear so from our individual hand. For
         # example, saying "no" means that none of our cards
         # are of the given suit, which means they must be of
-        # the other suits. Check that this does not lead to
-        # inconsistencies.
-        copied = deepcopy(self)
-        if not copied.no_transfer(suit, this, other, True) or not copied.shake_down():
+        # the other suits. Check from the tallies that this does
+        # not lead to inconsistencies.
+        if not self._answer_is_feasible(suit, this, other, False):
             return True, True   # forced because "no" results in inconsistency
-
-        copied = deepcopy(self)
-        if not copied.transfer(suit, this, other, True) or not copied.shake_down():
+        if not self._answer_is_feasible(suit, this, other, True):
             return True, False   # forced because "yes" results in inconsistency
-  
+
         # genuinely unforced
         return False, False
-    
+
+    def _answer_is_feasible(self, suit, this, other, has: bool) -> bool:
+        """
+        Checks from the tallies whether this player could give the answer
+        when other asks them for the suit, without changing the cards.
+
+        The answer is consistent if the unknown cards can still be dealt
+        so that every suit has four cards, with none in a hand that is void
+        in its suit. By Hall's theorem that is so if, for every set of
+        suits, the unknown cards that could be of those suits are enough to
+        make them up to four. The only sets that can fail are those that
+        some group of hands are all void in, so we only check those.
+        """
+        hands = self._hands
+        known = self._known
+        shift = suit * SUIT_BITS
+
+        # Asking means the other player has one of the suit, which may
+        # turn one of their unknowns into it
+        asker = hands[other]
+        asker_unknowns = asker.number_of_unknown_cards
+        if not (asker.counts >> shift) & SUIT_MASK:
+            if (asker.voids >> suit) & 1 or not asker_unknowns:
+                return False
+            asker_unknowns -= 1
+            known += 1 << shift
+
+        # Saying yes may turn one of our unknowns into the suit, and saying
+        # no makes us void in it
+        responder = hands[this]
+        responder_unknowns = responder.number_of_unknown_cards
+        responder_voids = responder.voids
+        if (responder.counts >> shift) & SUIT_MASK:
+            if not has:
+                return False
+        elif has:
+            if (responder_voids >> suit) & 1 or not responder_unknowns:
+                return False
+            responder_unknowns -= 1
+            known += 1 << shift
+        else:
+            responder_voids |= 1 << suit
+        if (known >> shift) & SUIT_MASK > 4:
+            return False
+
+        # the unknowns of each hand with voids, and of all the hands
+        available = 0
+        voided = []
+        for player, hand in enumerate(hands):
+            if player == other:
+                unknowns, voids = asker_unknowns, hand.voids
+            elif player == this:
+                unknowns, voids = responder_unknowns, responder_voids
+            else:
+                unknowns, voids = hand.number_of_unknown_cards, hand.voids
+            if unknowns:
+                available += unknowns
+                if voids:
+                    voided.append((voids, unknowns))
+
+        if not voided:
+            return True
+
+        # the suits that each group of voided hands are all void in
+        groups = set()
+        for voids, _ in voided:
+            groups |= {suits & voids for suits in groups}
+            groups.add(voids)
+        groups.discard(0)
+
+        missing = [4 - ((known >> (s * SUIT_BITS)) & SUIT_MASK) for s in range(len(hands))]
+        for suits in groups:
+            needed = 0
+            for s, count in enumerate(missing):
+                if (suits >> s) & 1:
+                    needed += count
+            for voids, unknowns in voided:
+                if voids & suits == suits:
+                    needed += unknowns
+            if needed > available:
+                return False
+        return True
+
     def next_player(self, this_player: int) -> int:
         """
         Finds the next player who is able to move (has any cards)
@@ -743,6 +1354,196 @@ class Cards:
             assert p != this_player, "At least one player must have some cards"
         return p            
 
+class BoundedCache:
+    """
+    Bounded map from integer keys to entries, which counts its hits,
+    misses and evictions. When the cache is full, the oldest entries
+    are evicted first.
+    """
+    def __init__(self, max_entries: int = 100000):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return (f"{type(self).__name__}(entries={len(self._entries)}/{self.max_entries} "
+            f"hits={self.hits} misses={self.misses} evictions={self.evictions} "
+            f"hit_rate={self.hit_rate():.3f})")
+
+    def hit_rate(self) -> float:
+        """
+        Returns the proportion of lookups that were found in the cache
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: int):
+        """
+        Returns the cached entry for this key, or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key: int, entry):
+        """
+        Adds an entry to the cache, evicting the oldest if it is full
+        """
+        entries = self._entries
+        if key not in entries and len(entries) >= self.max_entries:
+            del entries[next(iter(entries))]
+            self.evictions += 1
+        entries[key] = entry
+
+    def clear(self):
+        """
+        Empties the cache, but keeps the statistics
+        """
+        self._entries.clear()
+
+class ShakeDownCache(BoundedCache):
+    """
+    Cache of the results of Cards.shake_down. The same cards are reached
+    over and over again via different orders of moves, so rather than
+    repeating the inference we can look up its result. Maps the exact
+    state of the cards before shaking down to the state afterwards, plus
+    whether the cards were consistent.
+    """
+    pass
+
+class PositionCache(BoundedCache):
+    """
+    Cache of the symmetric positions returned by Cards.canonical. Working
+    out the permutation of suits and packing the hands into a position
+    costs far more than the incrementally updated hash of the cards, so we
+    look positions up by hash. Each entry also holds the exact key of
+    the cards, so that a collision is recalculated rather than trusted.
+    """
+    def __init__(self, max_entries: int = 100000):
+        super().__init__(max_entries)
+        self.collisions = 0
+
+    def get(self, key: int, exact_key: int):
+        """
+        Returns the cached entry for this hash, or None if there is none
+        or it is for different cards
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] != exact_key:
+            self.collisions += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+class HasCardCache(BoundedCache):
+    """
+    Cache of the results of Cards.has_card, where the hand itself does not
+    force the answer. Maps the exact state of the cards and the request to
+    whether the answer is forced, and if so what it is.
+    """
+    pass
+
+# Maximum value of a hash of the cards, as returned by Cards.zobrist
+ZOBRIST_MASK = (1 << 64) - 1
+
+_key_tables = {}
+
+def _key_table(number_of_players: int) -> List[Tuple[int, ...]]:
+    """
+    Returns the keys for each hand, which multiply its packed counts,
+    its voids and its count of unknown cards respectively, first to give
+    its contribution to the hash and then to the exact key.
+
+    The hash keys are random and odd, so no change to a single field can
+    leave the hash unchanged. Because the hash is a sum of products
+    rather than the usual exclusive-or of table entries, it can be updated
+    with a single multiply however many suits change in a hand. The
+    exact keys are powers of two, which place each field in its own bits.
+    """
+    table = _key_tables.get(number_of_players)
+    if table is None:
+        generator = Random(number_of_players)
+        voids_shift = number_of_players * SUIT_BITS
+        unknowns_shift = voids_shift + number_of_players
+        hand_bits = unknowns_shift + 3
+        table = []
+        for player in range(number_of_players):
+            place = player * hand_bits
+            table.append(tuple(generator.getrandbits(64) | 1 for _ in range(3))
+                + (1 << place, 1 << (place + voids_shift), 1 << (place + unknowns_shift)))
+        _key_tables[number_of_players] = table
+    return table
+
+_spread_tables = {}
+
+def _spread_table(number_of_suits: int) -> List[int]:
+    """
+    Returns a table that maps each bitmask of suits to the packed
+    counts (as in Hand.counts) holding one card of each of those suits.
+    """
+    table = _spread_tables.get(number_of_suits)
+    if table is None:
+        table = []
+        for mask in range(1 << number_of_suits):
+            packed = 0
+            for suit in range(number_of_suits):
+                if (mask >> suit) & 1:
+                    packed += 1 << (suit * SUIT_BITS)
+            table.append(packed)
+        _spread_tables[number_of_suits] = table
+    return table
+
+# Maps packed counts holding at most one card of each suit back to the
+# bitmask of those suits, i.e. the inverse of the spread tables
+_unspread = {}
+
+def _changed_suits(changed: int) -> int:
+    """
+    Given packed counts, as in Hand.counts, returns the bitmask of suits
+    whose counts are non-zero.
+    """
+    # fold every bit of each field down into the lowest bit of the field
+    assert SUIT_BITS == 6
+    changed |= changed >> 1
+    changed |= changed >> 2
+    changed |= changed >> 2
+    changed &= _LOWEST_BITS
+    mask = _unspread.get(changed)
+    if mask is None:
+        mask = 0
+        suit = 0
+        while changed >> (suit * SUIT_BITS):
+            if (changed >> (suit * SUIT_BITS)) & 1:
+                mask |= 1 << suit
+            suit += 1
+        _unspread[changed] = mask
+    return mask
+
+# The lowest bit of each suit field, for as many suits as we support
+_LOWEST_BITS = sum(1 << (suit * SUIT_BITS) for suit in range(16))
+
+def _suit_list(permutation) -> List[int]:
+    """
+    Converts a permutation of suits into a list of plain ints, so that
+    bit twiddling on the packed hands stays in arbitrary-precision ints
+    rather than fixed-width numpy ints.
+    """
+    if isinstance(permutation, np.ndarray):
+        return permutation.tolist()
+    return permutation
+
 def _not_legal(verbose, message) -> bool:
     if verbose:
         print(message)
@@ -1082,6 +1883,68 @@ def test_permutation():
     assert np.array_equal(p2, [2, 1, 0])
     print("test_permutation: succeeded")
 
+def test_canonical_permutation():
+    """
+    Takes the cards 01?/01?, which do not tell suits 0 and 1 apart at all,
+    0???x1/11??, where suits 0 and 1 used to get the same ranking, and
+    0012??/2??x3/1??x0/3?x12. Checks that permuting the suits in every
+    possible way gives the same position.
+    """
+    from itertools import permutations
+
+    def make_hands(hands, swap):
+        result = []
+        for counts, unknowns, voids in hands:
+            hand = Hand()
+            hand.known_cards = Counter({swap[suit]: count for suit, count in counts.items()})
+            hand.number_of_unknown_cards = unknowns
+            hand.known_voids = {swap[suit] for suit in voids}
+            result.append(hand)
+        return result
+
+    for hands in [
+            [({0: 1, 1: 1}, 1, set()), ({0: 1, 1: 1}, 1, set())],
+            [({0: 1}, 3, {1}), ({1: 2}, 2, set())],
+            [({0: 2, 1: 1, 2: 1}, 2, set()), ({2: 1}, 2, {3}),
+                ({1: 1}, 2, {0}), ({3: 1}, 1, {1, 2})]]:
+        n = len(hands)
+        for last_player in range(n):
+            positions = set()
+            for swap in permutations(range(n)):
+                cards = Cards(n)
+                cards.hands = make_hands(hands, swap)
+                positions.add(cards.canonical(last_player)[1])
+            assert len(positions) == 1
+    print("test_canonical_permutation: succeeded")
+
+def test_player_symmetric_position():
+    """
+    Takes the cards 0012??/2??x3/1??x0/3?x12 and rotates the hands, so each
+    player in turn has the first hand. If the players are symmetric, the
+    positions for the player with the first hand should all be the same,
+    both with and without a position cache. Otherwise they should differ.
+    """
+    hands = [({0: 2, 1: 1, 2: 1}, 2, set()), ({2: 1}, 2, {3}),
+        ({1: 1}, 2, {0}), ({3: 1}, 1, {1, 2})]
+    n = len(hands)
+    for cache in (None, PositionCache(100)):
+        symmetric = set()
+        asymmetric = set()
+        for rotation in range(n):
+            cards = Cards(n)
+            cards.position_cache = cache
+            new_hands = [Hand() for _ in range(n)]
+            for i, (counts, unknowns, voids) in enumerate(hands):
+                hand = new_hands[(i + rotation) % n]
+                hand.known_cards = Counter(counts)
+                hand.number_of_unknown_cards = unknowns
+                hand.known_voids = voids
+            cards.hands = new_hands
+            symmetric.add(cards.canonical(rotation, player_symmetric = True)[1])
+            asymmetric.add(cards.canonical(rotation)[1])
+        assert len(symmetric) == 1 and len(asymmetric) == n
+    print("test_player_symmetric_position: succeeded")
+
 def test_complex_shakedown():
     """
     We start with the hands 00111?x1/?x01/02223?/33?x01.
@@ -1114,6 +1977,348 @@ def test_complex_shakedown():
     assert cards.hands[0].number_of_unknown_cards == 0
     assert cards.hands[2].number_of_unknown_cards == 0
 
+def test_compact_hand():
+    """
+    The hand 0022?x13 is stored as packed counts and a void
+    bitmask. Check it round-trips, and that copies are independent.
+    """
+    h = Hand()
+    h.known_cards = Counter({0: 2, 2: 2})
+    h.number_of_unknown_cards = 1
+    h.known_voids = {1, 3}
+    assert h.count(0) == 2 and h.count(1) == 0 and h.count(2) == 2
+    assert h.is_void(1) and not h.is_void(0)
+    assert h.known_cards == {0: 2, 2: 2}
+    assert h.known_voids == {1, 3}
+    assert str(h) == "0022?x13"
+
+    c = h.copy()
+    c.remove(0)
+    c.ensure_have(2)
+    c.remove(2)
+    assert h.known_cards == {0: 2, 2: 2}
+    assert c.known_cards == {0: 1, 2: 1}
+
+    # asking for a suit turns the last unknown into a known card
+    assert not h.ensure_have(1)
+    assert h.ensure_have(0)
+    assert h.ensure_have(2)
+    h.number_of_unknown_cards = 1
+    h.known_voids = {1, 2, 3}
+    assert h.force_unknowns(4)
+    assert h.known_cards == {0: 3, 2: 2}
+    assert h.is_determined() and not h.known_voids
+    print("test_compact_hand: succeeded")
+
+def test_undo():
+    """
+    Make some moves on 00??/0???/???? with journalling, shaking down
+    after each, then check that undo restores the cards exactly.
+    """
+    h0 = Hand()
+    h0.known_cards = Counter({0: 2})
+    h0.number_of_unknown_cards = 2
+    h1 = Hand()
+    h1.known_cards = Counter({0: 1})
+    h1.number_of_unknown_cards = 3
+    h2 = Hand()
+    cards = Cards(3)
+    cards.hands = [h0, h1, h2]
+    before = str(cards)
+
+    outer = cards.mark()
+    cards.transfer(1, 2, 0, False)
+    cards.test_winner(0)
+    after_transfer = str(cards)
+
+    inner = cards.mark()
+    cards.no_transfer(2, 0, 1, False)
+    cards.test_winner(1)
+    assert str(cards) != after_transfer
+    cards.undo(inner)
+    assert str(cards) == after_transfer
+
+    cards.undo(outer)
+    assert str(cards) == before
+    assert cards._journal is None
+
+    # without a mark, nothing is recorded
+    cards.transfer(1, 2, 0, False)
+    assert cards._journal is None
+    print("test_undo: succeeded")
+
+def test_tallies():
+    """
+    Play some moves on 002?/0???/??? and check that the incrementally
+    maintained suit totals and open slots match a recount.
+    """
+    h0 = Hand()
+    h0.known_cards = Counter({0: 2, 2: 1})
+    h0.number_of_unknown_cards = 1
+    h1 = Hand()
+    h1.known_cards = Counter({0: 1})
+    h1.number_of_unknown_cards = 3
+    h2 = Hand()
+    h2.number_of_unknown_cards = 3
+    cards = Cards(3)
+    cards.hands = [h0, h1, h2]
+    assert cards.totals() == [3, 0, 1]
+    assert [cards.open_slots(suit) for suit in range(3)] == [7, 7, 7]
+
+    def check():
+        known, slots = cards._known, cards._slots
+        cards.recount()
+        assert (known, slots) == (cards._known, cards._slots), str(cards)
+
+    mark = cards.mark()
+    cards.no_transfer(1, 2, 1, False)
+    check()
+    cards.test_winner(1)
+    check()
+    cards.transfer(0, 1, 0, False)
+    check()
+    cards.test_winner(0)
+    check()
+    cards.undo(mark)
+    check()
+    assert cards.totals() == [3, 0, 1]
+    print("test_tallies: succeeded")
+
+def test_worklist_shakedown():
+    """
+    Starting from 2???/0???x2/????x0, make some moves, shaking down
+    after each only what changed. Check we get the same answer as a
+    shake down from scratch, and that nothing is left in the worklist.
+    """
+    h0 = Hand()
+    h0.known_cards = Counter({2: 1})
+    h0.number_of_unknown_cards = 3
+    h1 = Hand()
+    h1.known_cards = Counter({0: 1})
+    h1.number_of_unknown_cards = 3
+    h1.known_voids = {2}
+    h2 = Hand()
+    h2.number_of_unknown_cards = 4
+    h2.known_voids = {0}
+    cards = Cards(3)
+    cards.hands = [h0, h1, h2]
+
+    for suit, other, this, has in [(1, 2, 0, True), (0, 2, 1, False), (2, 1, 0, False)]:
+        if has:
+            cards.transfer(suit, other, this, False)
+        else:
+            cards.no_transfer(suit, other, this, False)
+        from_scratch = cards.copy()
+        from_scratch.recount()
+        assert cards.shake_down()
+        assert from_scratch.shake_down()
+        assert str(cards) == str(from_scratch)
+        assert cards._dirty_suits == 0 and cards._dirty_hands == 0
+    print("test_worklist_shakedown: succeeded")
+
+def test_deduction_dirties_only_what_it_touches():
+    """
+    Deductions made while shaking down should only add the suit and hand
+    they touched to the worklist, and a deduction-heavy shake down should
+    leave the worklist empty.
+    """
+    cards = Cards(4)
+    for hand in cards.hands:
+        hand.number_of_unknown_cards = 4
+    cards.recount()
+    assert cards.shake_down()
+    assert cards._dirty_suits == 0 and cards._dirty_hands == 0
+
+    assert cards._kill_unknown(1, 2)
+    assert cards._dirty_suits == 1 << 2 and cards._dirty_hands == 1 << 1
+    cards._dirty_suits = cards._dirty_hands = 0
+    assert cards._fill_some_unknowns(3, 0, 1)
+    assert cards._dirty_hands == 1 << 3
+    assert cards._dirty_suits == 0b1111     # open slots of every suit changed
+
+    # 00111?x1/?x01/02223?/33?x01 shakes down to 000111/?x01/022231/33?x01
+    # only via a long chain of deductions
+    h0 = Hand()
+    h0.known_cards = Counter({0: 2, 1: 3})
+    h0.number_of_unknown_cards = 1
+    h0.known_voids = {1}
+    h1 = Hand()
+    h1.number_of_unknown_cards = 1
+    h1.known_voids = {0, 1}
+    h2 = Hand()
+    h2.known_cards = Counter({0: 1, 2: 3, 3: 1})
+    h2.number_of_unknown_cards = 1
+    h3 = Hand()
+    h3.known_cards = Counter({3: 2})
+    h3.number_of_unknown_cards = 1
+    h3.known_voids = {0, 1}
+    cards = Cards(4)
+    cards.hands = [h0, h1, h2, h3]
+    assert cards.shake_down()
+    assert str(cards) == "000111x1/?x01/012223/33?x01"
+    assert cards._dirty_suits == 0 and cards._dirty_hands == 0
+    print("test_deduction_dirties_only_what_it_touches: succeeded")
+
+def test_shake_down_cache():
+    """
+    Shake down the same moves twice, once filling a ShakeDownCache and
+    once reading from it. Check the results match an uncached shake down,
+    including under the undo journal, and that the cache stays bounded.
+    """
+    h0 = Hand()
+    h0.known_cards = Counter({2: 1})
+    h0.number_of_unknown_cards = 3
+    h1 = Hand()
+    h1.known_cards = Counter({0: 1})
+    h1.number_of_unknown_cards = 3
+    h1.known_voids = {2}
+    h2 = Hand()
+    h2.number_of_unknown_cards = 4
+    h2.known_voids = {0}
+    start = Cards(3)
+    start.hands = [h0, h1, h2]
+    moves = [(1, 2, 0, True), (0, 2, 1, False), (2, 1, 0, False)]
+
+    cache = ShakeDownCache(2)
+    for _ in range(2):
+        cards = start.copy()
+        uncached = start.copy()
+        cards.shake_down_cache = cache
+        mark = cards.mark()
+        assert cards.shake_down() == uncached.shake_down()
+        for suit, other, this, has in moves:
+            for c in (cards, uncached):
+                if has:
+                    c.transfer(suit, other, this, False)
+                else:
+                    c.no_transfer(suit, other, this, False)
+            assert cards.shake_down() == uncached.shake_down()
+            assert str(cards) == str(uncached)
+            assert cards.totals() == uncached.totals()
+        cards.undo(mark)
+        assert str(cards) == str(start)
+
+    assert cache.hits == 2 and cache.misses == 2 and cache.evictions == 0
+
+    # the cache is full, so adding anything evicts the oldest entry
+    cache.put(-1, None)
+    assert len(cache) == 2 and cache.evictions == 1
+    print(f"test_shake_down_cache: succeeded {cache}")
+
+def test_zobrist():
+    """
+    Make some moves in a four player game, checking that the incrementally
+    updated hash and exact key match those calculated from scratch, both
+    as we go and as we undo the moves. Also check that canonical gives
+    the same answers from its cache as without it.
+    """
+    cards = Cards(4)
+    cache = PositionCache(100)
+    start = (cards.zobrist(), cards.exact_key())
+
+    def check():
+        from_scratch = cards.copy()
+        from_scratch.recount()
+        assert cards.zobrist() == from_scratch.zobrist()
+        assert cards.exact_key() == from_scratch.exact_key()
+        for player in range(4):
+            cards.position_cache = None
+            permutation, position = cards.canonical(player)
+            cards.position_cache = cache
+            for _ in range(2):
+                cached_permutation, cached_position = cards.canonical(player)
+                assert list(cached_permutation) == list(permutation)
+                assert cached_position == position
+
+    mark = cards.mark()
+    for suit, other, this, has in [(0, 1, 0, True), (1, 2, 1, False), (2, 3, 2, True),
+            (3, 0, 3, False), (1, 3, 0, True)]:
+        if has:
+            cards.transfer(suit, other, this, False)
+        else:
+            cards.no_transfer(suit, other, this, False)
+        assert cards.shake_down()
+        check()
+    assert (cards.zobrist(), cards.exact_key()) != start
+    cards.undo(mark)
+    assert (cards.zobrist(), cards.exact_key()) == start
+    assert cache.hits > 0 and cache.collisions == 0
+    print(f"test_zobrist: succeeded {cache}")
+
+def test_has_card_feasibility():
+    """
+    With 000?x0/111?x0/????, player 2 cannot say no to suit 0 as there is
+    nowhere else for the last 0 to go, and with 000?/111?/22??, player 2
+    cannot say yes to suit 0 when player 1 asks for one as there would be
+    five. Check that the tallies alone tell us so, and that the answers
+    match trying them in place, with and without a HasCardCache. Then
+    check that the tallies agree with trying each answer in place over
+    random games.
+    """
+    def try_answer(cards, suit, this, other, has):
+        mark = cards.mark()
+        if has:
+            consistent = cards.transfer(suit, this, other, True) and cards.shake_down()
+        else:
+            consistent = cards.no_transfer(suit, this, other, True) and cards.shake_down()
+        cards.undo(mark)
+        return consistent
+
+    def make_cards(hands):
+        cards = Cards(3)
+        result = []
+        for known, unknowns in hands:
+            hand = Hand()
+            hand.known_cards = Counter(known)
+            hand.number_of_unknown_cards = unknowns
+            result.append(hand)
+        cards.hands = result
+        return cards
+
+    cards = make_cards([({0: 3}, 1), ({1: 3}, 1), ({}, 4)])
+    cards.hands[0].known_voids = {0}
+    cards.hands[1].known_voids = {0}
+    cards.recount()
+    assert not cards._answer_is_feasible(0, 2, 0, False)
+    assert cards.has_card(0, 2, 0) == (True, True)
+
+    cards = make_cards([({0: 3}, 1), ({1: 3}, 1), ({2: 2}, 2)])
+    assert not cards._answer_is_feasible(0, 2, 1, True)
+    cache = HasCardCache(10)
+    for _ in range(2):
+        cards.has_card_cache = None
+        uncached = cards.has_card(0, 2, 1)
+        cards.has_card_cache = cache
+        assert cards.has_card(0, 2, 1) == uncached
+    assert cache.hits == 1 and cache.misses == 1
+
+    random = Random(1)
+    answers = 0
+    for number_of_players in (3, 4, 5):
+        for _ in range(20):
+            cards = Cards(number_of_players)
+            this = 0
+            for _ in range(100):
+                other, suit = random.choice(cards.legal_moves(this))
+                consistent = []
+                for has in (False, True):
+                    tried = try_answer(cards, suit, other, this, has)
+                    assert cards._answer_is_feasible(suit, other, this, has) == tried, \
+                        f"test_has_card_feasibility: {cards} {other} asked {this} for {suit}"
+                    if tried:
+                        consistent.append(has)
+                    answers += 1
+                if not consistent:
+                    break
+                if random.choice(consistent):
+                    cards.transfer(suit, other, this, False)
+                else:
+                    cards.no_transfer(suit, other, this, False)
+                if cards.test_winner(this) != Cards.NO_WINNER:
+                    break
+                this = cards.next_player(this)
+    print(f"test_has_card_feasibility: succeeded {uncached}, {answers} random answers")
+
 if __name__ == "__main__":
     test_simple_shakedown()
     test_no_transfer()
@@ -1122,10 +2327,19 @@ if __name__ == "__main__":
     test_shake_down()
     test_has_card()
     test_permutation()
+    test_canonical_permutation()
+    test_player_symmetric_position()
     test_three_player_shakedown()
     test_three_player_shakedown_2()
     test_four_player_shakedown()
     test_four_player_test_winner()
     test_four_player_exclusions()
     test_complex_shakedown()
-    
\ No newline at end of file
+    test_compact_hand()
+    test_undo()
+    test_tallies()
+    test_worklist_shakedown()
+    test_shake_down_cache()
+    test_zobrist()
+    test_has_card_feasibility()
+    test_deduction_dirties_only_what_it_touches()
@@ -1,43 +1,201 @@
 from cards import Cards
 from random import seed
 
-def play(players) -> int:
+class EventSink:
+    """
+    Listens to the events of a game as it is played. This one ignores
+    them all, so nothing is formatted or written.
+    """
+    def hands(self, cards: Cards, next_player: int):
+        """
+        The hands, before the next player makes their request
+        """
+        pass
+
+    def skip(self, player: int):
+        """
+        The player must skip, as they have no cards
+        """
+        pass
+
+    def request(self, player: int, other: int, suit: int):
+        """
+        The player asks the other player for a card of the suit
+        """
+        pass
+
+    def reply(self, player: int, other: int, suit: int, has: bool):
+        """
+        The other player answers, handing over the card if has is set
+        """
+        pass
+
+    def expect(self, player: int, result: int):
+        """
+        A player who looks ahead, about to make a request, expects it to
+        lead to the result: the winner, or -1 for a draw
+        """
+        pass
+
+    def end(self, cards: Cards, result: int):
+        """
+        The game is over. The result is the winner, -1 for a draw, or
+        Cards.ILLEGAL_CARDS if the cards became illegal.
+        """
+        pass
+
+class ConsoleSink(EventSink):
+    """
+    Writes the events of a game to stdout, showing the hands before each
+    request, and at the end
+    """
+    def hands(self, cards: Cards, next_player: int):
+        cards.show(next_player)
+
+    def skip(self, player: int):
+        print(f"Player {player} must skip as they have no cards")
+
+    def request(self, player: int, other: int, suit: int):
+        print(f"Player {player} requests suit {suit} from player {other}")
+
+    def reply(self, player: int, other: int, suit: int, has: bool):
+        if has:
+            print(f"Player {other} hands card {suit} to player {player}")
+        else:
+            print(f"Player {other} has no cards of suit {suit}")
+
+    def expect(self, player: int, result: int):
+        print(f"Result={result}")
+
+    def end(self, cards: Cards, result: int):
+        cards.show(-1)
+
+class BufferedLog(EventSink):
+    """
+    Records the events of a game in memory, as tuples of the event name
+    and its arguments, such as ("request", player, other, suit). The hands
+    are only recorded if asked for, as a copy of the cards.
+    """
+    def __init__(self, hands: bool = False):
+        self.events = []
+        self.record_hands = hands
+
+    def hands(self, cards: Cards, next_player: int):
+        if self.record_hands:
+            self.events.append(("hands", cards.copy(), next_player))
+
+    def skip(self, player: int):
+        self.events.append(("skip", player))
+
+    def request(self, player: int, other: int, suit: int):
+        self.events.append(("request", player, other, suit))
+
+    def reply(self, player: int, other: int, suit: int, has: bool):
+        self.events.append(("reply", player, other, suit, has))
+
+    def expect(self, player: int, result: int):
+        self.events.append(("expect", player, result))
+
+    def end(self, cards: Cards, result: int):
+        self.events.append(("end", result))
+
+    def moves(self):
+        """
+        Returns the requests and replies, as (player, other, suit, has)
+        """
+        return [event[1:] for event in self.events if event[0] == "reply"]
+
+def play(players, sink: EventSink = None) -> int:
     """
     Plays the game with the given list of players until one
     player wins or there is a draw. If a player wins, the
     function returns the number of the player (0 to one less
     than the number of players). If there is a draw, the function
     returns -1.
+
+    The events of the game are sent to the sink. By default they are
+    ignored; pass a ConsoleSink to see them.
     """
+    if sink is None:
+        sink = EventSink()
     number_of_players = len(players)
     cards = Cards(number_of_players)
     history = set()
     while True:
         for i, p in enumerate(players):
-            cards.show(i)
+            sink.hands(cards, i)
             if cards.is_empty(i):
-                print(f"Player {i} must skip as they have no cards")
+                sink.skip(i)
                 continue
 
             other, suit = p.next_move(i, cards, history)
-            print(f"Player {i} requests suit {suit} from player {other}")
-            if players[other].has_card(other, i, suit, cards, history):
-                print(f"Player {other} hands card {suit} to player {i}")
+            sink.request(i, other, suit)
+            has = players[other].has_card(other, i, suit, cards, history)
+            sink.reply(i, other, suit, has)
+            if has:
                 cards.transfer(suit, other, i, False)
             else:
-                print(f"Player {other} has no cards of suit {suit}")
                 cards.no_transfer(suit, other, i, False)
             winner = cards.test_winner(i)
             if winner == Cards.ILLEGAL_CARDS:
-                cards.show(-1)
+                sink.end(cards, winner)
                 raise Exception("The cards are in an illegal state. All players lose")
             if winner != Cards.NO_WINNER:
-                cards.show(-1)
+                sink.end(cards, winner)
                 return winner
 
             # if a position repeats, it forces a draw
             position = cards.position(i)
             if position in history:
-                cards.show(-1)
+                sink.end(cards, -1)
                 return -1
             history.add(position)
+
+def test_event_sinks():
+    """
+    Play the same random game with each sink. The buffered log should
+    record the same requests and replies the console shows, and the
+    default sink should write nothing at all.
+    """
+    import io
+    import contextlib
+    from player import RandomPlayer
+
+    def quietly(sink):
+        seed(1)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = play([RandomPlayer(), RandomPlayer(), RandomPlayer()], sink)
+        return result, output.getvalue()
+
+    result, output = quietly(None)
+    assert output == "", "test_event_sinks: the default sink should be silent"
+    log = BufferedLog(hands = True)
+    assert quietly(log) == (result, "")
+    console_result, console = quietly(ConsoleSink())
+    assert console_result == result
+
+    # the console shows each hand, then the request and reply of each move
+    moves = [line for line in console.splitlines() if line.startswith("Player") and "skip" not in line]
+    assert len(moves) == 2 * len(log.moves())
+    for (player, other, suit, has), line in zip(log.moves(), moves[1::2]):
+        if has:
+            assert line == f"Player {other} hands card {suit} to player {player}"
+        else:
+            assert line == f"Player {other} has no cards of suit {suit}"
+    assert log.events[-1] == ("end", result)
+
+    # a clever player tells the console what it expects before each request
+    from player import CleverPlayer
+    sink = ConsoleSink()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        clever = CleverPlayer(1000, 1000, sink = sink)
+        assert play([clever, clever], sink) == -1
+    lines = output.getvalue().splitlines()
+    requests = [i for i, line in enumerate(lines) if " requests suit " in line]
+    assert requests and all(lines[i - 1] == "Result=-1" for i in requests)
+    print(f"test_event_sinks: succeeded, {len(log.moves())} moves, result={result}")
+
+if __name__ == "__main__":
+    test_event_sinks()
@@ -1,9 +1,11 @@
 from player import Player, HumanPlayer, RandomPlayer, CleverPlayer
-from game import play
+from game import play, ConsoleSink
 
 if __name__ == "__main__":
-    players = [HumanPlayer(), CleverPlayer()]
-    result = play(players)
+    # give the computer ten seconds to think about each decision
+    sink = ConsoleSink()
+    players = [HumanPlayer(), CleverPlayer(time_budget = 10.0, symmetric = True, sink = sink)]
+    result = play(players, sink)
     if result >= 0:
         print(f"Winner was player {result}")
     else:
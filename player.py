@@ -1,12 +1,18 @@
 from abc import ABC
 from typing import List, Tuple, Set
-from random import randrange
-from collections import Counter
+from random import randrange, Random
+from collections import Counter, OrderedDict
 from copy import deepcopy
-from cards import Cards, Hand
-from game import play
+from cards import Cards, Hand, BoundedCache, ShakeDownCache, PositionCache, HasCardCache
+from game import play, EventSink, BufferedLog
 from time import perf_counter
-import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import math
+import sys
+import os
+import json
+import mmap
+import struct
 
 class Player(ABC):
     """
@@ -67,10 +73,15 @@ class RandomPlayer(Player):
     """
     Implementation of Player that randomly selects a legal move.
     """
-    def __init__(self):
-        pass
+    def __init__(self, seed = None):
+        """
+        If seed is specified, the player's choices are repeatable whatever
+        else uses the random module. Otherwise they come from that module.
+        """
+        self.randrange = randrange if seed is None else Random(seed).randrange
 
     def next_move(self, this: int, cards: Cards, history: Set[int]) -> Tuple[int, int]:
+        randrange = self.randrange
         number_of_players = cards.number_of_players()
         while True:
             other = randrange(number_of_players - 1)
@@ -85,7 +96,7 @@ class RandomPlayer(Player):
         if forced:
             return has
         
-        return randrange(2) == 1
+        return self.randrange(2) == 1
 
 class TestPlayer(Player):
     """
@@ -102,12 +113,493 @@ class TestPlayer(Player):
     def has_card(self, this: int, other: int, suit: int, cards: Cards, history: Set[int]) -> bool:
         return self.responses.pop(0)
 
+class TranspositionTable:
+    """
+    Table of positions and the best moves from them, as found by
+    CleverPlayer._evaluate_move. Moves are stored relative to the
+    position, as a tuple of (other, suit, result).
+
+    The table may be bounded by a number of entries or an approximate
+    number of bytes, in which case the policy says what to throw away
+    when it is full:
+
+    * LRU evicts the least recently used position.
+    * DEPTH hashes each position to a single slot, and only replaces
+      what is there with a position searched at least as deeply.
+    * TWO_TIER hashes each position to a pair of slots. One holds the
+      deepest position seen, the other the most recent.
+
+    Depths are the remaining search depth when the position was
+    evaluated, so deeper positions represent more work saved.
+    """
+    LRU = "lru"
+    DEPTH = "depth"
+    TWO_TIER = "two-tier"
+
+    # Rough cost in bytes of each entry, including its share of the table
+    ENTRY_BYTES = (sys.getsizeof(1 << 64) + sys.getsizeof((0, 0, 0))
+        + sys.getsizeof((0, 0, 0, 0)) + 32)
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None, policy: str = LRU):
+        """
+        If neither max_entries nor max_bytes is given, the table grows
+        without limit.
+        """
+        assert policy in (TranspositionTable.LRU, TranspositionTable.DEPTH,
+            TranspositionTable.TWO_TIER), f"unknown policy {policy}"
+        if max_bytes is not None:
+            by_bytes = max(1, max_bytes // TranspositionTable.ENTRY_BYTES)
+            max_entries = by_bytes if max_entries is None else min(max_entries, by_bytes)
+        self.max_entries = max_entries
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if max_entries is None:
+            self._entries = {}
+        elif policy == TranspositionTable.LRU:
+            self._entries = OrderedDict()
+        else:
+            # slots of (pos, move, depth), or None. Two tier tables have
+            # pairs of slots, the deeper first.
+            self._slots = [None] * max_entries
+            self._number_of_slots = (max_entries // 2 if policy == TranspositionTable.TWO_TIER
+                else max_entries)
+            assert self._number_of_slots > 0, "two tier tables need at least two entries"
+            self._entries = None
+
+    def __len__(self):
+        if self._entries is not None:
+            return len(self._entries)
+        return sum(1 for slot in self._slots if slot is not None)
+
+    def __contains__(self, pos: int) -> bool:
+        """
+        Returns whether the position is in the table, without counting
+        as a hit or miss, or as a use of the position
+        """
+        if self._entries is not None:
+            return pos in self._entries
+        index = pos % self._number_of_slots
+        if self.policy == TranspositionTable.TWO_TIER:
+            index *= 2
+            slot = self._slots[index + 1]
+            if slot is not None and slot[0] == pos:
+                return True
+        slot = self._slots[index]
+        return slot is not None and slot[0] == pos
+
+    def __str__(self):
+        return (f"TranspositionTable(policy={self.policy} entries={len(self)}/{self.max_entries} "
+            f"hits={self.hits} misses={self.misses} evictions={self.evictions})")
+
+    def get(self, pos: int) -> Tuple[int, int, int]:
+        """
+        Returns the move stored for this position, or None
+        """
+        entries = self._entries
+        if entries is not None:
+            move = entries.get(pos)
+            if move is not None and self.max_entries is not None:
+                entries.move_to_end(pos)
+        else:
+            move = None
+            index = pos % self._number_of_slots
+            if self.policy == TranspositionTable.TWO_TIER:
+                index *= 2
+                slot = self._slots[index + 1]
+                if slot is not None and slot[0] == pos:
+                    move = slot[1]
+            slot = self._slots[index]
+            if slot is not None and slot[0] == pos:
+                move = slot[1]
+        if move is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return move
+
+    def put(self, pos: int, move: Tuple[int, int, int], depth: int):
+        """
+        Stores the move for this position, which was evaluated with the
+        given remaining depth, evicting something if the table is full.
+        """
+        entries = self._entries
+        if entries is not None:
+            entries[pos] = move
+            if self.max_entries is not None:
+                entries.move_to_end(pos)
+                if len(entries) > self.max_entries:
+                    entries.popitem(last = False)
+                    self.evictions += 1
+            return
+
+        entry = (pos, move, depth)
+        slots = self._slots
+        index = pos % self._number_of_slots
+        if self.policy == TranspositionTable.DEPTH:
+            slot = slots[index]
+            if slot is None or slot[0] == pos:
+                slots[index] = entry
+            elif slot[2] <= depth:
+                slots[index] = entry
+                self.evictions += 1
+            else:
+                self.evictions += 1     # the new entry is not worth keeping
+            return
+
+        # Two tier. If this is at least as deep as the deeper slot, it
+        # replaces it, and what was there moves to the recent slot.
+        index *= 2
+        deep, recent = slots[index], slots[index + 1]
+        if deep is None or deep[0] == pos or deep[2] <= depth:
+            if deep is not None and deep[0] != pos:
+                if recent is not None and recent[0] != pos:
+                    self.evictions += 1
+                slots[index + 1] = deep
+            elif recent is not None and recent[0] == pos:
+                slots[index + 1] = None
+            slots[index] = entry
+        else:
+            if recent is not None and recent[0] != pos:
+                self.evictions += 1
+            slots[index + 1] = entry
+
+    def items(self):
+        """
+        Returns the positions in the table and their moves
+        """
+        if self._entries is not None:
+            return list(self._entries.items())
+        return [(slot[0], slot[1]) for slot in self._slots if slot is not None]
+
+class SolvedTable:
+    """
+    Read-only table of solved positions and their best moves, as saved
+    from a TranspositionTable. The file is memory mapped rather than read,
+    so opening it is almost free however large it is, and many processes
+    can share it.
+
+    The file starts with a header, giving the number of players, the
+    width of each key, whether the positions are player symmetric, the
+    max_depth and max_has_depth of the search (NO_LIMIT if it was exact),
+    the preferences of the players (as JSON) and the number of records.
+    Then come the records, sorted by position. Each holds the position as
+    a fixed-width big-endian key followed by the move, as three signed
+    bytes (other, suit, result).
+    """
+    MAGIC = b"SOLVED03"
+    HEADER = struct.Struct("<8sIIIIIIQ")
+    MOVE = struct.Struct("bbb")
+    NO_LIMIT = 0xFFFFFFFF
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self.number_of_players, self._key_bytes, symmetric, max_depth, max_has_depth, \
+            preferences_bytes, self._count = SolvedTable.HEADER.unpack_from(self._map, 0)
+        if magic != SolvedTable.MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a solved position table")
+        self.symmetric = bool(symmetric)
+
+        # the limits of the search that solved the positions, or None if
+        # it was exact
+        self.max_depth = None if max_depth == SolvedTable.NO_LIMIT else max_depth
+        self.max_has_depth = None if max_has_depth == SolvedTable.NO_LIMIT else max_has_depth
+        start = SolvedTable.HEADER.size
+        self.preferences = json.loads(self._map[start:start + preferences_bytes])
+        self._records = start + preferences_bytes
+        self._record_bytes = self._key_bytes + SolvedTable.MOVE.size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def save(path: str, table: TranspositionTable, number_of_players: int, preferences = None,
+            symmetric: bool = False, max_depth: int = None, max_has_depth: int = None):
+        """
+        Writes the contents of a transposition table to a file, which
+        can then be opened as a SolvedTable. The positions must all be
+        for the given number of players, preferences and symmetry. If the
+        moves were found by a search with a limited max_depth and
+        max_has_depth, as CleverPlayer's are, pass them in too. Leave them
+        out only if the moves are exact, as a RetrogradeSolver's are.
+        """
+        items = sorted(table.items())
+        key_bytes = max(1, (max((pos.bit_length() for pos, _ in items), default = 0) + 7) // 8)
+        preferences_json = json.dumps(preferences).encode()
+
+        # write to a temporary file, so nobody ever maps half a table
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(SolvedTable.HEADER.pack(SolvedTable.MAGIC, number_of_players,
+                key_bytes, symmetric,
+                SolvedTable.NO_LIMIT if max_depth is None else max_depth,
+                SolvedTable.NO_LIMIT if max_has_depth is None else max_has_depth,
+                len(preferences_json), len(items)))
+            f.write(preferences_json)
+            for pos, move in items:
+                f.write(pos.to_bytes(key_bytes, "big"))
+                f.write(SolvedTable.MOVE.pack(*move))
+        os.replace(temp_path, path)
+
+    def __len__(self):
+        return self._count
+
+    def __str__(self):
+        return (f"SolvedTable(players={self.number_of_players} entries={self._count} "
+            f"hits={self.hits} misses={self.misses})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+
+    def get(self, pos: int) -> Tuple[int, int, int]:
+        """
+        Returns the move stored for this position, or None. Binary
+        searches the sorted records, comparing keys as bytes.
+        """
+        key_bytes = self._key_bytes
+        if pos.bit_length() > key_bytes * 8:
+            self.misses += 1
+            return None
+        key = pos.to_bytes(key_bytes, "big")
+        data = self._map
+        record_bytes = self._record_bytes
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self._records + mid * record_bytes
+            found = data[offset:offset + key_bytes]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                self.hits += 1
+                return SolvedTable.MOVE.unpack_from(data, offset + key_bytes)
+        self.misses += 1
+        return None
+
+class _OutOfBudget(Exception):
+    """
+    Raised when CleverPlayer runs out of time or nodes in the middle
+    of a search
+    """
+    pass
+
+class MoveOrdering:
+    """
+    Orders the moves that CleverPlayer tries, so that the moves most
+    likely to win, and so end the search early, come first. Moves are
+    described relative to the player and the permutation of suits, as in
+    the transposition table, so they carry over between symmetric
+    positions. Moves are tried in the order:
+
+    * The hint for this position. Hints are the best moves found for
+      positions whose results could not be cached, for example because
+      the search was pruned or the result depended on the history.
+    * The killers for this depth, which are the last two moves that won
+      at that depth.
+    * All the other moves, most often winning first, according to the
+      history table.
+
+    Each of these can be switched off, to measure its effect.
+    """
+    def __init__(self, hints: bool = True, killers: bool = False, history: bool = True,
+            max_hints: int = 100000):
+        """
+        Killers are off by default, as in our games they are as likely
+        to delay a win as to find one.
+        """
+        self.hints = BoundedCache(max_hints) if hints else None
+        self.killers = {} if killers else None
+        self.history = Counter() if history else None
+
+    def __str__(self):
+        return (f"MoveOrdering(hints={self.hints} killers={self.killers is not None} "
+            f"history={self.history is not None})")
+
+    def order(self, this: int, moves: List[Tuple[int, int]], depth: int,
+            permutation: List[int], pos: int) -> List[Tuple[int, int]]:
+        """
+        Returns the legal moves (other, suit) in the order to try them
+        """
+        n = len(permutation)
+        relative = [((other - this) % n, permutation.index(suit)) for other, suit in moves]
+        hint = self.hints.get(pos) if self.hints is not None else None
+        killers = self.killers.get(depth, ()) if self.killers is not None else ()
+        history = self.history
+        ranks = []
+        for i, move in enumerate(relative):
+            if move == hint:
+                rank = (0, 0)
+            elif move in killers:
+                rank = (1, killers.index(move))
+            elif history is not None:
+                rank = (2, -history[move])
+            else:
+                rank = (2, 0)
+            ranks.append((rank, i))
+        ranks.sort()
+        return [moves[i] for _, i in ranks]
+
+    def record_win(self, this: int, move: Tuple[int, int], depth: int, permutation: List[int]):
+        """
+        Records that the move (other, suit) won, or was good enough
+        to end the search, at the given depth
+        """
+        other, suit = move
+        move = ((other - this) % len(permutation), permutation.index(suit))
+        if self.killers is not None:
+            killers = self.killers.get(depth, ())
+            if move not in killers:
+                self.killers[depth] = (move,) + killers[:1]
+        if self.history is not None:
+            self.history[move] += 1
+
+    def record_hint(self, pos: int, this: int, move: Tuple[int, int], permutation: List[int]):
+        """
+        Records the best move found for a position whose result
+        was not cached
+        """
+        if self.hints is not None:
+            other, suit = move
+            self.hints.put(pos, ((other - this) % len(permutation), permutation.index(suit)))
+
+class _RecordingTable(TranspositionTable):
+    """
+    TranspositionTable that also lists the moves put into it, so that a
+    worker process can send back what it found
+    """
+    def __init__(self, max_entries: int = None, policy: str = TranspositionTable.LRU):
+        super().__init__(max_entries, policy = policy)
+        self.added = []
+
+    def put(self, pos: int, move: Tuple[int, int, int], depth: int):
+        self.added.append((pos, move))
+        super().put(pos, move, depth)
+
+# The player that searches in each worker process of a parallel search,
+# the move ordering each of its searches starts from, and the last round
+# of moves it was sent
+_worker_player = None
+_worker_move_ordering = None
+_worker_round = None
+
+def _start_worker(settings):
+    """
+    Sets up a worker process to search like the CleverPlayer that is
+    searching in parallel. The worker keeps its player, and so its
+    transposition table and caches, for as long as the pool lasts.
+    """
+    global _worker_player, _worker_move_ordering, _worker_round
+    (max_depth, max_has_depth, preferences, pruning, move_ordering, symmetric,
+        max_entries, policy) = settings
+    _worker_player = CleverPlayer(max_depth, max_has_depth, preferences,
+        transposition_table = _RecordingTable(max_entries, policy), pruning = pruning,
+        symmetric = symmetric)
+    _worker_move_ordering = move_ordering
+    _worker_round = None
+
+def _search_move(round_number: int, solved: List[Tuple[int, Tuple[int, int, int]]], cards: Cards,
+        history: Set[int], this: int, other: int, suit: int, permutation: List[int],
+        depth: int) -> List[Tuple[int, Tuple[int, int, int]]]:
+    """
+    In a worker process, plays this player's request of the other player
+    for a suit, as CleverPlayer._evaluate_move_uncached would, and searches
+    whatever follows. Returns the moves it adds to the transposition table.
+
+    The first task of each round a worker sees brings its table up to
+    date with the moves solved since the last round. Every search starts
+    from the same move ordering, so what it finds does not depend on which
+    worker it ran in, though the positions it has to search may.
+    """
+    global _worker_round
+    player = _worker_player
+    table = player.transposition_table
+    if _worker_round != round_number:
+        _worker_round = round_number
+        for pos, move in solved:
+            TranspositionTable.put(table, pos, move, depth - 1)
+    table.added = []
+    player.move_ordering = deepcopy(_worker_move_ordering)
+    previous = player._attach_caches(cards)
+    try:
+        if player.has_card(other, this, suit, cards, history):
+            cards.transfer(suit, other, this, False)
+        else:
+            cards.no_transfer(suit, other, this, False)
+        if depth > 0 and cards.test_winner(this) == Cards.NO_WINNER:
+            next_player = cards.next_player(this)
+            _, position = cards.canonical(next_player, permutation)
+            if position not in history:
+                player._path[position] = 0
+                try:
+                    player._evaluate_move(next_player, cards, history, depth - 1, ply = 0)
+                finally:
+                    del player._path[position]
+    finally:
+        player._detach_caches(cards, previous)
+    return table.added
+
+def symmetric_preferences(preferences: List[List[int]]) -> bool:
+    """
+    Returns whether the preferences look the same from every seat, so
+    each player wants the player a given distance round from them to win
+    as much as the others do. No preferences at all are symmetric.
+    """
+    if not preferences:
+        return True
+    n = len(preferences)
+    return all(preferences[i] == [(p + i) % n for p in preferences[0]] for i in range(n))
+
+# Rank of results that a player does not mind about, such as a win for
+# a player not in their preferences
+UNRANKED = 1000
+
+def rank_result(preferences: List[List[int]], this: int, result: int) -> int:
+    """
+    Returns how much this player wants the given result: zero for a win,
+    one for a draw, then their preferences for other winners. Anything
+    else is UNRANKED.
+    """
+    if result == this:
+        return 0
+    if result < 0:
+        return 1
+    if preferences:
+        wanted = preferences[this]
+        if result in wanted:
+            return 2 + wanted.index(result)
+    return UNRANKED
+
+class AnswerCache(BoundedCache):
+    """
+    Cache of the answers CleverPlayer chooses when asked for a card, where
+    the answer is not forced. Maps the canonical position of the player
+    asking, the suit, the player asked and the depth of the search to the
+    answer and the result it leads to.
+    """
+    pass
+
 class CleverPlayer(Player):
     """
     Implementation of Player that looks ahead, playing the best move
     available.
     """
-    def __init__(self, max_depth = 1000, max_has_depth = 10, preferences = None):
+    def __init__(self, max_depth = 1000, max_has_depth = 10, preferences = None,
+            shake_down_cache_size = 100000, position_cache_size = 100000,
+            has_card_cache_size = 0, transposition_table = None, solved_table = None,
+            pruning = False, move_ordering = None, time_budget = None, node_budget = None,
+            workers = None, answer_cache_size = 100000, symmetric = False, sink = None):
         """
         The max_depth specifies how far ahead the player will look
         before making a move. For example, zero means only consider
@@ -121,42 +613,398 @@ class CleverPlayer(Player):
         players wants to win. It is a list of lists of player numbers.
 
         If other_player is supplied, we share its cache.
+
+        The transposition_table holds the best moves we have found so
+        far. Pass in a bounded TranspositionTable to limit its size. By
+        default it grows without limit.
+
+        If solved_table is supplied, it is a SolvedTable that was saved
+        from an earlier search with the same preferences and symmetry, and
+        either the same depths as ours or no limits at all. We look up
+        positions there before searching. It must be for the same number
+        of players as the game we are asked to play.
+
+        The shake_down_cache_size bounds the number of shake down results
+        we remember while searching, position_cache_size the number of
+        symmetric positions, which we look up by the hash of the cards, and
+        has_card_cache_size the number of forced answers. Zero means do not
+        cache them. (Our own search rarely asks the same question of the
+        same cards twice, as it caches positions, so by default we do not
+        cache forced answers.)
+
+        The answer_cache_size bounds the number of answers we remember
+        choosing when asked for a card, where the answer was not forced.
+        Zero means we always search for them. (A full search rarely asks
+        the same question twice, but when deepening within a budget each
+        pass asks the questions the last one did, and about a fifth of
+        them are answered from the cache.)
+
+        If symmetric is set, positions that only differ by a rotation of
+        the players share their cached moves. Our search assumes that
+        every player decides as we would, so this is safe whenever the
+        preferences look the same from every seat, as symmetric_preferences
+        checks. Positions in the history still say who is to move, as a
+        rotated position is not a repeat.
+
+        If pruning is set, we skip the rest of a player's moves once they
+        have found something they prefer to anything that would change the
+        decision of the player before them (shallow pruning). This gives
+        the same results, though where moves are equally good, it may
+        choose a different one.
+
+        If move_ordering is supplied, it is a MoveOrdering, which decides
+        which moves to try first. Otherwise we try them in a fixed order.
+        The number of positions we have searched is counted in nodes, so
+        that we can compare.
+
+        If time_budget (in seconds) or node_budget is specified, each
+        decision is made by iterative deepening: searching to depth zero,
+        then one, and so on, until the search is complete or the budget
+        runs out. We then play the result of the deepest search that
+        finished.
+
+        If workers is more than one, each move we make (other than within
+        a budget) starts by searching the replies to our possible moves in
+        that many processes. What they find is merged into our
+        transposition table, then we search as usual, which finds most of
+        the positions already solved. With a fixed move order, we play the
+        same moves as we would searching on our own. The processes are
+        started by our first move, and last until we are closed.
+
+        If sink is supplied, it is an EventSink, which we tell the result
+        we expect from each move we make. Pass the sink the game is
+        played with to see it alongside the moves.
         """
         self.max_depth = max_depth
         self.max_has_depth = max_has_depth
         self.preferences = preferences
         self.log_level = -1
+        self.sink = sink if sink is not None else EventSink()
 
-        # dictionary of moves and their outcomes, matching the results of
+        # table of moves and their outcomes, matching the results of
         # _evaluate_move. This cache is shared between all players that are
         # represented by this instance of CleverPlayer
-        self._cached_moves = {}
+        if transposition_table is None:
+            transposition_table = TranspositionTable()
+        self.transposition_table = transposition_table
+        if solved_table is not None:
+            if solved_table.preferences != preferences:
+                raise ValueError("the solved table was saved with different preferences")
+            if solved_table.symmetric != symmetric:
+                raise ValueError("the solved table was saved with different symmetry")
+            if solved_table.max_depth is not None and (solved_table.max_depth != max_depth
+                    or solved_table.max_has_depth != max_has_depth):
+                raise ValueError("the solved table was saved from a search with different depths")
+        self.solved_table = solved_table
+        self.pruning = pruning
+        self.move_ordering = move_ordering
+        self.nodes = 0
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.workers = workers
+        self.symmetric = symmetric
+
+        # the pool of worker processes, once we have started it, the number
+        # of rounds of moves we have sent it, and the moves the workers
+        # solved in the last round, which the others have not yet seen
+        self._executor = None
+        self._round = 0
+        self._solved = []
+
+        # while deepening, the deadline and node limit for this decision,
+        # the table of complete results to fall back on, and the number of
+        # times we have stopped searching because of the depth
+        self._budget = None
+        self._exact_moves = None
+        self._out_of_depth = 0
+
+        # the positions we have added to the history while searching, with
+        # their plies, as described in _evaluate_move
+        self._path = {}
+
+        # results of shaking down the cards, shared in the same way
+        self.shake_down_cache = (ShakeDownCache(shake_down_cache_size)
+            if shake_down_cache_size > 0 else None)
+        self.position_cache = (PositionCache(position_cache_size)
+            if position_cache_size > 0 else None)
+        self.has_card_cache = (HasCardCache(has_card_cache_size)
+            if has_card_cache_size > 0 else None)
+        self.answer_cache = (AnswerCache(answer_cache_size)
+            if answer_cache_size > 0 else None)
+
+    def close(self):
+        """
+        Shuts down our worker processes, if we started any
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _attach_caches(self, cards: Cards):
+        """
+        Attaches our caches to the cards while we are searching. Returns
+        whatever caches the cards had before, to pass to _detach_caches.
+        """
+        previous = cards.shake_down_cache, cards.position_cache, cards.has_card_cache
+        cards.shake_down_cache = self.shake_down_cache
+        cards.position_cache = self.position_cache
+        cards.has_card_cache = self.has_card_cache
+        return previous
+
+    def _detach_caches(self, cards: Cards, previous):
+        cards.shake_down_cache, cards.position_cache, cards.has_card_cache = previous
 
     def next_move(self, this: int, cards: Cards, history: Set[int]) -> Tuple[int, int]:
-        other, suit, result, _ = self._evaluate_move(this, cards, history, self.max_depth)
-        print(f"Result={result}")
+        previous = self._attach_caches(cards)
+        try:
+            if self._budgeted():
+                # Until we have searched to depth zero, play any legal move
+                other, suit = cards.legal_moves(this)[0]
+                fallback = other, suit, Cards.NO_WINNER, -1
+                max_has_depth = self.max_has_depth
+
+                def search(depth: int):
+                    self.max_has_depth = min(max_has_depth, depth)
+                    return self._evaluate_move(this, cards, history, depth)
+
+                other, suit, result, _ = self._deepen(search, fallback, self.max_depth)
+            else:
+                if self.workers is not None and self.workers > 1:
+                    self._search_in_parallel(this, cards, history, self.max_depth)
+                other, suit, result, _ = self._evaluate_move(this, cards, history, self.max_depth)
+        finally:
+            self._detach_caches(cards, previous)
+        self.sink.expect(this, result)
         return other, suit
 
-    def _evaluate_move(self, this: int, cards: Cards, history: Set[int], depth: int) -> Tuple[int, int, int, int]:
+    def _search_in_parallel(self, this: int, cards: Cards, history: Set[int], depth: int):
+        """
+        Searches what follows each of our legal moves in a pool of worker
+        processes, and merges the positions they solve into our
+        transposition table. Each worker keeps a table of its own, and we
+        only send it the root of the search and the positions the other
+        workers solved last time. Where more than one worker solves a
+        position, we keep the move from the earliest of our moves, so the
+        merge does not depend on timing.
+        """
+        permutation, pos = cards.canonical(this, None, self.symmetric)
+        if self.transposition_table.get(pos) is not None:
+            return
+        moves = cards.legal_moves_given_permutation(this, permutation)
+        if len(moves) < 2:
+            return
+
+        # the workers have caches of their own
+        root = cards.copy()
+        root.shake_down_cache = root.position_cache = root.has_card_cache = None
+        if self._executor is None:
+            table = self.transposition_table
+            settings = (self.max_depth, self.max_has_depth, self.preferences, self.pruning,
+                self.move_ordering, self.symmetric, table.max_entries, table.policy)
+            self._executor = ProcessPoolExecutor(self.workers, initializer = _start_worker,
+                initargs = (settings,))
+        self._round += 1
+        futures = [self._executor.submit(_search_move, self._round, self._solved, root,
+            history, this, other, suit, permutation, depth) for other, suit in moves]
+        merged = set()
+        solved = []
+        for future in futures:
+            for pos, move in future.result():
+                if pos not in merged and pos not in self.transposition_table:
+                    merged.add(pos)
+                    solved.append((pos, move))
+                    self.transposition_table.put(pos, move, depth - 1)
+        self._solved = solved
+
+    def _budgeted(self) -> bool:
+        """
+        Returns whether we should deepen iteratively within a budget, which
+        we only do for the outermost decision, not within a search
+        """
+        return (self.time_budget is not None or self.node_budget is not None) \
+            and self._budget is None
+
+    def _deepen(self, search, fallback, max_depth: int):
+        """
+        Calls search with increasing depths (zero, one, two, four and so
+        on), until it completes without reaching the maximum depth anywhere,
+        or we reach max_depth, or we run out of budget. Returns the result
+        of the last search that finished, or the fallback if none did.
+
+        Each search has a transposition table of its own, bounded like
+        ours, as its results are only valid for that depth. It can also use the results in our
+        transposition table, which are complete. When a search turns out to
+        have been complete, its results are added to our table. Otherwise
+        the moves it found to win become hints for the next, deeper search,
+        which tries them first. (Its draws are mostly just out of depth, so
+        say little.) Without a move ordering, we order by hints alone while
+        deepening.
+        """
+        deadline = (perf_counter() + self.time_budget if self.time_budget is not None
+            else float("inf"))
+        node_limit = (self.nodes + self.node_budget if self.node_budget is not None
+            else float("inf"))
+        self._budget = (deadline, node_limit)
+        transposition_table = self.transposition_table
+        max_has_depth = self.max_has_depth
+        move_ordering = self.move_ordering
+        if move_ordering is None:
+            self.move_ordering = MoveOrdering(history = False,
+                max_hints = transposition_table.max_entries or 100000)
+        result = fallback
+        try:
+            depth = 0
+            while True:
+                iteration_table = TranspositionTable(transposition_table.max_entries,
+                    policy = transposition_table.policy)
+                self.transposition_table = iteration_table
+                self._exact_moves = transposition_table
+                self._out_of_depth = 0
+                result = search(depth)
+                if self._out_of_depth == 0:
+                    for pos, move in iteration_table.items():
+                        transposition_table.put(pos, move, depth)
+                    break
+                if depth >= max_depth:
+                    break
+                hints = self.move_ordering.hints
+                if hints is not None:
+                    for pos, (other_c, suit_c, result_c) in iteration_table.items():
+                        if result_c >= 0:
+                            hints.put(pos, (other_c, suit_c))
+
+                # Double the depth each time, so that repeating the shallower
+                # searches costs no more than the deepest one
+                depth = min(max(1, 2 * depth), max_depth)
+        except _OutOfBudget:
+            pass
+        finally:
+            self.transposition_table = transposition_table
+            self._exact_moves = None
+            self.max_has_depth = max_has_depth
+            self.move_ordering = move_ordering
+            self._budget = None
+        return result
+
+    def _check_budget(self):
+        """
+        Raises _OutOfBudget if we are deepening and have run out of
+        time or nodes
+        """
+        deadline, node_limit = self._budget
+        if self.nodes > node_limit or perf_counter() > deadline:
+            raise _OutOfBudget()
+
+    # Result of a search that was pruned, as it could not give any of
+    # the results that the caller wanted
+    PRUNED = -3
+
+    # Rank of results that this player does not mind about
+    UNRANKED = UNRANKED
+
+    def _rank(self, this: int, result: int) -> int:
+        """
+        Returns how much this player wants the given result, as rank_result.
+        """
+        return rank_result(self.preferences, this, result)
+
+    def _wanted(self, this: int, best_rank: int, number_of_players: int) -> Tuple[int, ...]:
+        """
+        Returns the results this player would prefer to the best they
+        have found so far, or None if anything could change their mind.
+        """
+        if best_rank == CleverPlayer.UNRANKED:
+            return None
+        return tuple(result for result in range(-1, number_of_players)
+            if self._rank(this, result) < best_rank)
+
+    @staticmethod
+    def _run_steps(steps):
+        """
+        Runs a search, written as a generator. Whenever it needs the result
+        of another search, it yields that search's generator, and is sent
+        the result. Rather than recursing, we keep the generators that are
+        waiting on an explicit stack, so however deep the search goes, it
+        needs no more Python stack than the first step. If a step raises an
+        exception, we throw it into each waiting generator in turn, so they
+        can tidy up.
+        """
+        stack = []
+        result = None
+        error = None
+        while True:
+            try:
+                if error is None:
+                    call = steps.send(result)
+                else:
+                    call = steps.throw(error)
+            except StopIteration as stop:
+                if not stack:
+                    return stop.value
+                steps = stack.pop()
+                result, error = stop.value, None
+                continue
+            except BaseException as exception:
+                if not stack:
+                    raise
+                steps = stack.pop()
+                result, error = None, exception
+                continue
+            stack.append(steps)
+            steps = call
+            result = None
+
+    # Dependency of a result that does not depend on the history at all
+    INDEPENDENT = sys.maxsize
+
+    def _evaluate_move(self, this: int, cards: Cards, history: Set[int], depth: int,
+            wanted: Tuple[int, ...] = None, ply: int = None) -> Tuple[int, int, int, int]:
         """
         Like next_move, but it also returns a result, which says what 
         the final best-case result is as a result of this move.
 
-        Returns a tuple of (other_player, suit, result, draw_position)
+        If wanted is supplied, it lists the only results the caller is
+        interested in. If we find we cannot return any of them, we may
+        give up and return a result of PRUNED.
+
+        Draws by repetition depend on the history. The history is that of
+        the game, and is never changed while we search. The positions we
+        pass through while searching are pushed onto self._path, each with
+        its ply, counting from zero, and popped again afterwards. If the
+        position we are evaluating is one of them, pass in its ply. The
+        result says how far back it depends: the lowest ply of any position
+        it relies on repeating, or -1 if it relies on the history of the
+        game, or INDEPENDENT.
+
+        Returns a tuple of (other_player, suit, result, depends_on)
+        """
+        return self._run_steps(self._evaluate_move_steps(this, cards, history, depth, wanted, ply))
+
+    def _evaluate_move_steps(self, this: int, cards: Cards, history: Set[int], depth: int,
+            wanted: Tuple[int, ...] = None, ply: int = None):
+        """
+        The steps of _evaluate_move, as a generator for _run_steps
         """
-        permutation = cards.permutation(this)
+        permutation, pos = cards.canonical(this, None, self.symmetric)
 
         # just for now, override the cache
         # return self._evaluate_move_uncached(this, cards, history, depth, permutation)
 
         # see whether this move is in the cache
-        pos = cards.position_given_permutation(permutation, this)
         n = len(permutation)
-        if pos in self._cached_moves:
-            other_c, suit_c, result_c = self._cached_moves[pos]
+        cached = self.transposition_table.get(pos)
+        if cached is None and self._exact_moves is not None:
+            cached = self._exact_moves.get(pos)
+        if cached is None and self.solved_table is not None:
+            if self.solved_table.number_of_players != n:
+                raise ValueError(f"the solved table is for {self.solved_table.number_of_players} "
+                    f"players, not {n}")
+            cached = self.solved_table.get(pos)
+        if cached is not None:
+            other_c, suit_c, result_c = cached
             other = (other_c + this) % n
             result = result_c if result_c < 0 else (result_c + this) % n
-            suit = int(permutation[suit_c])
+            suit = permutation[suit_c]
 
             # Just for debugging, check that the non-cached result is the same
             # Note that because of the way we check for repeats by looking in
@@ -170,37 +1018,52 @@ class CleverPlayer(Player):
             # elif other_u != other or suit_u != suit or result_u != result:
             #     print(f"cache fail ({pos}): cards={cards} cached=({other_c}, {suit_c}, {result_c}) => ({other}, {suit}, {result}) uncached={other_u, suit_u, result_u} this={this} perm={permutation}")
 
-            # Always return -1 as the draw position of any cached move. Since
-            # the position was cached, we know that it is a genuine forcing draw,
-            # so any position will do, so long as it is not in the history. We
-            # know that -1 is not a valid position 
-            return other, suit, result, -1
+            # Since the position was cached, we know that any draw is a
+            # genuine forcing draw, whatever the history
+            return other, suit, result, CleverPlayer.INDEPENDENT
 
-        # find the best move and cache it
-        other, suit, result, draw_position = self._evaluate_move_uncached(this, cards, history, depth, permutation)
+        # find the best move and cache it, unless we gave up looking
+        other, suit, result, depends_on = yield self._evaluate_move_uncached(
+            this, cards, history, depth, permutation, wanted, pos)
+        if result == CleverPlayer.PRUNED:
+            if self.move_ordering is not None:
+                self.move_ordering.record_hint(pos, this, (other, suit), permutation)
+            return other, suit, result, depends_on
         other_c = (other - this) % n
         result_c = result if result < 0 else (result - this) % n
-        found = np.where(permutation == suit)
-        assert len(found) == 1 and len(found[0]) == 1
-        suit_c = int(found[0][0])
+        suit_c = permutation.index(suit)
 
-        # Only save winning positions to the cache, as draws may only be a draw given
-        # the current history, rather than being indicative of a draw in general. However,
-        # if this is a draw and the position that caused the draw is not in our history,
-        # we can record it.
-        if result_c >= 0 or draw_position not in history:
-            self._cached_moves[pos] = (other_c, suit_c, result_c)
+        # Only save a draw to the cache if it would be a draw whatever the
+        # history. That is so if it only relies on repeating this position, or
+        # positions after it, as any route here could repeat them in the same
+        # way. (Our own position is only on the path if we were given its ply.)
+        if ply is None:
+            ply = len(self._path)
+        if result_c >= 0 or depends_on >= ply:
+            self.transposition_table.put(pos, (other_c, suit_c, result_c), depth)
+        elif self.move_ordering is not None:
+            self.move_ordering.record_hint(pos, this, (other, suit), permutation)
 
-        return other, suit, result, draw_position
+        return other, suit, result, depends_on
 
     def _evaluate_move_uncached(self, this: int, cards: Cards, history: Set[int], 
-            depth: int, permutation: np.ndarray) -> Tuple[int, int, int, int]:
+            depth: int, permutation: List[int], wanted: Tuple[int, ...] = None,
+            pos: int = None) -> Tuple[int, int, int, int]:
         """
-        Like _evaluate_move, but not using the cache.
+        Like _evaluate_move_steps, and also a generator, but not using the
+        cache. If we are ordering moves, pass in the position, as from
+        Cards.canonical.
         """
+        self.nodes += 1
+        if self._budget is not None:
+            self._check_budget()
+
         # try all the legal moves. (We know there must be some, as the player has some cards)
         legal_moves = cards.legal_moves_given_permutation(this, permutation)
         assert len(legal_moves) > 0
+        move_ordering = self.move_ordering
+        if move_ordering is not None:
+            legal_moves = move_ordering.order(this, legal_moves, depth, permutation, pos)
         draw = None
         out_of_depth = None
         lose = None
@@ -212,164 +1075,289 @@ class CleverPlayer(Player):
             preferences = None
             other_winners = None
 
+        # If pruning, we track the rank of the best result so far. We can
+        # stop as soon as we prefer it to everything the caller wants, as
+        # then nothing we find can be of interest to them.
+        pruning = self.pruning
+        best_rank = CleverPlayer.UNRANKED
+        if pruning and wanted is not None:
+            cutoff = min((self._rank(this, result) for result in wanted),
+                default = CleverPlayer.UNRANKED)
+        else:
+            cutoff = None
+
+        # Unless we win, our result depends on every move we tried, as any
+        # of them could turn out differently given a different history. So
+        # it depends on the history as far back as any of them do.
+        dependency = CleverPlayer.INDEPENDENT
+
+        best_move = None
         for other, suit in legal_moves:
-            copy_cards = deepcopy(cards)
-            has = self.has_card(other, this, suit, copy_cards, history)
-            if has:
-                copy_cards.transfer(suit, other, this, False)
-            else:
-                copy_cards.no_transfer(suit, other, this, False)
-            winner = copy_cards.test_winner(this)
-            if winner == Cards.ILLEGAL_CARDS:
-                print(f"WARNING: illegal cards after move has={has} suit={suit} other={other} this={this} moves={legal_moves}")
-                cards.show(this)
-                print("becomes")
-                copy_cards.show(copy_cards.next_player(this))
-                print("-------------")
-                continue
+            if cutoff is not None and best_rank < cutoff:
+                if move_ordering is not None:
+                    move_ordering.record_win(this, best_move, depth, permutation)
+                return best_move[0], best_move[1], CleverPlayer.PRUNED, dependency
 
-            # if this move wins immediately, play it
-            if winner == this:
-                return other, suit, winner, -1
-            
-            # if this move loses immediately, keep looking
-            if winner != Cards.NO_WINNER:
-                # if any immediate lose was to a player we want to win, add that
-                # to the list of other winners
-                if preferences and winner in preferences:
-                    pref = preferences.index(winner)
-                    other_winners[pref] = (other, suit, winner, -1)
+            # make the move in place, and undo it before trying the next
+            mark = cards.mark()
+            try:
+                forced, has = cards.has_card(suit, other, this)
+                if not forced:
+                    has = yield self._has_card_steps(other, this, suit, cards, history)
+                if has:
+                    cards.transfer(suit, other, this, False)
                 else:
-                    # otherwise just consider it a worst case
-                    immediate_lose = (other, suit, winner, -1)
-                continue
+                    cards.no_transfer(suit, other, this, False)
+                winner = cards.test_winner(this)
+                if winner == Cards.ILLEGAL_CARDS:
+                    print(f"WARNING: illegal cards after move has={has} suit={suit} other={other} this={this} moves={legal_moves}")
+                    illegal_cards = cards.copy()
+                    cards.undo(mark)
+                    cards.show(this)
+                    print("becomes")
+                    illegal_cards.show(illegal_cards.next_player(this))
+                    print("-------------")
+                    continue
+
+                # if this move wins immediately, play it
+                if winner == this:
+                    if move_ordering is not None:
+                        move_ordering.record_win(this, (other, suit), depth, permutation)
+                    return other, suit, winner, CleverPlayer.INDEPENDENT
             
-            # if we have hit our maximum depth, assume this is a draw
-            if depth == 0:
-                out_of_depth = (other, suit, -1, -1)
-                continue
+                # if this move loses immediately, keep looking
+                if winner != Cards.NO_WINNER:
+                    # if any immediate lose was to a player we want to win, add that
+                    # to the list of other winners
+                    if preferences and winner in preferences:
+                        pref = preferences.index(winner)
+                        other_winners[pref] = (other, suit, winner, CleverPlayer.INDEPENDENT)
+                        if 2 + pref < best_rank:
+                            best_rank, best_move = 2 + pref, (other, suit)
+                    else:
+                        # otherwise just consider it a worst case
+                        immediate_lose = (other, suit, winner, CleverPlayer.INDEPENDENT)
+                    continue
+            
+                # if we have hit our maximum depth, assume this is a draw
+                if depth == 0:
+                    out_of_depth = (other, suit, -1, CleverPlayer.INDEPENDENT)
+                    self._out_of_depth += 1
+                    if 1 < best_rank:
+                        best_rank, best_move = 1, (other, suit)
+                    continue
 
-            # if this move results in a draw, remember it
-            next_player = copy_cards.next_player(this)
-            position = copy_cards.position_given_permutation(permutation, next_player)
-            if position in history:
-                draw = (other, suit, -1, position)
-                continue        # stop looking if we have hit a draw                
+                # if this move results in a draw, remember it. If there is a
+                # choice, we play the draw that depends least on the history.
+                next_player = cards.next_player(this)
+                _, position = cards.canonical(next_player, permutation)
+                path = self._path
+                if position in history or position in path:
+                    depends_on = path.get(position, -1)
+                    dependency = min(dependency, depends_on)
+                    if draw is None or depends_on >= draw[3]:
+                        draw = (other, suit, -1, depends_on)
+                    if 1 < best_rank:
+                        best_rank, best_move = 1, (other, suit)
+                    continue        # stop looking if we have hit a draw                
 
-            # remember this position, so we recognise a subsequent draw
-            copy_history = deepcopy(history)
-            copy_history.add(position)
+                # Allow the next player to play their best move. If pruning,
+                # tell them which results would be any use to us. We push this
+                # position onto the path while they search, so we recognise a
+                # subsequent draw, rather than copying the history.
+                next_wanted = (self._wanted(this, best_rank, len(permutation))
+                    if pruning else None)
+                ply = len(path)
+                path[position] = ply
+                try:
+                    _, _, next_winner, depends_on = yield self._evaluate_move_steps(
+                        next_player, cards, history, depth - 1, next_wanted, ply)
+                finally:
+                    del path[position]
 
-            # Allow the next player to play their best move
-            _, _, next_winner, draw_position = self._evaluate_move(next_player, copy_cards, copy_history, depth - 1)
+                # If they gave up, this move is no better than what we have
+                dependency = min(dependency, depends_on)
+                if next_winner == CleverPlayer.PRUNED:
+                    continue
             
-            # If this results in a win for us, play this move
-            if next_winner == this:
-                return other, suit, next_winner, -1
+                # If this results in a win for us, play this move
+                if next_winner == this:
+                    if move_ordering is not None:
+                        move_ordering.record_win(this, (other, suit), depth, permutation)
+                    return other, suit, next_winner, CleverPlayer.INDEPENDENT
             
-            # If it results in a draw, record it
-            if next_winner < 0:
-                draw = (other, suit, -1, draw_position)
+                # If it results in a draw, record it
+                if next_winner < 0:
+                    if draw is None or depends_on >= draw[3]:
+                        draw = (other, suit, -1, depends_on)
+                    if 1 < best_rank:
+                        best_rank, best_move = 1, (other, suit)
             
-            # if there is a preference list, look along it
-            elif preferences and next_winner in preferences:
-                pref = preferences.index(next_winner)
-                other_winners[pref] = (other, suit, next_winner, 0)
+                # if there is a preference list, look along it
+                elif preferences and next_winner in preferences:
+                    pref = preferences.index(next_winner)
+                    other_winners[pref] = (other, suit, next_winner, depends_on)
+                    if 2 + pref < best_rank:
+                        best_rank, best_move = 2 + pref, (other, suit)
 
-            # Record a losing move, in case we cannot win
-            else:
-                lose = (other, suit, next_winner, -1)
+                # Record a losing move, in case we cannot win
+                else:
+                    lose = (other, suit, next_winner, depends_on)
+            finally:
+                cards.undo(mark)
 
         # force a draw if we can
         if draw is not None:
-            return draw
+            return draw[:3] + (dependency,)
         
         # if we were unable to probe to the end of any moves, use one
         if out_of_depth is not None:
-            return out_of_depth
+            return out_of_depth[:3] + (dependency,)
         
         # is there a preference to which other players we want to win?
         if other_winners:
             for other_winner in other_winners:
                 if other_winner:
-                    return other_winner
+                    return other_winner[:3] + (dependency,)
 
         # an eventual lose is slightly better than an immediate one
         if lose is not None:
-            return lose
+            return lose[:3] + (dependency,)
  
         # nothing works. Just play any losing move
         assert immediate_lose is not None
-        return immediate_lose
+        return immediate_lose[:3] + (dependency,)
     
     def has_card(self, this: int, other: int, suit: int, cards: Cards, history: Set[int]) -> bool:
-        # if the move is forced, don't think about it
-        forced, has = cards.has_card(suit, this, other)
-        if forced:
-            return has
+        previous = self._attach_caches(cards)
+        try:
+            # if the move is forced, don't think about it
+            forced, has = cards.has_card(suit, this, other)
+            if forced:
+                return has
 
-        # otherwise make the move that results in a win or failing that a draw
-        # try saying yes, which is generally the best option.
-        copy_cards = deepcopy(cards)
-        copy_cards.transfer(suit, this, other, False)
-        yes_winner = copy_cards.test_winner(other)
-        if yes_winner == this:
-            return True     # saying yes gives us an immediate win!
+            if self._budgeted():
+                # a search to depth zero never runs out of budget
+                def search(depth: int):
+                    self.max_has_depth = depth
+                    return self._has_card(this, other, suit, cards, history)
 
-        # if the max depth is zero, do no lookahead -- just say yes
-        # unless it results in an immediate lose
-        if self.max_has_depth == 0:
-            return yes_winner != Cards.NO_WINNER
+                return self._deepen(search, True, self.max_has_depth)
+            return self._has_card(this, other, suit, cards, history)
+        finally:
+            self._detach_caches(cards, previous)
 
-        if self.preferences:
-            preferences = self.preferences[this]
-        else:
-            preferences = None
+    def _has_card(self, this: int, other: int, suit: int, cards: Cards, history: Set[int]) -> bool:
+        return self._run_steps(self._has_card_steps(this, other, suit, cards, history))
 
-        next_player = copy_cards.next_player(other)
+    def _has_card_steps(self, this: int, other: int, suit: int, cards: Cards, history: Set[int]):
+        """
+        The steps of _has_card, as a generator for _run_steps. The answer
+        must not be forced. If we have an answer_cache, we look it up there
+        by the canonical position of the player asking, with the suit and
+        this player relative to them, and the depth we would search to.
+        """
+        cache = self.answer_cache
+        if cache is None:
+            has, _, _ = yield self._choose_answer_steps(this, other, suit, cards, history)
+            return has
 
-        # If this results in an immediate win for someone else or an illegal position,
-        # say no (unless we are thinking about second preferences)
-        # TODO: Consider raising a warning if Cards.ILLEGAL_CARDS
-        if yes_winner != Cards.NO_WINNER:
-            if not preferences or yes_winner not in preferences:
-                return False
-        else:
-            # Convert the yes_winner into an eventual winner after looking forward
-            copy_history = deepcopy(history)
-            _, _, yes_winner, _ = self._evaluate_move(next_player, copy_cards, copy_history, self.max_has_depth - 1)
-            
-            # If this results in a win for us, say yes
+        n = cards.number_of_players()
+        permutation, pos = cards.canonical(other, None, self.symmetric)
+        key = (pos, permutation.index(suit), (this - other) % n, self.max_has_depth)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+        out_of_depth = self._out_of_depth
+        has, result, depends_on = yield self._choose_answer_steps(this, other, suit, cards, history)
+
+        # As with draws in the transposition table, only remember answers
+        # that would be the same whatever the history. Nor do we remember
+        # answers where we ran out of depth, as deepening needs to know.
+        if depends_on >= len(self._path) and self._out_of_depth == out_of_depth:
+            cache.put(key, (has, result))
+        return has
+
+    def _choose_answer_steps(self, this: int, other: int, suit: int, cards: Cards, history: Set[int]):
+        """
+        Searches for the best answer when this player is asked for a card
+        by the other. Returns (has, result, depends_on), where result is
+        what we expect to follow from the answer, or None if we chose it
+        without looking, and depends_on is as for _evaluate_move.
+        """
+        depends_on = CleverPlayer.INDEPENDENT
+        # make the move that results in a win or failing that a draw
+        # try saying yes, which is generally the best option. Each answer is
+        # tried in place, and undone afterwards.
+        mark = cards.mark()
+        try:
+            cards.transfer(suit, this, other, False)
+            yes_winner = cards.test_winner(other)
             if yes_winner == this:
-                return True
+                return True, this, depends_on   # saying yes gives us an immediate win!
+
+            # if the max depth is zero, do no lookahead -- just say yes
+            # unless it results in an immediate lose
+            if self.max_has_depth == 0:
+                self._out_of_depth += 1
+                return yes_winner == Cards.NO_WINNER, None, depends_on
+
+            if self.preferences:
+                preferences = self.preferences[this]
+            else:
+                preferences = None
+
+            next_player = cards.next_player(other)
+
+            # If this results in an immediate win for someone else or an illegal position,
+            # say no (unless we are thinking about second preferences)
+            # TODO: Consider raising a warning if Cards.ILLEGAL_CARDS
+            if yes_winner != Cards.NO_WINNER:
+                if not preferences or yes_winner not in preferences:
+                    return False, None, depends_on
+            else:
+                # Convert the yes_winner into an eventual winner after looking forward
+                _, _, yes_winner, yes_depends_on = yield self._evaluate_move_steps(
+                    next_player, cards, history, self.max_has_depth - 1)
+                depends_on = min(depends_on, yes_depends_on)
+                
+                # If this results in a win for us, say yes
+                if yes_winner == this:
+                    return True, this, depends_on
+        finally:
+            cards.undo(mark)
 
         # now try saying no
-        copy_cards = deepcopy(cards)
-        copy_cards.no_transfer(suit, this, other, False)
-        no_winner = copy_cards.test_winner(other)
-        if no_winner == this:
-            return False    # saying no gives us an immediate win
-
-        # if this results in an immediate win for someone else or illegal cards, say yes
-        if no_winner != Cards.NO_WINNER:
-            if not preferences or no_winner not in preferences:
-                return True
-        else:
-            # Allow the next player to play their best move
-            copy_history = deepcopy(history)
-            _, _, no_winner, _ = self._evaluate_move(next_player, copy_cards, copy_history, self.max_has_depth - 1)
-        
-            # If this results in a win for us, say no
+        mark = cards.mark()
+        try:
+            cards.no_transfer(suit, this, other, False)
+            no_winner = cards.test_winner(other)
             if no_winner == this:
-                return False
+                return False, this, depends_on  # saying no gives us an immediate win
+
+            # if this results in an immediate win for someone else or illegal cards, say yes
+            if no_winner != Cards.NO_WINNER:
+                if not preferences or no_winner not in preferences:
+                    return True, yes_winner, depends_on
+            else:
+                # Allow the next player to play their best move
+                _, _, no_winner, no_depends_on = yield self._evaluate_move_steps(
+                    next_player, cards, history, self.max_has_depth - 1)
+                depends_on = min(depends_on, no_depends_on)
+            
+                # If this results in a win for us, say no
+                if no_winner == this:
+                    return False, this, depends_on
+        finally:
+            cards.undo(mark)
         
         # If yes would have resulted in a draw, then say yes
         if yes_winner < 0:
-            return True
+            return True, yes_winner, depends_on
 
         # If no would have resulted in a draw, then say no
         if no_winner < 0:
-            return False
+            return False, no_winner, depends_on
 
         # if there are any preferences for other players, choose the
         # answer that would give them a win
@@ -383,12 +1371,248 @@ class CleverPlayer(Player):
             else:
                 no_preference = len(preferences)
             if yes_preference < no_preference:
-                return True
+                return True, yes_winner, depends_on
             elif no_preference < yes_preference:
-                return False
+                return False, no_winner, depends_on
         
         # Nothing works -- just say no
-        return False
+        return False, no_winner, depends_on
+
+class _Node:
+    """
+    Node of the tree searched by MCTSPlayer. The player is the one making
+    the decision here. If they are asking for a card, the moves are
+    (other, suit). If they are answering, asker and suit say what they
+    were asked, and the moves are True and False. Terminal nodes have a
+    result instead: the winner, or -1 for a draw.
+    """
+    __slots__ = ("player", "asker", "suit", "untried", "children", "visits", "rewards", "result")
+
+    def __init__(self, player: int, number_of_players: int, asker: int = None, suit: int = None):
+        self.player = player
+        self.asker = asker
+        self.suit = suit
+        self.untried = None
+        self.children = {}
+        self.visits = 0
+        self.rewards = [0.0] * number_of_players
+        self.result = None
+
+class MCTSPlayer(Player):
+    """
+    Implementation of Player that uses Monte Carlo tree search, for games
+    too big to search exhaustively. Each decision grows a tree of moves
+    and answers from the current position, choosing which to explore by
+    UCT, and finishing each line with random moves until somebody wins.
+    """
+    def __init__(self, iterations = 1000, time_budget = None, preferences = None,
+            exploration = 1.4, playout_depth = 200, seed = None,
+            shake_down_cache_size = 100000):
+        """
+        Each decision runs the given number of iterations, or if
+        time_budget (in seconds) is specified, as many as fit in that time.
+
+        If preferences is specified, it states who each of the players
+        wants to win, as for CleverPlayer. A win is worth one, a draw a
+        half, and a win for a preferred player less than a half, falling
+        away down the list.
+
+        The exploration is the UCT constant, which trades off trying the
+        moves that have done well against those that have hardly been
+        tried. A random playout that goes on for more than playout_depth
+        moves is counted as a draw. The seed makes the player repeatable.
+        Without one, we take a seed from the random module, so seeding
+        that makes us repeatable too.
+        """
+        self.iterations = iterations
+        self.time_budget = time_budget
+        self.preferences = preferences
+        self.exploration = exploration
+        self.playout_depth = playout_depth
+        self.random = Random(randrange(1 << 32) if seed is None else seed)
+        self.shake_down_cache = (ShakeDownCache(shake_down_cache_size)
+            if shake_down_cache_size > 0 else None)
+        self.playouts = 0
+
+    def next_move(self, this: int, cards: Cards, history: Set[int]) -> Tuple[int, int]:
+        root = _Node(this, cards.number_of_players())
+        return self._search(root, cards, history)
+
+    def has_card(self, this: int, other: int, suit: int, cards: Cards, history: Set[int]) -> bool:
+        forced, has = cards.has_card(suit, this, other)
+        if forced:
+            return has
+        root = _Node(this, cards.number_of_players(), other, suit)
+        return self._search(root, cards, history)
+
+    def _search(self, root: _Node, cards: Cards, history: Set[int]):
+        """
+        Grows the tree from the root within our budget, and returns the
+        move from the root that was explored most
+        """
+        previous = cards.shake_down_cache
+        cards.shake_down_cache = self.shake_down_cache
+        try:
+            deadline = (perf_counter() + self.time_budget if self.time_budget is not None
+                else None)
+            iteration = 0
+            while iteration == 0 or (perf_counter() < deadline if deadline is not None
+                    else iteration < self.iterations):
+                mark = cards.mark()
+                try:
+                    self._iterate(root, cards, history)
+                finally:
+                    cards.undo(mark)
+                iteration += 1
+        finally:
+            cards.shake_down_cache = previous
+        return max(root.children.items(), key = lambda child: child[1].visits)[0]
+
+    def _iterate(self, root: _Node, cards: Cards, history: Set[int]):
+        """
+        Selects a path down the tree, making the moves on the cards as we
+        go, expands it by one node, plays out randomly from there, and
+        adds the result to every node on the path
+        """
+        n = cards.number_of_players()
+        seen = set()
+        node = root
+        path = [root]
+        while node.result is None:
+            if node.untried is None:
+                node.untried = self._moves(node, cards)
+                self.random.shuffle(node.untried)
+            if node.untried:
+                node = self._play(node, node.untried.pop(), cards, history, seen)
+                path.append(node)
+                break
+            node = self._play(node, self._select(node), cards, history, seen)
+            path.append(node)
+
+        result = node.result
+        if result is None:
+            result = self._playout(node, cards, history, seen)
+        rewards = [self._reward(player, result) for player in range(n)]
+        for node in path:
+            node.visits += 1
+            node_rewards = node.rewards
+            for player in range(n):
+                node_rewards[player] += rewards[player]
+
+    def _moves(self, node: _Node, cards: Cards) -> list:
+        if node.asker is None:
+            return cards.legal_moves(node.player)
+        return [True, False]
+
+    def _select(self, node: _Node):
+        """
+        Returns the move to the child with the best upper confidence bound,
+        for the player deciding at this node
+        """
+        player = node.player
+        scale = self.exploration * math.sqrt(math.log(node.visits))
+        best = None
+        best_value = None
+        for move, child in node.children.items():
+            value = child.rewards[player] / child.visits + scale / math.sqrt(child.visits)
+            if best is None or value > best_value:
+                best, best_value = move, value
+        return best
+
+    def _play(self, node: _Node, move, cards: Cards, history: Set[int], seen: Set[int]) -> _Node:
+        """
+        Makes the move from this node on the cards. Returns the child it
+        leads to, creating it the first time.
+        """
+        child = node.children.get(move)
+        n = cards.number_of_players()
+        if node.asker is None:
+            asker = node.player
+            other, suit = move
+            forced, has = cards.has_card(suit, other, asker)
+            if not forced:
+                # the other player must decide how to answer
+                if child is None:
+                    child = _Node(other, n, asker, suit)
+                    node.children[move] = child
+                return child
+        else:
+            asker = node.asker
+            other = node.player
+            suit = node.suit
+            has = move
+
+        result = self._answer(asker, other, suit, has, cards, history, seen)
+        if child is None:
+            if result is None:
+                child = _Node(cards.next_player(asker), n)
+            else:
+                child = _Node(-1, n)
+                child.result = result
+            node.children[move] = child
+        return child
+
+    def _answer(self, asker: int, other: int, suit: int, has: bool, cards: Cards,
+            history: Set[int], seen: Set[int]) -> int:
+        """
+        Makes the transfer, or not, on the cards. Returns the winner, -1
+        for a draw by repetition, or None if the game goes on.
+        """
+        if has:
+            cards.transfer(suit, other, asker, False)
+        else:
+            cards.no_transfer(suit, other, asker, False)
+        winner = cards.test_winner(asker)
+        assert winner != Cards.ILLEGAL_CARDS, "an answer that was not forced was illegal"
+        if winner != Cards.NO_WINNER:
+            return winner
+
+        # as in play, a repeated position is a draw
+        position = cards.position(asker)
+        if position in history or position in seen:
+            return -1
+        seen.add(position)
+        return None
+
+    def _playout(self, node: _Node, cards: Cards, history: Set[int], seen: Set[int]) -> int:
+        """
+        Plays random moves and answers from the given node until the game
+        ends, or goes on too long, which counts as a draw
+        """
+        self.playouts += 1
+        random = self.random
+        if node.asker is not None:
+            result = self._answer(node.asker, node.player, node.suit, random.random() < 0.5,
+                cards, history, seen)
+            if result is not None:
+                return result
+            this = cards.next_player(node.asker)
+        else:
+            this = node.player
+        for _ in range(self.playout_depth):
+            other, suit = random.choice(cards.legal_moves(this))
+            forced, has = cards.has_card(suit, other, this)
+            if not forced:
+                has = random.random() < 0.5
+            result = self._answer(this, other, suit, has, cards, history, seen)
+            if result is not None:
+                return result
+            this = cards.next_player(this)
+        return -1
+
+    def _reward(self, this: int, result: int) -> float:
+        """
+        Returns what the result is worth to this player
+        """
+        if result == this:
+            return 1.0
+        if result < 0:
+            return 0.5
+        if self.preferences:
+            preferences = self.preferences[this]
+            if result in preferences:
+                return 0.5 * (len(preferences) - preferences.index(result)) / (len(preferences) + 1)
+        return 0.0
 
 def test_two_clever_players():
     start = perf_counter()
@@ -404,6 +1628,104 @@ def test_two_clever_players():
     print("----------------")
     print()
 
+def test_transposition_table():
+    """
+    Fill small tables with each policy, checking what they keep
+    """
+    lru = TranspositionTable(max_entries = 2)
+    lru.put(1, (1, 0, -1), 5)
+    lru.put(2, (1, 1, -1), 5)
+    assert lru.get(1) == (1, 0, -1)     # 1 is now more recent than 2
+    lru.put(3, (1, 2, -1), 5)
+    assert lru.get(2) is None and lru.get(1) is not None and lru.get(3) is not None
+    assert len(lru) == 2 and lru.evictions == 1 and lru.hits == 3 and lru.misses == 1
+
+    # positions 1 and 3 share a slot, so the deeper one stays
+    depth = TranspositionTable(max_entries = 2, policy = TranspositionTable.DEPTH)
+    depth.put(1, (1, 0, -1), 5)
+    depth.put(3, (1, 1, -1), 4)
+    assert depth.get(1) == (1, 0, -1) and depth.get(3) is None
+    depth.put(3, (1, 1, -1), 6)
+    assert depth.get(1) is None and depth.get(3) == (1, 1, -1)
+    assert depth.evictions == 2
+
+    # positions 1, 2 and 3 share a pair of slots
+    two_tier = TranspositionTable(max_entries = 2, policy = TranspositionTable.TWO_TIER)
+    two_tier.put(1, (1, 0, -1), 5)
+    two_tier.put(2, (1, 1, -1), 4)
+    two_tier.put(3, (1, 2, -1), 3)
+    assert two_tier.get(1) == (1, 0, -1) and two_tier.get(2) is None
+    assert two_tier.get(3) == (1, 2, -1)
+    two_tier.put(2, (1, 1, -1), 6)
+    assert two_tier.get(2) == (1, 1, -1) and two_tier.get(1) == (1, 0, -1)
+    assert two_tier.get(3) is None and len(two_tier) == 2
+
+    # a byte budget turns into a number of entries
+    assert TranspositionTable(max_bytes = 10 * TranspositionTable.ENTRY_BYTES).max_entries == 10
+    print("test_transposition_table: succeeded")
+
+def test_two_clever_players_bounded():
+    """
+    The result should not change if the transposition table is too
+    small to hold everything
+    """
+    for policy in (TranspositionTable.LRU, TranspositionTable.DEPTH, TranspositionTable.TWO_TIER):
+        table = TranspositionTable(max_entries = 4, policy = policy)
+        player = CleverPlayer(1000, 1000, transposition_table = table)
+        result = play([player, player])
+        print(table)
+        assert result == -1, "test_two_clever_players_bounded: expecting a draw"
+        assert len(table) <= 4 and table.evictions > 0
+    print("----------------")
+    print()
+
+def test_solved_table():
+    """
+    Solve a three player game, save the table, then play it again with a
+    new player that looks up the saved table. It should play the same
+    game, without needing to search.
+    """
+    import tempfile
+    player = CleverPlayer(1000, 1000)
+    result = play([player, player, player])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "three.solved")
+        SolvedTable.save(path, player.transposition_table, 3,
+            max_depth = 1000, max_has_depth = 1000)
+        with SolvedTable(path) as solved:
+            assert solved.max_depth == 1000 and solved.max_has_depth == 1000
+            assert len(solved) == len(player.transposition_table)
+            for pos, move in player.transposition_table.items():
+                assert solved.get(pos) == move
+            assert solved.get(0) is None     # the one miss
+
+            start = perf_counter()
+            replayer = CleverPlayer(1000, 1000, solved_table = solved)
+            replayed = play([replayer, replayer, replayer])
+            print(f"{solved} replayed in {perf_counter() - start} seconds")
+            assert replayed == result
+            assert solved.misses == 1 and len(replayer.transposition_table) == 0
+
+            # the table is only valid for searches with the same preferences,
+            # symmetry and limits, and for three players
+            for mismatch, settings in [("preferences", dict(preferences = [[1], [2], [0]])),
+                    ("symmetry", dict(symmetric = True)),
+                    ("depths", dict(max_depth = 10)), ("depths", dict(max_has_depth = 10))]:
+                try:
+                    CleverPlayer(**{"max_depth": 1000, "max_has_depth": 1000, **settings},
+                        solved_table = solved)
+                    assert False, f"test_solved_table: expecting different {mismatch} to fail"
+                except ValueError as e:
+                    assert f"different {mismatch}" in str(e)
+            try:
+                play([replayer, replayer])
+                assert False, "test_solved_table: expecting two players to fail"
+            except ValueError:
+                pass
+    print("----------------")
+    print()
+
 def test_three_clever_players():
     start = perf_counter()
     player = CleverPlayer(1000, 1000)
@@ -439,6 +1761,257 @@ def test_three_clever_biased_players():
     print("----------------")
     print()
 
+def test_three_clever_players_pruned():
+    """
+    Pruning should not change the results of any games
+    """
+    for preferences in [None, [[1], [2], [0]], [[2], [0], [1]]]:
+        results = []
+        for pruning in (False, True):
+            player = CleverPlayer(1000, 1000, preferences, pruning = pruning)
+            results.append(play([player, player, player]))
+        assert results[0] == results[1], \
+            f"test_three_clever_players_pruned: pruning changed {preferences} from {results[0]} to {results[1]}"
+    print("test_three_clever_players_pruned: succeeded")
+
+def test_move_ordering():
+    """
+    Check the order of moves, then that ordering moves does not change
+    the result of a game with preferences
+    """
+    ordering = MoveOrdering(killers = True)
+    moves = [(1, 0), (1, 1), (2, 0), (2, 1)]
+    permutation = [0, 1, 2]
+    assert ordering.order(0, moves, 5, permutation, 1234) == moves
+    ordering.record_win(0, (2, 0), 5, permutation)
+    ordering.record_win(0, (2, 1), 4, permutation)
+    ordering.record_win(0, (2, 1), 3, permutation)
+    ordering.record_hint(1234, 0, (1, 1), permutation)
+    assert ordering.order(0, moves, 5, permutation, 1234) == [(1, 1), (2, 0), (2, 1), (1, 0)]
+    assert ordering.order(0, moves, 4, permutation, 0) == [(2, 1), (2, 0), (1, 0), (1, 1)]
+
+    nodes = []
+    for move_ordering in (None, MoveOrdering()):
+        player = CleverPlayer(1000, 1000, [[1], [2], [0]], move_ordering = move_ordering)
+        result = play([player, player, player])
+        assert result == -1, "test_move_ordering: expecting a draw"
+        nodes.append(player.nodes)
+    print(f"test_move_ordering: succeeded, nodes without ordering {nodes[0]}, with {nodes[1]}")
+
+def test_iterative_deepening():
+    """
+    With plenty of time, deepening should give the same result as a full
+    search. With a tiny budget, each decision should stop searching soon
+    after its budget runs out.
+    """
+    player = CleverPlayer(1000, 1000, time_budget = 60)
+    assert play([player, player]) == -1, "test_iterative_deepening: expecting a draw"
+
+    class CountingPlayer(CleverPlayer):
+        def next_move(self, this, cards, history):
+            start = self.nodes
+            result = super().next_move(this, cards, history)
+            assert self.nodes - start <= self.node_budget + 1
+            return result
+
+    player = CountingPlayer(1000, 1000, node_budget = 50)
+    result = play([player, player, player])
+    assert result in (-1, 0, 1, 2)
+    assert player.move_ordering is None, "test_iterative_deepening: hints outlived deepening"
+
+    # each pass tries the wins the last one found first, which saves
+    # a fifth of the nodes of budgeted three player games
+    nodes = []
+    for seeded in (False, True):
+        player = CleverPlayer(1000, 1000, time_budget = 600)
+        if not seeded:
+            player.move_ordering = MoveOrdering(hints = False, history = False)
+        play([player, player, player])
+        nodes.append(player.nodes)
+    assert nodes[1] < nodes[0], "test_iterative_deepening: expecting hints to save nodes"
+
+    # each deepening pass is bounded like the table we were given
+    class BoundedPlayer(CleverPlayer):
+        def _evaluate_move(self, this, cards, history, depth, *args, **kwargs):
+            table = self.transposition_table
+            assert table.max_entries == 4 and table.policy == TranspositionTable.DEPTH
+            return super()._evaluate_move(this, cards, history, depth, *args, **kwargs)
+
+    table = TranspositionTable(max_entries = 4, policy = TranspositionTable.DEPTH)
+    player = BoundedPlayer(1000, 1000, transposition_table = table, time_budget = 60)
+    assert play([player, player]) == -1, "test_iterative_deepening: expecting a draw"
+    assert len(table) <= 4
+    print(f"test_iterative_deepening: succeeded, {player.nodes} nodes")
+
+def test_run_steps():
+    """
+    Run a search far deeper than Python's recursion limit, then one that
+    fails at the bottom, which should tidy up every level on the way out.
+    """
+    def countdown(n):
+        if n == 0:
+            return 0
+        return (yield countdown(n - 1)) + 1
+
+    depth = 10 * sys.getrecursionlimit()
+    assert CleverPlayer._run_steps(countdown(depth)) == depth
+
+    tidied = []
+    def fail(n):
+        try:
+            if n == 0:
+                raise _OutOfBudget()
+            yield fail(n - 1)
+        finally:
+            tidied.append(n)
+
+    try:
+        CleverPlayer._run_steps(fail(depth))
+        assert False, "test_run_steps: expecting _OutOfBudget"
+    except _OutOfBudget:
+        pass
+    assert tidied == list(range(depth + 1))
+    print("test_run_steps: succeeded")
+
+def test_answer_cache():
+    """
+    Ask the same question twice. The second time, the answer should come
+    from the cache. Then play a game using the cache, which
+    should give the same result as without.
+    """
+    cards = Cards(3)
+    player = CleverPlayer(1000, 1000, answer_cache_size = 100000)
+    has = player.has_card(1, 0, 0, cards, set())
+    hits = player.answer_cache.hits
+    assert player.has_card(1, 0, 0, cards, set()) == has
+    assert player.answer_cache.hits == hits + 1, str(player.answer_cache)
+
+    result = play([CleverPlayer(1000, 1000, answer_cache_size = 0)] * 3)
+    player = CleverPlayer(1000, 1000, answer_cache_size = 100000)
+    assert play([player] * 3) == result
+    print(f"test_answer_cache: succeeded, {player.answer_cache}")
+
+def test_symmetric_players():
+    """
+    Check which preferences are symmetric. Then play the three player
+    game with rotated positions sharing their moves, and with each of the
+    symmetric second preferences. The results should be the same as without,
+    with fewer positions to search. Save the symmetric moves, and check
+    that the table remembers they were symmetric.
+    """
+    import tempfile
+    assert symmetric_preferences(None)
+    assert symmetric_preferences([[1, 2], [2, 0], [0, 1]])
+    assert not symmetric_preferences([[1, 2], [0, 2], [0, 1]])
+
+    for preferences in (None, [[1], [2], [0]], [[2], [0], [1]]):
+        player = CleverPlayer(1000, 1000, preferences)
+        result = play([player] * 3)
+        symmetric = CleverPlayer(1000, 1000, preferences, symmetric = True)
+        assert play([symmetric] * 3) == result
+        print(f"preferences {preferences}: {len(symmetric.transposition_table)} symmetric "
+            f"positions, against {len(player.transposition_table)}")
+        assert len(symmetric.transposition_table) < len(player.transposition_table)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "symmetric.solved")
+        SolvedTable.save(path, symmetric.transposition_table, 3, preferences, symmetric = True,
+            max_depth = 1000, max_has_depth = 1000)
+        with SolvedTable(path) as solved:
+            assert solved.symmetric
+            replayer = CleverPlayer(1000, 1000, preferences, solved_table = solved,
+                symmetric = True)
+            assert play([replayer] * 3) == result
+    print("----------------")
+    print()
+
+def test_draw_dependencies():
+    """
+    The two player game is a draw. Searching from the start, the draws only
+    rely on positions within the search, so the start can be cached. If the
+    game has already passed through every position we could move to, each
+    move draws at once, relying on the history of the game. That should not
+    be cached. Either way, the search should leave the history as it was.
+    """
+    cards = Cards(2)
+    permutation, pos = cards.canonical(0)
+    player = CleverPlayer(1000, 1000)
+    _, _, result, depends_on = player._evaluate_move(0, cards, set(), 1000)
+    assert result == -1 and depends_on >= 0
+    assert player.transposition_table.get(pos) is not None
+
+    history = set()
+    for other, suit in cards.legal_moves(0):
+        for has in (True, False):
+            next_cards = cards.copy()
+            if has:
+                next_cards.transfer(suit, other, 0, False)
+            else:
+                next_cards.no_transfer(suit, other, 0, False)
+            if next_cards.test_winner(0) == Cards.NO_WINNER:
+                history.add(next_cards.canonical(1, permutation)[1])
+    # the search never changes the history, so it may as well be frozen
+    player = CleverPlayer(1000, 1000)
+    _, _, result, depends_on = player._evaluate_move(0, cards, frozenset(history), 1000)
+    assert result == -1 and depends_on == -1
+    assert player.transposition_table.get(pos) is None
+    assert not player._path
+    print("test_draw_dependencies: succeeded")
+
+def test_parallel_search():
+    """
+    Play a three player game with the replies to each move searched in
+    parallel. It should be the same game as searching on our own, but the
+    main process should find almost everything already solved. Then do the
+    same with a shallow search, which needs the workers for more than one
+    move, so they must keep going between moves.
+    """
+    def moves(player):
+        log = BufferedLog()
+        result = play([player, player, player], log)
+        return result, log.moves()
+
+    start = perf_counter()
+    serial = CleverPlayer(1000, 1000)
+    parallel = CleverPlayer(1000, 1000, workers = 2)
+    try:
+        assert moves(parallel) == moves(serial)
+    finally:
+        parallel.close()
+    print(f"searched {parallel.nodes} nodes in parallel, {serial.nodes} on our own, "
+        f"in {perf_counter() - start} seconds")
+    assert parallel.nodes < serial.nodes
+
+    serial = CleverPlayer(2, 2)
+    parallel = CleverPlayer(2, 2, workers = 2)
+    try:
+        assert moves(parallel) == moves(serial)
+        assert parallel._round > 1
+    finally:
+        parallel.close()
+    assert parallel._executor is None
+    print("----------------")
+    print()
+
+def test_worker_path():
+    """
+    Search several moves in turn in one worker, here in this process.
+    Each search should leave nothing on the worker's path, so that what
+    the next one finds does not depend on it.
+    """
+    global _worker_player, _worker_move_ordering, _worker_round
+    cards = Cards(3)
+    permutation, _ = cards.canonical(0)
+    _start_worker((4, 4, None, False, None, False, None, TranspositionTable.LRU))
+    try:
+        for round_number, (other, suit) in enumerate(
+                cards.legal_moves_given_permutation(0, permutation)):
+            _search_move(round_number, [], cards.copy(), set(), 0, other, suit, permutation, 4)
+            assert not _worker_player._path, f"test_worker_path: left {_worker_player._path}"
+    finally:
+        _worker_player = _worker_move_ordering = _worker_round = None
+    print("test_worker_path: succeeded")
+
 def test_three_clever_players_of_all_types():
     """
     Try all combinations of preferences for the three player game
@@ -473,6 +2046,28 @@ def test_four_clever_players():
     print("----------------")
     print()
 
+def test_mcts_player():
+    """
+    An MCTSPlayer with a small budget should win more than half its three
+    and four player games against random players, who would only win a
+    third or a quarter of them. Every player has its own seed, so the
+    games are always the same.
+    """
+    start = perf_counter()
+    games = 30
+    for n in (3, 4):
+        wins = 0
+        for game in range(games):
+            players = [RandomPlayer(seed = game * n + i) for i in range(n)]
+            players[game % n] = MCTSPlayer(50, seed = game)
+            if play(players) == game % n:
+                wins += 1
+        print(f"MCTSPlayer won {wins} of {games} games against {n - 1} random players")
+        assert wins > games // 2
+    print(f"elapsed time: {perf_counter() - start} seconds")
+    print("----------------")
+    print()
+
 def test_next_move():
     """
     Starting from position 222?/000?/111? with player 0 to play, 
@@ -533,8 +2128,21 @@ def test_next_move():
 
 if __name__ == "__main__":
     test_next_move()
+    test_transposition_table()
     test_two_clever_players()
+    test_two_clever_players_bounded()
+    test_solved_table()
     test_three_clever_players()
     test_three_clever_biased_players()
+    test_three_clever_players_pruned()
+    test_move_ordering()
+    test_iterative_deepening()
+    test_run_steps()
+    test_answer_cache()
+    test_symmetric_players()
+    test_draw_dependencies()
+    test_parallel_search()
+    test_worker_path()
+    test_mcts_player()
     test_three_clever_players_of_all_types()
     test_four_clever_players()
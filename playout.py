@@ -0,0 +1,977 @@
+from typing import Dict, List, Set, Tuple
+from random import Random, randrange
+from time import perf_counter
+from cards import Cards, ShakeDownCache
+import numpy as np
+import sys
+
+class PlayoutResult:
+    """
+    The results of a batch of random games: how many each player won,
+    how many were drawn, the total number of requests, and how long
+    they took to play.
+    """
+    def __init__(self, number_of_players: int):
+        self.number_of_players = number_of_players
+        self.wins = [0] * number_of_players
+        self.draws = 0
+        self.moves = 0
+        self.abandoned = 0
+        self.elapsed = 0.0
+
+    @property
+    def games(self) -> int:
+        return sum(self.wins) + self.draws
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.elapsed if self.elapsed else 0.0
+
+    def add(self, result: int, moves: int):
+        if result < 0:
+            self.draws += 1
+        else:
+            self.wins[result] += 1
+        self.moves += moves
+
+    def __str__(self):
+        games = self.games
+        mean_length = self.moves / games if games else 0.0
+        wins = " ".join(f"{wins / games:.3f}" if games else "-" for wins in self.wins)
+        draws = f"{self.draws / games:.3f}" if games else "-"
+        abandoned = f", {self.abandoned} abandoned" if self.abandoned else ""
+        return (f"{games} games in {self.elapsed:.2f} seconds "
+            f"({self.games_per_second:.0f} games/s), mean length {mean_length:.1f} moves, "
+            f"wins {wins}, draws {draws}{abandoned}")
+
+class PlayoutEngine:
+    """
+    Plays complete random games, as between RandomPlayers, at high speed
+    and without printing anything.
+
+    Each state of the game is a small integer, standing for the position
+    after the last player's move, as recorded in the history of a game.
+    When a state is first reached, we work out the mask of suits the
+    player to move may ask for, and so every (other, suit) request a
+    RandomPlayer could make. Each request has two slots in the state's
+    list of successors, one for each answer, and an answer that is
+    forced fills both. One uniform choice from the list then picks the
+    request and the answer with the same odds as a RandomPlayer.
+
+    Slots are filled the first time they are chosen, by making the move
+    on a copy of the cards, which we keep until every slot of the state
+    is filled. After that a game is nothing but lookups in the table,
+    and a set of the keys of the states seen, to spot a draw by
+    repetition. A state's key is the exact key of its cards, with the
+    last player, which Cards keeps up to date as the cards change.
+
+    A successor of zero or more is the index of the next state, and a
+    negative successor -1 - winner is a win.
+
+    Once the table holds max_states states, a game that leaves it is
+    played out directly on a copy of the cards, as by RandomPlayers,
+    adding nothing to the table. So the table keeps the states near the
+    start, which most games pass through. With four or more players,
+    random games wander through far more states than we could hope to
+    keep, and so rarely meet one twice that by default we keep no table
+    at all, and play every game directly.
+
+    With five or more players, the shake down does not foresee every
+    inconsistency, and a request can turn out to have no consistent
+    answer. Games as between RandomPlayers would fail there, so we
+    abandon them, and count them as such.
+    """
+    def __init__(self, number_of_players: int, seed: int = None, max_states: int = None,
+            shake_down_cache_size = 0):
+        """
+        By default max_states is 200000 with two or three players, and
+        zero with more. The table always holds the start. By default we
+        do not cache shake downs, as the table or the randomness of the
+        games means we rarely shake down the same cards twice.
+        """
+        self.number_of_players = number_of_players
+        if max_states is None:
+            max_states = 200000 if number_of_players <= 3 else 0
+        self.max_states = max(1, max_states)
+        self.direct_moves = 0
+        self._random = Random(randrange(1 << 32) if seed is None else seed)
+        self._shake_down_cache = (ShakeDownCache(shake_down_cache_size)
+            if shake_down_cache_size > 0 else None)
+        self.clear()
+
+    def clear(self):
+        """
+        Throws away the table of states, apart from the start
+        """
+        # For each state, its key and its list of successors, with None in
+        # the slots not yet filled. While any are empty we keep the cards,
+        # the player to move and their mask of legal suits. The start is
+        # state zero, with the last move notionally made by the last player.
+        self._index: Dict[int, int] = {}
+        self._keys: List[int] = []
+        self._successors: List[List[int]] = []
+        self._pending: Dict[int, Tuple[Cards, int, int]] = {}
+        n = self.number_of_players
+        cards = Cards(n)
+        cards.shake_down_cache = self._shake_down_cache
+        self._add_state(cards, n - 1)
+
+    def __len__(self):
+        return len(self._successors)
+
+    def __str__(self):
+        return (f"PlayoutEngine(players={self.number_of_players} states={len(self)} "
+            f"complete={len(self) - len(self._pending)} direct_moves={self.direct_moves})")
+
+    def legal_suits(self, cards: Cards, this: int) -> int:
+        """
+        Returns the mask of suits this player may ask for
+        """
+        hand = cards.hands[this]
+        mask = 0
+        for suit in range(self.number_of_players):
+            if hand.is_legal(suit):
+                mask |= 1 << suit
+        return mask
+
+    def play(self) -> Tuple[int, int]:
+        """
+        Plays one random game from the start. Returns the winner, or -1
+        for a draw, or Cards.ILLEGAL_CARDS if it was abandoned, and the
+        number of requests.
+        """
+        table = self._successors
+        keys = self._keys
+        random = self._random.random
+        seen = set()
+        state = 0
+        moves = 0
+        while True:
+            successors = table[state]
+            slot = int(random() * len(successors))
+            next_state = successors[slot]
+            if next_state is None:
+                next_state, cards, last_player = self._fill(state, slot)
+                if next_state is None:
+                    if cards is None:
+                        return Cards.ILLEGAL_CARDS, moves + 1
+                    return self._play_out(cards, last_player, seen, moves + 1)
+            state = next_state
+            moves += 1
+            if state < 0:
+                return -1 - state, moves
+            key = keys[state]
+            if key in seen:
+                return -1, moves
+            seen.add(key)
+
+    def _play_out(self, cards: Cards, last_player: int, seen: Set[int],
+            moves: int) -> Tuple[int, int]:
+        """
+        Plays the rest of a game directly on the cards, which are ours to
+        change, after last_player has made the given number of moves.
+        Returns the same as play.
+        """
+        n = self.number_of_players
+        random = self._random.random
+        start = moves
+        try:
+            while True:
+                key = cards.exact_key() * n + last_player
+                if key in seen:
+                    return -1, moves
+                seen.add(key)
+
+                this = cards.next_player(last_player)
+                hand = cards.hands[this]
+                suits = [suit for suit in range(n) if hand.is_legal(suit)]
+                other, suit = divmod(int(random() * (n - 1) * len(suits)), len(suits))
+                other = (this + 1 + other) % n
+                suit = suits[suit]
+                forced, has = cards.has_card(suit, other, this)
+                if not forced:
+                    has = random() < 0.5
+                if has:
+                    cards.transfer(suit, other, this, False)
+                else:
+                    cards.no_transfer(suit, other, this, False)
+                moves += 1
+                winner = cards.test_winner(this)
+                if winner != Cards.NO_WINNER:
+                    return winner, moves
+                last_player = this
+        finally:
+            self.direct_moves += moves - start
+
+    def run(self, games: int) -> PlayoutResult:
+        """
+        Plays the given number of random games, and returns the results,
+        including the number of games played per second. Abandoned games
+        are counted, and played again with new cards, unless more are
+        abandoned than were asked for.
+        """
+        result = PlayoutResult(self.number_of_players)
+        play = self.play
+        add = result.add
+        start = perf_counter()
+        played = 0
+        while played < games and result.abandoned <= games:
+            winner, moves = play()
+            if winner == Cards.ILLEGAL_CARDS:
+                result.abandoned += 1
+            else:
+                add(winner, moves)
+                played += 1
+        result.elapsed = perf_counter() - start
+        return result
+
+    def _add_state(self, cards: Cards, last_player: int) -> int:
+        """
+        Returns the index of the state after last_player has moved, adding
+        it if it is new, or None if it is new and the table is full.
+        """
+        key = cards.exact_key() * self.number_of_players + last_player
+        index = self._index.get(key)
+        if index is None and len(self._successors) < self.max_states:
+            index = len(self._successors)
+            this = cards.next_player(last_player)
+            mask = self.legal_suits(cards, this)
+            requests = (self.number_of_players - 1) * bin(mask).count("1")
+            self._index[key] = index
+            self._keys.append(key)
+            self._successors.append([None] * (2 * requests))
+            self._pending[index] = (cards.copy(), this, mask)
+        return index
+
+    def _fill(self, index: int, slot: int) -> Tuple[int, Cards, int]:
+        """
+        Makes the move in the given slot of the given state, and fills in
+        the successor, and the other slot too if the answer is forced.
+        Returns the successor, or if the move leaves the table, None with
+        a copy of the cards after the move and the player who made it. If
+        the cards are left inconsistent, returns None with no cards.
+        """
+        cards, this, mask = self._pending[index]
+        successors = self._successors[index]
+        n = self.number_of_players
+        suits = [suit for suit in range(n) if (mask >> suit) & 1]
+        request, answer = divmod(slot, 2)
+        other, suit = divmod(request, len(suits))
+        other = (this + 1 + other) % n
+        suit = suits[suit]
+
+        forced, has = cards.has_card(suit, other, this)
+        if forced:
+            slots = (slot - answer, slot - answer + 1)
+        else:
+            slots = (slot,)
+            has = answer == 0
+        mark = cards.mark()
+        try:
+            if has:
+                cards.transfer(suit, other, this, False)
+            else:
+                cards.no_transfer(suit, other, this, False)
+            winner = cards.test_winner(this)
+            if winner == Cards.ILLEGAL_CARDS:
+                return None, None, None
+            if winner != Cards.NO_WINNER:
+                next_state = -1 - winner
+            else:
+                next_state = self._add_state(cards, this)
+                if next_state is None:
+                    return None, cards.copy(), this
+        finally:
+            cards.undo(mark)
+
+        for slot in slots:
+            successors[slot] = next_state
+        if None not in successors:
+            del self._pending[index]
+        return next_state, None, None
+
+class BatchPlayout:
+    """
+    Plays many random games in lockstep, as between RandomPlayers, with
+    the hands of every game held in NumPy arrays: the known count of each
+    suit in each hand, the known voids of each hand, and the number of
+    unknown cards in each hand, with the games along the last axis. Each
+    step makes one request in every game still going, tries both answers
+    across the whole batch, and shakes the results down with array
+    operations.
+
+    The shake down follows Cards._shake_down rule for rule, including the
+    worklist of suits and hands still to be shaken down, which decides the
+    order the rules are applied in and so which voids are left behind in
+    hands that become fully known. Those voids are part of the position,
+    and so matter to draws by repetition. If neither answer is consistent,
+    or a game runs for max_moves, the game is abandoned, counted as such,
+    and played again in a later batch.
+
+    Positions are compared by a 64-bit Zobrist hash of the hands and the
+    last player, so a draw by repetition could in principle be a hash
+    collision. Each game keeps the hashes it has seen in a small open
+    addressing hash set, a row of an array, so spotting a repeat costs
+    about the same however long the game has gone on.
+
+    With two or three players, the PlayoutEngine is faster once warmed
+    up, as its table soon holds every state. With four or more there are
+    far too many states to table, and the batch is many times faster.
+    """
+    def __init__(self, number_of_players: int, seed: int = None, batch_size: int = 16384,
+            max_moves: int = 256):
+        """
+        The hash sets take 16 to 32 bytes per game for each of max_moves,
+        so by default a batch needs about 64 MB. Smaller batches are
+        slower, as the shake down then spends more of its time going round
+        for the few games with something left to deduce.
+        """
+        self.number_of_players = number_of_players
+        self.batch_size = batch_size
+        self.max_moves = max_moves
+        self._rng = np.random.default_rng(seed)
+
+        # random keys for every count of every suit in every hand, every
+        # void, every number of unknowns and every last player
+        n = number_of_players
+        keys = np.random.default_rng(0).integers(0, np.iinfo(np.uint64).max,
+            size = n * n * 6 + n * 5 + n, dtype = np.uint64, endpoint = True)
+        self._count_keys = keys[:n * n * 5].reshape(n, n, 5)
+        self._void_keys = keys[n * n * 5:n * n * 6].reshape(n, n)
+        self._unknown_keys = keys[n * n * 6:n * n * 6 + n * 5].reshape(n, 5)
+        self._player_keys = keys[n * n * 6 + n * 5:]
+
+    def __str__(self):
+        return (f"BatchPlayout(players={self.number_of_players} batch_size={self.batch_size} "
+            f"max_moves={self.max_moves})")
+
+    def run(self, games: int) -> PlayoutResult:
+        """
+        Plays the given number of random games, a batch at a time, and
+        returns the results, including the number of games played per
+        second. Abandoned games are counted, and played again in a later
+        batch, unless more are abandoned than were asked for.
+        """
+        result = PlayoutResult(self.number_of_players)
+        start = perf_counter()
+        while result.games < games and result.abandoned <= games:
+            self._run_batch(min(self.batch_size, games - result.games), result)
+        result.elapsed = perf_counter() - start
+        return result
+
+    def _run_batch(self, games: int, result: PlayoutResult):
+        """
+        Plays a batch of games from the start, adding them to the result.
+        Finished games are dropped from the arrays as we go.
+        """
+        n = self.number_of_players
+        rng = self._rng
+
+        # The cards of each game are a tuple of arrays, indexed by hand,
+        # suit and game: the known counts, the voids, the number of unknown
+        # cards, and the suits and hands still to be shaken down, as in
+        # Cards. Only the first two have a suit axis.
+        cards = (np.zeros((n, n, games), dtype = np.int8), np.zeros((n, n, games), dtype = bool),
+            np.full((n, games), 4, dtype = np.int8), np.ones((n, games), dtype = bool),
+            np.ones((n, games), dtype = bool))
+        this = np.zeros(games, dtype = np.intp)
+        wins = np.zeros(n, dtype = np.int64)
+
+        # the hash set of the positions each game has been through, with
+        # room for twice as many as it can see. Finished games keep their
+        # rows, so each game remembers which row is its own.
+        size = 1 << (2 * self.max_moves - 1).bit_length()
+        seen = np.zeros((games, size), dtype = np.uint64)
+        seen_rows = np.arange(games)
+
+        for move in range(self.max_moves):
+            counts, voids, unknowns, _, _ = cards
+            rows = np.arange(len(this))
+
+            # choose the request, from the suits this player may ask for
+            legal = counts[this, :, rows] > 0
+            legal |= (unknowns[this, rows] > 0)[:, None] & ~voids[this, :, rows]
+            choice = (rng.random(len(rows)) * legal.sum(1, dtype = np.int8)).astype(np.intp)
+            suit = np.argmax(np.cumsum(legal, 1) > choice[:, None], 1)
+            other = (this + 1 + rng.integers(0, n - 1, len(rows))) % n
+            before = [(counts[player, :, rows].copy(), voids[player, :, rows].copy(),
+                unknowns[player, rows].copy()) for player in (this, other)]
+
+            # asking for the suit means we must have one
+            need = counts[this, suit, rows] == 0
+            counts[this, suit, rows] += need
+            unknowns[this, rows] -= need
+            emptied = need & (unknowns[this, rows] == 0)
+            voids[this[emptied], :, rows[emptied]] = False
+
+            # try both answers, and see which are consistent
+            yes = tuple(array.copy() for array in cards)
+            yes_ok = self._give(yes, this, other, suit)
+            no_ok = counts[other, suit, rows] == 0
+            voids[other, suit, rows] = True
+            for answer in (yes, cards):
+                for player, old in zip((this, other), before):
+                    self._track(answer, player, suit, old)
+
+            # shake both answers down together, as one batch twice the size
+            both = tuple(np.concatenate(answers, -1) for answers in zip(yes, cards))
+            consistent = self._shake_down(both)
+            games = len(rows)
+            yes_ok &= consistent[:games]
+            no_ok &= consistent[games:]
+            yes = tuple(array[..., :games] for array in both)
+            cards = tuple(array[..., games:] for array in both)
+
+            # choose at random between the consistent answers
+            say_yes = yes_ok & (~no_ok | (rng.random(len(rows)) < 0.5))
+            cards = tuple(np.where(say_yes, chosen, array) for chosen, array in zip(yes, cards))
+            counts, voids, unknowns, _, _ = cards
+            abandoned = ~yes_ok & ~no_ok
+
+            # test for winners: if everything is known the player who asked
+            # wins, otherwise anybody with four of a kind, starting with them
+            determined = ~(unknowns > 0).any(0)
+            order = (this[:, None] + np.arange(n)) % n
+            fours = (counts == 4).any(1)[order, rows[:, None]]
+            winner = np.where(determined, this,
+                np.where(fours.any(1), order[rows, np.argmax(fours, 1)], -1))
+            winner[abandoned] = -1
+            won = winner >= 0
+            wins += np.bincount(winner[won], minlength = n)
+
+            # a repeated position is a draw
+            key = self._keys(counts, voids, unknowns, this)
+            drawn = ~won & ~abandoned & self._repeated(seen, seen_rows, key)
+
+            finished = won | drawn | abandoned
+            result.draws += int(drawn.sum())
+            result.abandoned += int(abandoned.sum())
+            result.moves += (move + 1) * int((won | drawn).sum())
+
+            # the next player is the next with any cards
+            going = ~finished
+            cards = tuple(array[..., going] for array in cards)
+            counts, _, unknowns, _, _ = cards
+            seen_rows, this = seen_rows[going], this[going]
+            if not len(this):
+                break
+            rows = np.arange(len(this))
+            order = (this[:, None] + 1 + np.arange(n)) % n
+            has_cards = ((counts.sum(1, dtype = np.int8) + unknowns) > 0)[order, rows[:, None]]
+            this = order[rows, np.argmax(has_cards, 1)]
+
+        result.abandoned += len(this)
+        for player in range(n):
+            result.wins[player] += int(wins[player])
+
+    @staticmethod
+    def _repeated(seen: np.ndarray, rows: np.ndarray, key: np.ndarray) -> np.ndarray:
+        """
+        Adds each game's key to its hash set, the given row of seen, where
+        zero marks an empty slot. Returns which games had seen it before.
+        We probe slots in turn from the one the key hashes to, so the few
+        games that collide take a few more rounds.
+        """
+        key = np.maximum(key, np.uint64(1))
+        mask = seen.shape[1] - 1
+        slot = (key & np.uint64(mask)).astype(np.intp)
+        repeated = np.zeros(len(key), dtype = bool)
+        probing = np.arange(len(key))
+        while len(probing):
+            found = seen[rows[probing], slot[probing]]
+            match = found == key[probing]
+            empty = found == 0
+            repeated[probing[match]] = True
+            added = probing[empty]
+            seen[rows[added], slot[added]] = key[added]
+            probing = probing[~match & ~empty]
+            slot[probing] = (slot[probing] + 1) & mask
+        return repeated
+
+    def _give(self, cards, this: np.ndarray, other: np.ndarray, suit: np.ndarray) -> np.ndarray:
+        """
+        The other player hands a card of the suit to this player, in every
+        game. Returns whether they could.
+        """
+        counts, voids, unknowns, _, _ = cards
+        rows = np.arange(len(this))
+        known = counts[other, suit, rows] > 0
+        ok = known | (~voids[other, suit, rows] & (unknowns[other, rows] > 0))
+        unknown = ok & ~known
+        counts[other, suit, rows] -= known
+        unknowns[other, rows] -= unknown
+        emptied = unknown & (unknowns[other, rows] == 0)
+        voids[other[emptied], :, rows[emptied]] = False
+        counts[this, suit, rows] += ok
+        return ok
+
+    def _track(self, cards, player: np.ndarray, suit: np.ndarray, old):
+        """
+        Marks the hand of the player in each game, and any suits whose
+        tallies have changed, as needing to be shaken down, as Cards._track
+        does. Pass in the hands before the change, indexed by game and
+        suit, and the suit whose known cards may have changed.
+        """
+        counts, voids, unknowns, dirty_suits, dirty_hands = cards
+        old_counts, old_voids, old_unknowns = old
+        rows = np.arange(len(player))
+        new_voids = voids[player, :, rows]
+        new_unknowns = unknowns[player, rows]
+        changed_counts = (counts[player, :, rows] != old_counts).any(1)
+        dirty_hands[player, rows] |= (changed_counts | (new_voids != old_voids).any(1)
+            | (new_unknowns != old_unknowns))
+        dirty_suits[suit, rows] |= changed_counts
+        had_unknowns = (old_unknowns > 0)[:, None]
+        dirty_suits |= np.where((new_unknowns == old_unknowns)[:, None],
+            (old_voids ^ new_voids) & had_unknowns,
+            (~old_voids & had_unknowns) | (~new_voids & (new_unknowns > 0)[:, None])).T
+
+    def _fill(self, cards, amount: np.ndarray):
+        """
+        Turns the given number of unknown cards in each hand into each
+        suit, as Cards._fill_some_unknowns does. The amounts are indexed
+        like the counts. This leaves the voids alone.
+        """
+        counts, voids, unknowns, dirty_suits, dirty_hands = cards
+        filled = amount > 0
+        filled_hands = filled.any(1)
+        counts += amount
+        unknowns -= amount.sum(1, dtype = np.int8)
+        dirty_hands |= filled_hands
+        dirty_suits |= (filled_hands[:, None] & ~voids).any(0) | filled.any(0)
+
+    def _kill(self, cards, kill: np.ndarray):
+        """
+        Records that the given hands have none of the given suits, indexed
+        like the voids, as Cards._kill_unknown does
+        """
+        _, voids, _, dirty_suits, dirty_hands = cards
+        voids |= kill
+        dirty_hands |= kill.any(1)
+        dirty_suits |= kill.any(0)
+
+    def _first(self, acting: np.ndarray):
+        """
+        Given which suits of each game a rule acts on, returns which suits
+        come up to and including the first it acts on, and which come after
+        it. Cards applies such rules a suit at a time, and once a rule has
+        filled in some cards, the later suits must see the change, so we
+        apply the rule to all the suits up to the first it acts on, and
+        then go round again for those after.
+        """
+        n = self.number_of_players
+        first = np.where(acting.any(0), np.argmax(acting, 0), n)
+        suits = np.arange(n)[:, None]
+        return suits <= first, suits > first
+
+    def _in_suit_order(self, rule, cards, pending: np.ndarray, *extra):
+        """
+        Applies a rule that Cards applies a suit at a time to the pending
+        suits of every game, in place. The rule is given the hands, the
+        pending suits and any extra arrays indexed by game, acts on the
+        pending suits up to the first it changes, and returns which games
+        are consistent, which have changed and which suits are still
+        pending. Only the games with suits still pending go round again,
+        gathered into smaller arrays. Returns which games are consistent,
+        and which have changed.
+        """
+        ok, changes, pending = rule(cards, pending, *extra)
+        games = np.flatnonzero(pending.any(0))
+        pending = pending[:, games]
+        while len(games):
+            subset = tuple(array[..., games] for array in cards)
+            consistent, changed, pending = rule(subset, pending,
+                *(array[..., games] for array in extra))
+            for array, shaken in zip(cards, subset):
+                array[..., games] = shaken
+            ok[games] &= consistent
+            changes[games] |= changed
+            again = pending.any(0)
+            games, pending = games[again], pending[:, again]
+        return ok, changes
+
+    def _fill_suits(self, cards, pending: np.ndarray):
+        """
+        Kills the suits whose cards are all known, and fills in those whose
+        missing cards just fit their open slots or only fit in one hand, as
+        Cards._shake_down does, for use with _in_suit_order
+        """
+        counts, voids, unknowns, _, _ = cards
+        changes = np.zeros(counts.shape[-1], dtype = bool)
+        total = counts.sum(0, dtype = np.int8)
+        live = pending & (total > 0)
+        open_hands = (unknowns > 0)[:, None] & ~voids
+        remainder = 4 - total
+        slots = (unknowns[:, None] * open_hands).sum(0, dtype = np.int8)
+        partial = live & (total < 4)
+        failed = live & ((total > 4) | (partial & (slots < remainder)))
+        fits = partial & (slots == remainder)
+        alone = partial & (slots > remainder) & (open_hands.sum(0, dtype = np.int8) == 1)
+        upto, after = self._first(failed | fits | alone)
+        ok = ~(failed & upto).any(0)
+        full = open_hands & (live & (total == 4) & upto & ok)
+        if full.any():
+            self._kill(cards, full)
+            changes |= full.any((0, 1))
+        amount = np.where(open_hands & ((fits | alone) & upto & ok),
+            np.where(fits, unknowns[:, None], remainder), 0).astype(np.int8)
+        if amount.any():
+            self._fill(cards, amount)
+            changes |= amount.any((0, 1))
+        return ok, changes, pending & after & ok
+
+    def _fill_short_suits(self, cards, pending: np.ndarray, totals: np.ndarray):
+        """
+        Fills in the cards of suits with few known cards that only one hand
+        has room for, as Cards._shake_down does, for use with
+        _in_suit_order. Pass in the known cards of each suit from the start
+        of the pass.
+        """
+        counts, voids, unknowns, _, _ = cards
+        changes = np.zeros(counts.shape[-1], dtype = bool)
+        slots = (unknowns[:, None] * ((unknowns > 0)[:, None] & ~voids)).sum(0,
+            dtype = np.int8)
+        amount = np.where(pending & ~voids,
+            np.maximum(totals - (slots - unknowns[:, None]), 0), 0)
+        upto, after = self._first((amount > 0).any(0))
+        amount = np.where(upto, amount, 0)
+        ok = (amount <= unknowns[:, None]).all((0, 1))
+        amount = np.where(ok, amount, 0).astype(np.int8)
+        if amount.any():
+            self._fill(cards, amount)
+            changes |= amount.any((0, 1))
+        return ok, changes, pending & after & ok
+
+    def _shake_down(self, cards) -> np.ndarray:
+        """
+        Applies the shake down rules to every game, in place, as
+        Cards._shake_down does, driven by the suits and hands still to be
+        shaken down in each game. Returns which games are consistent.
+
+        Each pass only works on the games that still have something to
+        shake down, gathered into smaller arrays. Once a game is found to
+        be inconsistent, we stop changing its hands.
+        """
+        ok = np.ones(cards[0].shape[-1], dtype = bool)
+        active = np.flatnonzero(cards[3].any(0) | cards[4].any(0))
+        while len(active):
+            subset = tuple(array[..., active] for array in cards)
+            consistent = self._shake_down_pass(subset)
+            for array, changed in zip(cards, subset):
+                array[..., active] = changed
+            ok[active] = consistent
+            active = active[consistent & (subset[3].any(0) | subset[4].any(0))]
+        return ok
+
+    def _shake_down_pass(self, cards) -> np.ndarray:
+        """
+        One pass of Cards._shake_down over games that all have something
+        to shake down. Returns which games are consistent so far.
+        """
+        counts, voids, unknowns, dirty_suits, dirty_hands = cards
+        n = self.number_of_players
+        suits = dirty_suits.copy()
+        players = dirty_hands.copy()
+
+        # If we know the whereabouts of four cards of a suit, none of the
+        # unknowns are of that suit. If the rest of a suit just fit its
+        # open slots, or only fit in one hand, fill them in.
+        ok, changes = self._in_suit_order(self._fill_suits, cards, suits.copy())
+
+        # If the unknowns in a hand can only be of one suit, they are. If
+        # they cannot be of any suit, the cards are inconsistent.
+        check = players & (unknowns > 0) & ok
+        choices = (~voids).sum(1, dtype = np.int8)
+        ok &= ~(check & (choices == 0)).any(0)
+        forced = check & (choices == 1) & ok
+        if forced.any():
+            only = np.argmax(~voids, 1)
+            dirty_suits |= (forced[:, None] & ~voids).any(0)
+            dirty_hands |= forced
+            for suit in range(n):
+                counts[:, suit] += np.where(forced & (only == suit), unknowns, 0).astype(np.int8)
+            unknowns[forced] = 0
+            voids &= ~forced[:, None]
+            changes |= forced.any(0)
+
+        # Only the games where nothing has changed go on to the other
+        # rules, so we gather them into smaller arrays again
+        waiting = np.flatnonzero(ok & ~changes)
+        if len(waiting):
+            subset = tuple(array[..., waiting] for array in cards)
+            consistent, changed = self._shake_down_further(subset, suits[:, waiting],
+                players[:, waiting])
+            for array, shaken in zip(cards, subset):
+                array[..., waiting] = shaken
+            ok[waiting] = consistent
+            changes[waiting] = changed
+
+        # If nothing changed, there is nothing more to deduce from the
+        # suits and hands that were waiting
+        settled = ~changes | ~ok
+        dirty_suits[:, settled] = False
+        dirty_hands[:, settled] = False
+        return ok
+
+    def _shake_down_further(self, cards, suits: np.ndarray, players: np.ndarray):
+        """
+        The rest of a pass of Cards._shake_down, over games where the
+        cheaper rules changed nothing, given the suits and hands that were
+        to be shaken down. Returns which games are consistent, and which
+        have changed.
+        """
+        counts, voids, unknowns, dirty_suits, dirty_hands = cards
+        n = self.number_of_players
+        ok = np.ones(counts.shape[-1], dtype = bool)
+        changes = np.zeros(counts.shape[-1], dtype = bool)
+        waiting = ok.copy()
+
+        # If all the unknowns are in one hand, they are whatever is left
+        totals = counts.sum(0, dtype = np.int8)
+        last = waiting & players.any(0) & ((unknowns > 0).sum(0, dtype = np.int8) == 1)
+        if last.any():
+            games = np.flatnonzero(last)
+            hand = np.argmax(unknowns[:, games] > 0, 0)
+            missing = (4 - totals[:, games]).T
+            ok[games] &= ((missing >= 0).all(1)
+                & (missing.sum(1, dtype = np.int8) == unknowns[hand, games])
+                & ~(voids[hand, :, games] & (missing > 0)).any(1))
+            filled = ok[games]
+            games, hand, missing = games[filled], hand[filled], missing[filled]
+            dirty_suits[:, games] |= (~voids[hand, :, games] | (missing > 0)).T
+            dirty_hands[hand, games] = True
+            counts[hand, :, games] += missing.astype(np.int8)
+            unknowns[hand, games] = 0
+            changes |= last
+            waiting &= ~last
+
+        # A hand with several unknowns must hold enough of each suit that
+        # the other suits it could hold cannot make up the rest
+        room = np.where(~voids & (totals < 4), 4 - totals, 0)
+        possible = room.sum(1, dtype = np.int8)
+        several = waiting & (unknowns > 1) & (players | (suits & ~voids).any(1))
+        ok &= ~(several & (possible < unknowns)).any(0)
+        amount = np.where(several[:, None] & (room > 0),
+            np.maximum(unknowns[:, None] - (possible[:, None] - room), 0), 0)
+        ok &= (amount.sum(1, dtype = np.int8) <= unknowns).all(0)
+        amount = np.where(ok, amount, 0).astype(np.int8)
+        if amount.any():
+            self._fill(cards, amount)
+            changes |= amount.any((0, 1))
+        waiting &= ok & ~changes
+
+        # If the open slots of a suit, less those of one hand, are fewer
+        # than its known cards, that hand must make up the difference.
+        # Like Cards, we only look at suits with two known cards or fewer.
+        consistent, changed = self._in_suit_order(self._fill_short_suits, cards,
+            waiting & suits & (totals <= 2), totals)
+        ok &= consistent
+        changes |= changed
+        waiting &= ok & ~changes
+
+        # If several hands can only hold the same group of suits, and the
+        # missing cards of the group just fill their unknowns, no other
+        # hand holds any of the group. Each hand stands for its group, so
+        # a group is dealt with as often as it has members, to the same
+        # effect.
+        grouped = waiting & (unknowns > 0) & ((~voids).sum(1, dtype = np.int8) <= n - 2)
+        games = np.flatnonzero((grouped.sum(0) > 1))
+        if len(games):
+            subset = tuple(array[..., games] for array in cards)
+            consistent, killed = self._shake_down_groups(subset, grouped[:, games],
+                suits[:, games], players[:, games], totals[:, games])
+            for array, shaken in zip(cards, subset):
+                array[..., games] = shaken
+            ok[games] &= consistent
+            changes[games] |= killed
+        return ok, changes
+
+    def _shake_down_groups(self, cards, grouped: np.ndarray, suits: np.ndarray,
+            players: np.ndarray, totals: np.ndarray):
+        """
+        The group rule of _shake_down_further, over the games where several
+        hands could share a group. Returns which games are consistent, and
+        which have changed.
+        """
+        _, voids, unknowns, _, _ = cards
+        group = ~voids
+        masks = (voids << np.arange(self.number_of_players, dtype = np.uint8)[:, None]).sum(1,
+            dtype = np.uint8)
+        members = grouped[:, None] & grouped & (masks[:, None] == masks)
+        shared = grouped & (members.sum(1, dtype = np.int8) > 1)
+        shared &= (group & suits).any(1) | (members & players).any(1)
+        holes = (unknowns * members).sum(1, dtype = np.int8)
+        absent = ((4 - totals) * group).sum(1, dtype = np.int8)
+        ok = ~(shared & (absent < holes)).any(0)
+        exact = shared & (absent == holes) & ok
+        kill = (exact[:, None, None] & group[:, None] & ~members[:, :, None]).any(0)
+        kill &= (unknowns > 0)[:, None] & group
+        if kill.any():
+            self._kill(cards, kill)
+        return ok, kill.any((0, 1))
+
+    def _keys(self, counts: np.ndarray, voids: np.ndarray, unknowns: np.ndarray,
+            this: np.ndarray) -> np.ndarray:
+        """
+        Returns the Zobrist hash of the hands in each game, after this
+        player's move
+        """
+        n = self.number_of_players
+        key = self._player_keys[this]
+        for hand in range(n):
+            key += self._unknown_keys[hand][unknowns[hand]]
+            for suit in range(n):
+                key += self._count_keys[hand, suit][counts[hand, suit]]
+                key += np.where(voids[hand, suit], self._void_keys[hand, suit], np.uint64(0))
+        return key
+
+def test_playout_engine():
+    """
+    Play random three and four player games with the engine, and as
+    RandomPlayers through the game itself. The engine should be repeatable
+    given a seed, and find roughly the same share of wins and draws, in
+    games of about the same length. With three players it should be more
+    than twice as fast once warmed up, and with four, where it plays the
+    games directly, it should still be faster. (We take the best of two
+    runs of each, as the timings are noisy.)
+    """
+    from player import RandomPlayer
+    from game import play, BufferedLog
+    import random
+
+    def as_random_players(number_of_players: int, games: int) -> PlayoutResult:
+        result = PlayoutResult(number_of_players)
+        start = perf_counter()
+        for _ in range(games):
+            log = BufferedLog()
+            result.add(play([RandomPlayer() for _ in range(number_of_players)], log),
+                len(log.moves()))
+        result.elapsed = perf_counter() - start
+        return result
+
+    random.seed(1)
+    for number_of_players, warm_up, games, speed_up in ((3, 20000, 20000, 2), (4, 0, 3000, 1)):
+        engine = PlayoutEngine(number_of_players, seed = 1)
+        first = engine.run(2000)
+        print(first)
+        again = PlayoutEngine(number_of_players, seed = 1).run(2000)
+        assert (again.wins, again.draws, again.moves) == (first.wins, first.draws, first.moves)
+
+        # once the common states are filled in, it should fly
+        engine.run(warm_up)
+        fast = max((engine.run(games) for _ in range(2)), key = lambda r: r.games_per_second)
+        print(fast)
+        print(engine)
+        assert fast.games == games
+
+        slow = max((as_random_players(number_of_players, 300) for _ in range(2)),
+            key = lambda r: r.games_per_second)
+        print(f"as RandomPlayers: {slow}")
+        assert fast.games_per_second > speed_up * slow.games_per_second
+        for wins, slow_wins in zip(fast.wins + [fast.draws], slow.wins + [slow.draws]):
+            assert abs(wins / fast.games - slow_wins / slow.games) < 0.1
+        assert abs(fast.moves / fast.games - slow.moves / slow.games) < 1.5
+    print("----------------")
+    print()
+
+def test_batch_playout():
+    """
+    Play random three player games in a batch. The batch should be
+    repeatable given a seed, abandon no games, and find roughly the same
+    share of wins and draws as the engine, in games of about the same
+    length. Any games abandoned with more players should be made up.
+    """
+    first = BatchPlayout(3, seed = 1, batch_size = 5000).run(10000)
+    print(first)
+    again = BatchPlayout(3, seed = 1, batch_size = 5000).run(10000)
+    assert (again.wins, again.draws, again.moves) == (first.wins, first.draws, first.moves)
+    assert first.games == 10000 and first.abandoned == 0
+
+    engine = PlayoutEngine(3, seed = 1)
+    exact = engine.run(20000)
+    print(f"with the engine: {exact}")
+    for wins, exact_wins in zip(first.wins + [first.draws], exact.wins + [exact.draws]):
+        assert abs(wins / first.games - exact_wins / exact.games) < 0.03
+    assert abs(first.moves / first.games - exact.moves / exact.games) < 0.5
+
+    # with five players, the odd game has no consistent answer, and is
+    # played again
+    abandoning = BatchPlayout(5, seed = 3, batch_size = 2000).run(2000)
+    print(abandoning)
+    assert abandoning.games == 2000 and abandoning.abandoned > 0
+    print("----------------")
+    print()
+
+def test_batch_shake_down():
+    """
+    Collect the cards after both answers to random requests in random
+    games, before they are shaken down, and shake them all down with
+    the batch and with Cards. They should agree exactly on which are
+    consistent, and on every count, void and unknown of those that are.
+    """
+    for n in (2, 3, 4, 5):
+        random = Random(n)
+        states = []
+        for _ in range(100):
+            cards = Cards(n)
+            this = 0
+            for _ in range(100):
+                other, suit = random.choice(cards.legal_moves(this))
+                for has in (True, False):
+                    answered = cards.copy()
+                    if has:
+                        ok = answered.transfer(suit, other, this, True)
+                    else:
+                        ok = answered.no_transfer(suit, other, this, True)
+                    if ok:
+                        states.append(answered)
+                forced, has = cards.has_card(suit, other, this)
+                if not forced:
+                    has = random.random() < 0.5
+                if has:
+                    cards.transfer(suit, other, this, False)
+                else:
+                    cards.no_transfer(suit, other, this, False)
+                if cards.test_winner(this) != Cards.NO_WINNER:
+                    break
+                this = cards.next_player(this)
+
+        def arrays():
+            games = len(states)
+            result = (np.zeros((n, n, games), dtype = np.int8),
+                np.zeros((n, n, games), dtype = bool), np.zeros((n, games), dtype = np.int8),
+                np.zeros((n, games), dtype = bool), np.zeros((n, games), dtype = bool))
+            counts, voids, unknowns, dirty_suits, dirty_hands = result
+            for game, cards in enumerate(states):
+                for player, hand in enumerate(cards.hands):
+                    unknowns[player, game] = hand.number_of_unknown_cards
+                    dirty_suits[player, game] = (cards._dirty_suits >> player) & 1
+                    dirty_hands[player, game] = (cards._dirty_hands >> player) & 1
+                    for suit in range(n):
+                        counts[player, suit, game] = hand.count(suit)
+                        voids[player, suit, game] = hand.is_void(suit)
+            return result
+
+        batch = arrays()
+        ok = BatchPlayout(n)._shake_down(batch)
+        expected = np.array([cards.shake_down() for cards in states])
+        assert np.array_equal(ok, expected)
+        for shaken, exact in zip(batch[:3], arrays()[:3]):
+            assert np.array_equal(shaken[..., ok], exact[..., ok])
+        print(f"{n} players: {len(states)} states, {int((~ok).sum())} inconsistent")
+    print("test_batch_shake_down: succeeded")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        # play the given number of games with the given number of players,
+        # in a batch if asked for
+        if len(sys.argv) > 3 and sys.argv[3] == "batch":
+            print(BatchPlayout(int(sys.argv[1])).run(int(sys.argv[2])))
+        else:
+            engine = PlayoutEngine(int(sys.argv[1]))
+            print(engine.run(int(sys.argv[2])))
+            print(engine)
+    else:
+        test_playout_engine()
+        test_batch_playout()
+        test_batch_shake_down()
@@ -0,0 +1,294 @@
+from typing import Dict, List, Tuple
+from cards import Cards, ShakeDownCache, PositionCache
+from player import CleverPlayer, TranspositionTable, SolvedTable, rank_result
+from game import play
+from time import perf_counter
+import os
+import sys
+
+class RetrogradeSolver:
+    """
+    Solves every position of a game with a given number of players,
+    rather than searching forward from the positions that are reached.
+
+    First we enumerate every canonical position that can be reached from
+    the start, together with the moves and answers that link them. Then
+    we work backwards from the positions where somebody wins, resolving
+    a position once its result no longer depends on anything unresolved.
+    Anything still unresolved at the end can be kept going for ever, and
+    is a draw.
+
+    Unlike CleverPlayer, the results do not depend on the history, so a
+    draw is a draw however we got there. The table of best moves can be
+    saved as a SolvedTable, which any CleverPlayer with the same
+    preferences can then use.
+    """
+    def __init__(self, number_of_players: int, preferences = None,
+            shake_down_cache_size = 100000, position_cache_size = 100000):
+        """
+        If preferences is specified, it states who each of the players
+        wants to win, as for CleverPlayer.
+        """
+        self.number_of_players = number_of_players
+        self.preferences = preferences
+        self._shake_down_cache = (ShakeDownCache(shake_down_cache_size)
+            if shake_down_cache_size > 0 else None)
+        self._position_cache = (PositionCache(position_cache_size)
+            if position_cache_size > 0 else None)
+
+        # For each state, indexed in the order we found them: its
+        # canonical position, the player to move, and their moves. Each
+        # move is (other_c, suit_c, answers), with other_c and suit_c
+        # relative to the player to move, as in a TranspositionTable. The
+        # answers are a tuple of (has, outcome) for each legal answer,
+        # yes before no. An outcome of zero or more is the index of the
+        # next state, and a negative outcome -1 - winner is a win.
+        self._index: Dict[int, int] = {}
+        self._positions: List[int] = []
+        self._players: List[int] = []
+        self._moves: List[List[Tuple[int, int, Tuple[Tuple[bool, int], ...]]]] = []
+
+        # the result of each state, and its best move, once solved
+        self._results: List[int] = None
+        self._best: List[Tuple[int, int]] = None
+        self.passes = 0
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __str__(self):
+        return (f"RetrogradeSolver(players={self.number_of_players} "
+            f"states={len(self)} passes={self.passes})")
+
+    def solve(self) -> int:
+        """
+        Solves every position reachable from the start. Returns the
+        result of the start position: the winner, or -1 for a draw.
+        """
+        cards = Cards(self.number_of_players)
+        cards.shake_down_cache = self._shake_down_cache
+        cards.position_cache = self._position_cache
+        self._enumerate(cards, 0)
+        self._resolve()
+        return self._results[0]
+
+    def result(self, this: int, cards: Cards) -> int:
+        """
+        Returns the result of the given position with this player to
+        move, or None if it cannot be reached from the start.
+        """
+        _, pos = cards.canonical(this)
+        index = self._index.get(pos)
+        return None if index is None else self._results[index]
+
+    def table(self) -> TranspositionTable:
+        """
+        Returns a TranspositionTable of the best move in every position.
+        """
+        n = self.number_of_players
+        table = TranspositionTable()
+        for index, pos in enumerate(self._positions):
+            this = self._players[index]
+            result = self._results[index]
+            result_c = result if result < 0 else (result - this) % n
+            other_c, suit_c = self._best[index]
+            table.put(pos, (other_c, suit_c, result_c), 0)
+        return table
+
+    def save(self, path: str):
+        """
+        Saves the best move in every position, to be opened as a SolvedTable.
+        """
+        SolvedTable.save(path, self.table(), self.number_of_players, self.preferences)
+
+    def _enumerate(self, cards: Cards, this: int):
+        """
+        Finds every state reachable from the given cards, with this player
+        to move, breadth first. Only the states waiting to be expanded keep
+        a copy of their cards.
+        """
+        self._add_state(cards, this)
+        pending = [(cards.copy(), this)]
+        while pending:
+            next_pending = []
+            for cards, this in pending:
+                self._moves.append(self._expand(cards, this, next_pending))
+            pending = next_pending
+
+    def _add_state(self, cards: Cards, this: int) -> Tuple[int, bool]:
+        """
+        Returns the index of the state with this player to move, and
+        whether it is new.
+        """
+        _, pos = cards.canonical(this)
+        index = self._index.get(pos)
+        if index is not None:
+            return index, False
+        index = len(self._positions)
+        self._index[pos] = index
+        self._positions.append(pos)
+        self._players.append(this)
+        return index, True
+
+    def _expand(self, cards: Cards, this: int, pending) -> List[Tuple[int, int, Tuple[Tuple[bool, int], ...]]]:
+        """
+        Returns the moves from the given state, adding any new states that
+        they lead to onto pending.
+        """
+        n = self.number_of_players
+        permutation, _ = cards.canonical(this)
+        moves = []
+        for other, suit in cards.legal_moves_given_permutation(this, permutation):
+            forced, has = cards.has_card(suit, other, this)
+            answers = []
+            for answer in ((has,) if forced else (True, False)):
+                mark = cards.mark()
+                try:
+                    if answer:
+                        ok = cards.transfer(suit, other, this, True)
+                    else:
+                        ok = cards.no_transfer(suit, other, this, True)
+                    winner = cards.test_winner(this) if ok else Cards.ILLEGAL_CARDS
+                    if winner == Cards.ILLEGAL_CARDS:
+                        continue
+                    if winner != Cards.NO_WINNER:
+                        answers.append((answer, -1 - winner))
+                        continue
+                    next_player = cards.next_player(this)
+                    index, is_new = self._add_state(cards, next_player)
+                    if is_new:
+                        pending.append((cards.copy(), next_player))
+                    answers.append((answer, index))
+                finally:
+                    cards.undo(mark)
+            if answers:
+                moves.append(((other - this) % n, permutation.index(suit), tuple(answers)))
+        assert moves, "A player with cards must have a legal move"
+        return moves
+
+    def _resolve(self):
+        """
+        Works out the result of every state by backward induction. We keep
+        sweeping through the states, latest first, until a sweep resolves
+        nothing more. The rest are draws.
+        """
+        count = len(self._positions)
+        self._results = [None] * count
+        self._best = [None] * count
+        changed = True
+        while changed:
+            changed = False
+            self.passes += 1
+            for index in range(count - 1, -1, -1):
+                if self._results[index] is None:
+                    best = self._best_move(index)
+                    if best is not None:
+                        self._best[index], self._results[index] = best
+                        changed = True
+
+        # Every unresolved state can be kept unresolved for ever, and the
+        # players would prefer that to anything they have not won, so they
+        # are all draws. Now find the moves that keep them drawn.
+        drawn = [index for index in range(count) if self._results[index] is None]
+        for index in drawn:
+            self._results[index] = -1
+        for index in drawn:
+            self._best[index], result = self._best_move(index)
+            assert result == -1
+
+    def _best_move(self, index: int) -> Tuple[Tuple[int, int], int]:
+        """
+        Returns the best move for the player to move in this state, and the
+        result, or None if that depends on states that are not yet solved.
+        Where the player does not mind, we play the first move.
+        """
+        n = self.number_of_players
+        this = self._players[index]
+        preferences = self.preferences
+        unsolved = False
+        best = None
+        best_rank = None
+        for other_c, suit_c, answers in self._moves[index]:
+            result = self._answer((this + other_c) % n, answers)
+            if result is None:
+                unsolved = True
+            elif result == this:
+                return (other_c, suit_c), result
+            else:
+                rank = rank_result(preferences, this, result)
+                if best is None or rank < best_rank:
+                    best, best_rank = ((other_c, suit_c), result), rank
+        return None if unsolved else best
+
+    def _answer(self, responder: int, answers: Tuple[Tuple[bool, int], ...]) -> int:
+        """
+        Returns the result once the responder has chosen their best answer,
+        or None if that depends on states that are not yet solved. Where the
+        responder does not mind, they say no, as CleverPlayer does.
+        """
+        preferences = self.preferences
+        unsolved = False
+        best = None
+        best_rank = None
+        for _, outcome in answers:
+            result = -1 - outcome if outcome < 0 else self._results[outcome]
+            if result is None:
+                unsolved = True
+            elif result == responder:
+                return result
+            else:
+                rank = rank_result(preferences, responder, result)
+                if best is None or rank <= best_rank:
+                    best, best_rank = result, rank
+        return None if unsolved else best
+
+def test_two_player_solver():
+    """
+    Solve every two player position. The start should be a draw, as
+    CleverPlayer finds by searching forward.
+    """
+    start = perf_counter()
+    solver = RetrogradeSolver(2)
+    result = solver.solve()
+    print(f"{solver} solved in {perf_counter() - start} seconds, result={result}")
+    assert result == -1, "test_two_player_solver: expecting a draw"
+    assert solver.result(0, Cards(2)) == -1
+    assert len(solver.table()) == len(solver)
+    print("----------------")
+    print()
+
+def test_three_player_solved_table():
+    """
+    Solve every three player position, save the table, then play a game
+    using it. The players should never need to search as the game goes.
+    """
+    import tempfile
+    start = perf_counter()
+    solver = RetrogradeSolver(3)
+    result = solver.solve()
+    print(f"{solver} solved in {perf_counter() - start} seconds, result={result}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "three.solved")
+        solver.save(path)
+        with SolvedTable(path) as solved:
+            assert len(solved) == len(solver)
+            player = CleverPlayer(1000, 1000, solved_table = solved)
+            start = perf_counter()
+            played = play([player, player, player])
+            print(f"{solved} played in {perf_counter() - start} seconds, result={played}")
+            assert played == result
+            assert solved.misses == 0
+    print("----------------")
+    print()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        # solve the given number of players, and save the table
+        solver = RetrogradeSolver(int(sys.argv[1]))
+        result = solver.solve()
+        solver.save(sys.argv[2])
+        print(f"{solver}: result={result}, saved to {sys.argv[2]}")
+    else:
+        test_two_player_solver()
+        test_three_player_solved_table()
@@ -0,0 +1,216 @@
+from typing import Callable, Dict, List, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from random import Random
+from time import perf_counter
+from cards import Cards
+from player import Player, RandomPlayer, CleverPlayer, MCTSPlayer
+from game import play, ConsoleSink
+import random
+import os
+
+class _TimedPlayer(Player):
+    """
+    Wraps a player, timing each of their decisions
+    """
+    def __init__(self, player: Player):
+        self.player = player
+        self.moves = 0
+        self.times = []
+
+    def next_move(self, this: int, cards: Cards, history: Set[int]) -> Tuple[int, int]:
+        start = perf_counter()
+        move = self.player.next_move(this, cards, history)
+        self.times.append(perf_counter() - start)
+        self.moves += 1
+        return move
+
+    def has_card(self, this: int, other: int, suit: int, cards: Cards, history: Set[int]) -> bool:
+        start = perf_counter()
+        has = self.player.has_card(this, other, suit, cards, history)
+        self.times.append(perf_counter() - start)
+        return has
+
+class Standing:
+    """
+    How one entry in a tournament has done: the games they won, drew and
+    lost, and the number, total time and longest time of their decisions.
+    """
+    def __init__(self):
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.decisions = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.draws + self.losses
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.decisions if self.decisions else 0.0
+
+class TournamentResult:
+    """
+    The results of a tournament: a Standing for each entry, by name, and
+    the games themselves. Each game is a tuple of (seats, result, moves),
+    where seats lists the name of the entry in each seat, result is the
+    winning seat or -1 for a draw, and moves is the number of requests.
+    """
+    def __init__(self, names: List[str]):
+        self.standings: Dict[str, Standing] = {name: Standing() for name in names}
+        self.games: List[Tuple[Tuple[str, ...], int, int]] = []
+        self.elapsed = 0.0
+
+    def add(self, seats: Tuple[str, ...], result: int, moves: int, times: List[List[float]]):
+        """
+        Adds the result of a game, with the times of the decisions made
+        in each seat
+        """
+        self.games.append((seats, result, moves))
+        for seat, name in enumerate(seats):
+            standing = self.standings[name]
+            if result < 0:
+                standing.draws += 1
+            elif result == seat:
+                standing.wins += 1
+            else:
+                standing.losses += 1
+            standing.decisions += len(times[seat])
+            standing.total_time += sum(times[seat])
+            standing.max_time = max([standing.max_time] + times[seat])
+
+    def game_lengths(self) -> List[int]:
+        return [moves for _, _, moves in self.games]
+
+    def __str__(self):
+        lengths = self.game_lengths()
+        mean_length = sum(lengths) / len(lengths) if lengths else 0.0
+        lines = [f"{len(self.games)} games in {self.elapsed:.1f} seconds, "
+            f"mean length {mean_length:.1f} moves"]
+        lines.append(f"{'entry':20} {'games':>6} {'wins':>6} {'draws':>6} {'losses':>6} "
+            f"{'mean ms':>9} {'max ms':>9}")
+        for name, standing in self.standings.items():
+            lines.append(f"{name:20} {standing.games:6} {standing.wins:6} {standing.draws:6} "
+                f"{standing.losses:6} {standing.mean_time * 1000:9.2f} {standing.max_time * 1000:9.2f}")
+        return "\n".join(lines)
+
+def play_game(factories: List[Callable[[], Player]], seed: int,
+        quiet: bool = True) -> Tuple[int, int, List[List[float]]]:
+    """
+    Plays one game between players made by the given factories, one per
+    seat, after seeding the random numbers. Returns the result, the
+    number of requests and the times of the decisions made in each seat.
+    If quiet, nothing is written to the console.
+    """
+    random.seed(seed)
+    players = [_TimedPlayer(factory()) for factory in factories]
+    result = play(players, None if quiet else ConsoleSink())
+    return result, sum(player.moves for player in players), [player.times for player in players]
+
+def _play_seated(roster: List[Tuple[str, Callable[[], Player]]], number_of_players: int,
+        self_play: bool, seed: int, quiet: bool, game: int):
+    """
+    Chooses the entries for each seat of a game, and plays it. With
+    self_play, an entry may take more than one seat.
+    """
+    game_seed = seed * 1000003 + game
+    if self_play:
+        entries = Random(game_seed).choices(roster, k = number_of_players)
+    else:
+        entries = Random(game_seed).sample(roster, number_of_players)
+    result, moves, times = play_game([factory for _, factory in entries], game_seed, quiet)
+    return tuple(name for name, _ in entries), result, moves, times
+
+def run_tournament(roster: List[Tuple[str, Callable[[], Player]]], games: int,
+        number_of_players: int = None, workers: int = None, seed: int = 0,
+        quiet: bool = True, self_play: bool = False) -> TournamentResult:
+    """
+    Plays the given number of games between entries in the roster, which
+    is a list of (name, factory), where calling the factory makes a new
+    player. The factories must be picklable, such as classes, or partial
+    applications of them. Each game has number_of_players seats, by
+    default one per entry, and the entries are seated at random. Each
+    entry takes at most one seat in a game, unless self_play, when they
+    are seated independently, so an entry may play against itself, and
+    a game counts in their standing once for each seat they took.
+
+    Each game is seeded from the seed and its number, so the same
+    tournament always plays the same games, whichever process plays them.
+    Games are played across a pool of worker processes, by default one
+    per core. If workers is one, they are played in this process.
+    """
+    if number_of_players is None:
+        number_of_players = len(roster)
+    if number_of_players < 2:
+        raise ValueError("a game needs at least two players")
+    if not self_play and number_of_players > len(roster):
+        raise ValueError("not enough entries for the seats without self_play")
+    if len(set(name for name, _ in roster)) != len(roster):
+        raise ValueError("entries must have different names")
+
+    start = perf_counter()
+    tournament = TournamentResult([name for name, _ in roster])
+    play_seated = partial(_play_seated, roster, number_of_players, self_play, seed, quiet)
+    if workers == 1:
+        outcomes = map(play_seated, range(games))
+        for seats, result, moves, times in outcomes:
+            tournament.add(seats, result, moves, times)
+    else:
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(workers) as executor:
+            chunksize = max(1, games // (4 * workers))
+            for seats, result, moves, times in executor.map(play_seated, range(games),
+                    chunksize = chunksize):
+                tournament.add(seats, result, moves, times)
+    tournament.elapsed = perf_counter() - start
+    return tournament
+
+def test_tournament():
+    """
+    Play a small three player tournament between random, clever and
+    MCTS players, in this process and in a pool. Both should play the
+    same games, and the standings should add up.
+    """
+    roster = [("random", RandomPlayer), ("clever", partial(CleverPlayer, 1000, 1000)),
+        ("mcts", partial(MCTSPlayer, 20))]
+    serial = run_tournament(roster, 4, workers = 1, seed = 1)
+    print(serial)
+    parallel = run_tournament(roster, 4, workers = 2, seed = 1)
+    print(parallel)
+    assert [game[:2] for game in parallel.games] == [game[:2] for game in serial.games]
+
+    standings = serial.standings.values()
+    assert sum(standing.games for standing in standings) == 12
+    assert sum(standing.wins for standing in standings) == \
+        sum(1 for _, result, _ in serial.games if result >= 0)
+    assert all(length > 0 for length in serial.game_lengths())
+    print("----------------")
+    print()
+
+def test_self_play():
+    """
+    Play a clever player against itself at a three player table. Every
+    seat should be theirs, and each game should count three times.
+    """
+    roster = [("clever", partial(CleverPlayer, 1000, 1000))]
+    try:
+        run_tournament(roster, 3, 3, workers = 1)
+        assert False, "test_self_play: expecting too few entries to fail"
+    except ValueError:
+        pass
+    tournament = run_tournament(roster, 3, 3, workers = 1, seed = 1, self_play = True)
+    print(tournament)
+    assert all(seats == ("clever",) * 3 for seats, _, _ in tournament.games)
+    standing = tournament.standings["clever"]
+    assert standing.games == 9
+    assert standing.wins == sum(1 for _, result, _ in tournament.games if result >= 0)
+    assert standing.draws == 3 * sum(1 for _, result, _ in tournament.games if result < 0)
+    print("----------------")
+    print()
+
+if __name__ == "__main__":
+    test_tournament()
+    test_self_play()